@@ -1,27 +1,160 @@
 # Description: Aatinaa API
 # Check if a stock is sharia compliant or not.
 
-from requests import post
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import Session
+
+import rate_limit
+from storage import open_store
+from telemetry import current
 
 URL = 'https://api.aatinaa.co/graphql'
 
+# How many tickers go into one GraphQL request and how many requests run at once
+BATCH_SIZE = 20
+MAX_WORKERS = 4
+
+# Compliance changes quarterly at most so results are kept for a week. The
+# cache is read from its store once per run, kept in memory and written back
+# once by flush_cache. A Cloud Function's /tmp goes with its instance, so there
+# SHARIA_CACHE_STORE should point at a bucket: gs://bucket/prefix
+CACHE_STORE = os.getenv("SHARIA_CACHE_STORE", tempfile.gettempdir())
+CACHE_KEY = "sharia_cache.json"
+CACHE_TTL = int(os.getenv("SHARIA_CACHE_TTL", 7 * 24 * 60 * 60))
+_cache = None
+_cache_changed = False
+_cache_lock = threading.Lock()
+
+# Only the fields needed to classify a stock
+FIELDS = "ticker\n    interestBearingDebtStatus\n    interestBearingSecuritiesStatus\n    interestVsRevenueStatus\n    shariaCompliantStatus\n"
+
+# One pooled session so every request reuses the same connections, paced by the shared limiter
+session = rate_limit.install(Session(), "aatinaa", pool_connections=1, pool_maxsize=MAX_WORKERS)
+
+
+def classify(data):
+    debt = data.get('interestBearingDebtStatus', None)
+    securities = data.get('interestBearingSecuritiesStatus', None)
+    revenue = data.get('interestVsRevenueStatus', None)
+    sharia_compliant = data.get('shariaCompliantStatus', None)
+
+    if sharia_compliant == 'PASSED':
+        return "COMPLIANT"
+    elif debt == 'PASSED' and securities == 'PASSED' and revenue == 'PASSED':
+        return "QUESTIONABLE"
+    else:
+        return "FAILED"
+
+
 def sharia_status(ticker):
 
-    body = {"operationName":"getStockDetail","variables":{"ticker":ticker},"query":"query getStockDetail($ticker: String!) {\n  getStockDetail(ticker: $ticker) {ticker\n    securityName\n    sector\n    totalDebt\n    totalCash\n    totalDeposit\n    totalReceivables\n    totalAssets\n    totalInterestIncome\n    totalRevenue\n    interestBearingDebt\n    interestBearingSecurities\n    interestVsRevenue\n    interestBearingDebtStatus\n    interestBearingSecuritiesStatus\n    interestVsRevenueStatus\n    redListStatus\n    shariaCompliantStatus\n    marketCap\n    createdAt\n    modifiedAt\n  }\n}\n"}
-    
+    body = {"operationName":"getStockDetail","variables":{"ticker":ticker},"query":"query getStockDetail($ticker: String!) {\n  getStockDetail(ticker: $ticker) {" + FIELDS + "  }\n}\n"}
+
+    try:
+        data = session.post(URL, json=body).json()['data']['getStockDetail']
+        return classify(data)
+    except Exception as e:
+        return "UNKNOWN"
+
+
+def _alias(ticker):
+    # GraphQL aliases can only have letters, digits and underscores (BRK.B -> BRK_B)
+    return re.sub(r'\W', '_', ticker)
+
+
+def _sharia_status_batch(tickers):
+    """Look up several tickers in one GraphQL request using an aliased getStockDetail per ticker"""
+    aliases = {f"t{i}_{_alias(ticker)}": ticker for i, ticker in enumerate(tickers)}
+    params = ", ".join(f"${alias}: String!" for alias in aliases)
+    selections = "".join(f"  {alias}: getStockDetail(ticker: ${alias}) {{{FIELDS}  }}\n" for alias in aliases)
+    body = {"operationName":"getStockDetails","variables":aliases,"query":f"query getStockDetails({params}) {{\n{selections}}}\n"}
+
+    report = current()
+    started = time.perf_counter()
     try:
-        data = post(URL, json=body).json()['data']['getStockDetail']
-
-        debt = data.get('interestBearingDebtStatus', None)
-        securities = data.get('interestBearingSecuritiesStatus', None)
-        revenue = data.get('interestVsRevenueStatus', None)
-        sharia_compliant = data.get('shariaCompliantStatus', None)
-
-        if sharia_compliant == 'PASSED':
-            return "COMPLIANT"
-        elif debt == 'PASSED' and securities == 'PASSED' and revenue == 'PASSED':
-            return "QUESTIONABLE"
-        else:
-            return "FAILED"
+        report.count("aatinaa.requests")
+        response = session.post(URL, json=body)
+        report.count("aatinaa.bytes", len(response.content))
+        data = response.json()['data']
+        if not isinstance(data, dict):
+            # a GraphQL error comes back as {"data": null, "errors": [...]}
+            raise ValueError(f"no data in the response: {response.text[:200]}")
     except Exception as e:
-        return "UNKNOWN"
\ No newline at end of file
+        report.event("request_failed", upstream="aatinaa", first=tickers[0], size=len(tickers), error=str(e)[:200])
+        return {ticker: "UNKNOWN" for ticker in tickers}
+    finally:
+        report.observe("aatinaa.batch_seconds", f"{tickers[0]}..{tickers[-1]}", time.perf_counter() - started)
+
+    # a ticker that Aatinaa doesn't know comes back as null
+    return {
+        ticker: classify(data[alias]) if isinstance(data.get(alias), dict) else "UNKNOWN"
+        for alias, ticker in aliases.items()
+    }
+
+
+def _load_cache():
+    """The cache of this run, read from the store the first time it is asked for. Call with _cache_lock held"""
+    global _cache
+    if _cache is None:
+        try:
+            data = open_store(CACHE_STORE).read(CACHE_KEY)
+            _cache = json.loads(data) if data is not None else {}
+        except (OSError, ValueError):
+            _cache = {}
+    return _cache
+
+
+def flush_cache():
+    """Write the statuses looked up this run to the store, the next run reads the store again"""
+    global _cache, _cache_changed
+    with _cache_lock:
+        if _cache is not None and _cache_changed:
+            open_store(CACHE_STORE).write(CACHE_KEY, json.dumps(_cache).encode())
+        _cache = None
+        _cache_changed = False
+
+
+def sharia_status_many(tickers, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, ttl=CACHE_TTL):
+    """Get the sharia status of many tickers, returns a dict of ticker -> status
+
+    Cached results younger than ttl seconds are used as is, the rest are
+    looked up in batches of batch_size tickers with max_workers requests at once.
+    New results stay in memory until flush_cache.
+    """
+    global _cache_changed
+    now = time.time()
+
+    statuses = {}
+    missing = []
+    with _cache_lock:
+        cache = _load_cache()
+        for ticker in dict.fromkeys(tickers):
+            cached = cache.get(ticker)
+            if cached and now - cached["time"] < ttl:
+                statuses[ticker] = cached["status"]
+            else:
+                missing.append(ticker)
+
+    current().count("aatinaa.cache_hits", len(statuses))
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(_sharia_status_batch, batches):
+            statuses.update(result)
+
+    # UNKNOWN means the lookup failed so it is tried again next time
+    if missing:
+        with _cache_lock:
+            cache = _load_cache()
+            for ticker in missing:
+                if statuses[ticker] != "UNKNOWN":
+                    cache[ticker] = {"status": statuses[ticker], "time": now}
+                    _cache_changed = True
+
+    return statuses
@@ -0,0 +1,134 @@
+# Description: Corporate action adjustments
+# The bar cache keeps prices as traded, so a split would otherwise look like
+# a crash to the SMA and 52 week conditions. Next to each symbol's bars the
+# cache keeps a small table of its splits and cash dividends. When bars are
+# read the table is turned into a per-bar price factor (a few array
+# operations), and "Adj Close" is the close times that factor. A new split
+# or dividend only adds a row to the table. No bars are fetched again and
+# raw and adjusted prices come from the same stored bars.
+#
+# The actions come from Alpaca's corporate actions API. sync_actions only
+# asks for the days since a symbol was last synced.
+
+import datetime as dt
+
+import numpy as np
+
+from telemetry import current
+
+# One action as a record: prices before ex_date are divided by split and
+# reduced by dividend (cash per share), one of them is always 1 / 0
+ACTION_DTYPE = np.dtype([("ex_date", np.int64), ("split", np.float64), ("dividend", np.float64)])
+
+# the kinds of action that change the price series
+ACTION_TYPES = ["forward_split", "reverse_split", "stock_dividend", "cash_dividend"]
+
+# symbols per request, they go in the query string
+SYMBOLS_PER_REQUEST = 100
+
+DAY_NS = 86_400 * 10**9
+
+
+def _day(value):
+    """A date or YYYY-MM-DD string as UTC midnight epoch nanoseconds"""
+    if isinstance(value, str):
+        value = dt.date.fromisoformat(value[:10])
+    return (value - dt.date(1970, 1, 1)).days * DAY_NS
+
+
+def from_alpaca(response):
+    """Turn the raw corporate actions response into symbol -> action records sorted by ex_date"""
+    rows = {}
+    for kind, actions in (response or {}).items():
+        for action in actions:
+            if kind in ("forward_splits", "reverse_splits"):
+                row = (_day(action["ex_date"]), action["new_rate"] / action["old_rate"], 0.0)
+            elif kind == "stock_dividends":
+                # rate new shares for every share held, like a split of 1 + rate
+                row = (_day(action["ex_date"]), 1.0 + action["rate"], 0.0)
+            elif kind == "cash_dividends":
+                row = (_day(action["ex_date"]), 1.0, action["rate"])
+            else:
+                continue
+            rows.setdefault(action["symbol"], []).append(row)
+    return {symbol: np.sort(np.array(actions, dtype=ACTION_DTYPE), order="ex_date") for symbol, actions in rows.items()}
+
+
+def merge_actions(old, new):
+    """Combine two action tables sorted by ex date, an action already in old isn't added twice"""
+    if old is None:
+        return np.unique(new)
+    # unique sorts the records field by field, so by ex_date first
+    return np.unique(np.concatenate([old, new]))
+
+
+def price_factors(timestamp, close, actions):
+    """The multiplier that adjusts each bar's prices for every action after it, None if none applies
+
+    A split divides the earlier prices by its ratio. A cash dividend scales
+    them by 1 - dividend / the close before the ex date, the usual
+    back-adjustment. Actions after the last bar (announced but not traded
+    yet) are left out.
+    """
+    if actions is None or not len(timestamp):
+        return None
+    actions = actions[(actions["ex_date"] > timestamp[0]) & (actions["ex_date"] <= timestamp[-1])]
+    if not len(actions):
+        return None
+
+    # the bar before each ex date is the last one with a timestamp below it
+    before = np.searchsorted(timestamp, actions["ex_date"], "left") - 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dividend = np.where(actions["dividend"] > 0, 1 - actions["dividend"] / close[before], 1.0)
+    factors = np.where(np.isfinite(dividend) & (dividend > 0), dividend, 1.0) / actions["split"]
+
+    # a bar takes the product of the factors of every action after it
+    after = np.append(np.cumprod(factors[::-1])[::-1], 1.0)
+    return after[np.searchsorted(actions["ex_date"], timestamp, "right")]
+
+
+def sync_actions(tickers, start_date, end_date, client, cache=None):
+    """Record every split and dividend of the tickers between start_date and end_date in the bar cache
+
+    client is an Alpaca CorporateActionsClient returning raw responses. A
+    ticker synced before is only asked about the days since. Returns the
+    tickers that got a new action, their bars now read with new factors.
+    """
+    from alpaca.data.requests import CorporateActionsRequest
+
+    from bar_cache import BarCache
+
+    cache = cache or BarCache()
+    report = current()
+    start_date = start_date.date() if isinstance(start_date, dt.datetime) else start_date
+    end = end_date.date() if isinstance(end_date, dt.datetime) else end_date
+
+    # tickers that need actions from the same day onwards are asked about together
+    groups = {}
+    for ticker in tickers:
+        synced = cache.actions_synced(ticker)
+        if synced is None:
+            start = start_date
+        elif dt.date.fromisoformat(synced) >= end:
+            continue  # already synced today
+        else:
+            start = max(dt.date.fromisoformat(synced), start_date)
+        groups.setdefault(start, []).append(ticker)
+
+    changed = []
+    for start, group in groups.items():
+        for i in range(0, len(group), SYMBOLS_PER_REQUEST):
+            chunk = group[i:i + SYMBOLS_PER_REQUEST]
+            request = CorporateActionsRequest(symbols=chunk, types=ACTION_TYPES, start=start, end=end)
+            report.count("alpaca.corporate_action_requests")
+            actions = from_alpaca(client.get_corporate_actions(request))
+            # the end day is asked again next time in case it was synced before its actions were published
+            empty = np.empty(0, dtype=ACTION_DTYPE)
+            for ticker in chunk:
+                if cache.add_actions(ticker, actions.get(ticker, empty), synced=end.isoformat()):
+                    changed.append(ticker)
+
+    report.count("corporate_actions.changed", len(changed))
+    if changed:
+        print(f"New splits or dividends for {len(changed)} tickers: {', '.join(changed[:20])}")
+    return changed
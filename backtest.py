@@ -0,0 +1,250 @@
+# Description: Backtest the screener conditions
+# Runs the six conditions from main() for every trading day in a date range
+# over the bars in the local bar cache, fetching whatever the cache is missing
+# for the range first. All tickers and all days are done in one pass with
+# cumulative-sum SMAs and block-wise sliding min/max, and the result is a day x
+# ticker table of condition bitmasks (bit 0 is cond 1).
+#
+# Like conditions.evaluate_frames, every window runs over the ticker's own
+# bars, so a ticker that was halted for a while gets the same SMAs and 52 week
+# range as the screener would have given it on that day.
+
+import argparse
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from bar_cache import BarCache
+from conditions import LOOKBACK
+
+# Same integer scaling as indicator_state so the SMAs are exact
+SCALE = 10_000
+
+# main() skips tickers with fewer bars than this
+MIN_BARS = 50
+
+# How far back to read before the first day so every window is full
+WARMUP_DAYS = 400
+
+
+def load_closes(tickers, start_date, end_date, cache=None, close="Close"):
+    """Get a day x ticker DataFrame of closes from the bar cache, NaN where a ticker has no bar"""
+    cache = cache or BarCache()
+    series = {}
+    for ticker in tickers:
+        df = cache.read(ticker, start_date, end_date)
+        if df is None or df.empty:
+            continue
+        # daily bars are stamped at 04:00 or 05:00 UTC depending on DST, so line them up by date
+        series[ticker] = pd.Series(df[close].to_numpy(), index=df.index.normalize())
+
+    if not series:
+        return pd.DataFrame(index=pd.DatetimeIndex([], tz="UTC"))
+    return pd.concat(series, axis=1, sort=True)
+
+
+def _own_bars(values):
+    """Stack each column's values without its missing days, bottom aligned in a bar x column matrix
+
+    Returns the matrix and, for every (day, column) that has a value, its
+    day row, column and bar row, to put results back on the days with scatter.
+    """
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=0)
+    depth = int(counts.max()) if len(counts) else 0
+    # a column's last bar lands on the last row, so a shorter history is padded with NaN at the top
+    positions = np.cumsum(valid, axis=0) - 1 + (depth - counts)
+    days, columns = np.nonzero(valid)
+    bars = positions[days, columns]
+
+    panel = np.full((depth, values.shape[1]), np.nan)
+    panel[bars, columns] = values[days, columns]
+    return panel, (days, columns, bars)
+
+
+def _scatter(values, cells, shape, fill):
+    """Put a bar x column result from _own_bars back on the day x column grid"""
+    days, columns, bars = cells
+    out = np.full(shape, fill, dtype=values.dtype)
+    out[days, columns] = values[bars, columns]
+    return out
+
+
+def _rolling_mean(scaled, valid, window, lag=0):
+    """Mean of the last `window` valid closes at every row, `lag` rows back, NaN with no data"""
+    rows = len(scaled)
+    sums = np.vstack([np.zeros((1, scaled.shape[1]), dtype=np.int64), np.cumsum(scaled, axis=0)])
+    counts = np.vstack([np.zeros((1, valid.shape[1]), dtype=np.int64), np.cumsum(valid, axis=0)])
+
+    end = np.arange(1, rows + 1) - lag
+    start = np.maximum(end - window, 0)
+    end = np.maximum(end, 0)
+
+    total = sums[end] - sums[start]
+    count = counts[end] - counts[start]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.round(np.where(count > 0, total / count / SCALE, np.nan), 2)
+
+
+def _rolling_extreme(values, window, accumulate):
+    """Sliding window max (np.maximum) or min (np.minimum) along the rows
+
+    Splits the rows into blocks of `window` and combines the running extreme
+    from each block's end with the one from the next block's start, so the
+    cost doesn't depend on the window size.
+    """
+    rows, cols = values.shape
+    fill = -np.inf if accumulate is np.maximum else np.inf
+    pad = (-rows) % window
+    blocks = np.vstack([values, np.full((pad, cols), fill)]).reshape(-1, window, cols)
+
+    prefix = accumulate.accumulate(blocks, axis=1).reshape(-1, cols)
+    suffix = accumulate.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(-1, cols)
+
+    out = prefix[:rows].copy()
+    if rows >= window:
+        out[window - 1:] = accumulate(suffix[: rows - window + 1], prefix[window - 1 : rows])
+    return out
+
+
+def condition_masks(closes):
+    """Evaluate the six conditions on every row of a day x ticker close DataFrame
+
+    Returns a uint8 DataFrame of the same shape where bit i is set when
+    condition i + 1 held on that day. Days without a bar or with fewer than
+    MIN_BARS bars of history are 0.
+    """
+    days = closes.to_numpy(dtype=float)
+    # the windows run over each ticker's own bars, not over every day any ticker traded
+    panel, cells = _own_bars(days)
+    valid = ~np.isnan(panel)
+    scaled = np.where(valid, np.round(panel * SCALE), 0).astype(np.int64)
+
+    sma_50 = _rolling_mean(scaled, valid, 50)
+    sma_150 = _rolling_mean(scaled, valid, 150)
+    sma_200 = _rolling_mean(scaled, valid, 200)
+    sma_200_20 = _rolling_mean(scaled, valid, 200, lag=21)
+
+    low_52 = _rolling_extreme(np.where(valid, panel, np.inf), LOOKBACK, np.minimum)
+    high_52 = _rolling_extreme(np.where(valid, panel, -np.inf), LOOKBACK, np.maximum)
+    low_52 = np.round(low_52, 2)
+    high_52 = np.round(high_52, 2)
+
+    with np.errstate(invalid="ignore"):
+        conditions = [
+            (panel > sma_150) & (sma_150 > sma_200),
+            sma_200 > sma_200_20,
+            (sma_50 > sma_150) & (sma_150 > sma_200),
+            panel > sma_50,
+            panel >= 1.3 * low_52,
+            panel >= 0.75 * high_52,
+        ]
+
+    masks = np.zeros(panel.shape, dtype=np.uint8)
+    for bit, condition in enumerate(conditions):
+        masks |= condition.astype(np.uint8) << bit
+
+    enough_history = np.cumsum(valid, axis=0) >= MIN_BARS
+    masks[~(valid & enough_history)] = 0
+    return pd.DataFrame(_scatter(masks, cells, days.shape, 0), index=closes.index, columns=closes.columns)
+
+
+def condition_count(masks):
+    """Count the conditions set in each bitmask"""
+    values = masks.to_numpy()
+    count = sum((values >> bit) & 1 for bit in range(6))
+    return pd.DataFrame(count, index=masks.index, columns=masks.columns)
+
+
+def forward_returns(closes, horizon):
+    """Return from each day's close to the ticker's close `horizon` of its own bars later"""
+    panel, cells = _own_bars(closes.to_numpy(dtype=float))
+    later = np.full_like(panel, np.nan)
+    if horizon < len(panel):
+        later[:len(panel) - horizon] = panel[horizon:]
+    returns = _scatter(later / panel - 1, cells, closes.shape, np.nan)
+    return pd.DataFrame(returns, index=closes.index, columns=closes.columns)
+
+
+def trim(frame, start_date):
+    """The rows of a day x ticker table from start_date on, without the warm-up days"""
+    return frame[frame.index >= pd.Timestamp(start_date, tz="UTC").normalize()]
+
+
+def entries(masks, closes, min_count=6, horizons=(20, 60), start_date=None):
+    """List every day a ticker moved up to min_count conditions, with forward returns
+
+    masks and closes are the full tables from run, warm-up days included, so a
+    ticker that already met min_count before start_date isn't an entry on it.
+    """
+    has_bar = closes.notna()
+    hit = (condition_count(masks) >= min_count) & has_bar
+    # only the first day of each streak is an entry, compared with the ticker's previous bar
+    before = hit.where(has_bar).ffill().shift(1).fillna(False).astype(bool)
+    entered = hit & ~before
+    if start_date is not None:
+        entered = trim(entered, start_date)
+
+    rows = entered.stack()
+    rows = rows[rows].index
+    result = pd.DataFrame({"Date": rows.get_level_values(0), "Ticker": rows.get_level_values(1)})
+    result["Close"] = closes.stack().reindex(rows).to_numpy()
+    for horizon in horizons:
+        result[f"Return {horizon}d"] = forward_returns(closes, horizon).stack().reindex(rows).to_numpy()
+    return result
+
+
+def run(tickers, start_date, end_date, cache=None, fetch=True):
+    """Backtest the conditions from start_date to end_date, returns the masks and closes
+
+    Both start WARMUP_DAYS before start_date so every window is full on the
+    first day, trim leaves those days out. With fetch, whatever the bar cache
+    is missing for the range is fetched from Alpaca first. A cache kept by the
+    daily runs only goes back about 400 days.
+    """
+    cache = cache or BarCache()
+    first = start_date - dt.timedelta(days=WARMUP_DAYS)
+    if fetch:
+        import main
+
+        main.get_cached_stock_data(tickers, first, end_date, cache=cache, evict=False)
+
+    closes = load_closes(tickers, first, end_date, cache)
+    if closes.empty:
+        return closes, closes
+    return condition_masks(closes), closes
+
+
+def save_masks(masks, path):
+    """Write the bitmask table as a compressed .npz (dates, tickers, masks)"""
+    np.savez_compressed(
+        path,
+        dates=masks.index.as_unit("ns").asi8,
+        tickers=np.array(masks.columns, dtype=str),
+        masks=masks.to_numpy(dtype=np.uint8),
+    )
+
+
+def load_masks(path):
+    data = np.load(path)
+    index = pd.DatetimeIndex(data["dates"].view("datetime64[ns]")).tz_localize("UTC")
+    return pd.DataFrame(data["masks"], index=index, columns=data["tickers"])
+
+
+# Example: python backtest.py 2024-01-01 2024-12-31 NVDA AAPL --output masks.npz
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest the screener conditions on cached bars")
+    parser.add_argument("start", type=dt.datetime.fromisoformat)
+    parser.add_argument("end", type=dt.datetime.fromisoformat)
+    parser.add_argument("tickers", nargs="*", help="defaults to every symbol in the bar cache")
+    parser.add_argument("--output", default="backtest_masks.npz")
+    parser.add_argument("--no-fetch", action="store_true", help="only use the bars already in the cache")
+    args = parser.parse_args()
+
+    cache = BarCache()
+    masks, closes = run(args.tickers or cache.symbols(), args.start, args.end, cache, fetch=not args.no_fetch)
+    if closes.empty:
+        raise SystemExit(f"No bars for {args.start:%Y-%m-%d} to {args.end:%Y-%m-%d}")
+    save_masks(trim(masks, args.start), args.output)
+    print(entries(masks, closes, start_date=args.start).to_string())
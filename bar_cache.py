@@ -0,0 +1,312 @@
+# Description: Local bar cache
+# Keeps the daily bars of every symbol on disk so a run only has to fetch
+# the days it hasn't seen yet. Each symbol gets its own directory with its
+# bars in one .npy file of records, which is read back straight into Bars.
+# Its splits and dividends, if it has any, are kept next to the bars (see
+# adjustments.py) and turn into the price factor of the Bars that are read.
+#
+# The cache works in a local directory, which on Cloud Functions is /tmp: in
+# memory and gone once the instance is recycled, which for a daily run is
+# almost every time. Set BAR_CACHE_STORE to a bucket (gs://bucket/prefix) and
+# the whole cache is saved there as one archive after a run and restored from
+# it when a new instance starts with an empty cache.
+
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from adjustments import ACTION_DTYPE, merge_actions, price_factors
+from bars import Bars
+from storage import atomic_directory, atomic_write
+
+# Cloud Functions can only write to /tmp so that is the default location
+CACHE_DIR = os.getenv("BAR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bar_cache"))
+
+# Where the cache is kept between instances, see above. Unset keeps it only in CACHE_DIR
+CACHE_STORE = os.getenv("BAR_CACHE_STORE")
+SNAPSHOT_KEY = "bar_cache.tar.gz"
+
+# Once the cache is bigger than this, symbols that left the universe are evicted
+MAX_CACHE_BYTES = int(os.getenv("BAR_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+
+# More calendar days than this between two bars means bars are missing
+# (a long weekend with a holiday is 4 days)
+MAX_GAP_DAYS = 5
+
+# every bar of a symbol as one structured array, see bars.DTYPE
+BARS_FILE = "bars.npy"
+META_FILE = "meta.json"
+# the symbol's splits and dividends as adjustments.ACTION_DTYPE records, only there if it has any
+ACTIONS_FILE = "actions.npy"
+# the last day its actions were synced up to, so dropping a symbol also has its actions synced again
+ACTIONS_SYNC_FILE = "actions.json"
+
+
+def _to_timestamp(value):
+    """Convert a date or datetime to a UTC pandas Timestamp (naive means UTC)"""
+    value = pd.Timestamp(value)
+    if value.tzinfo is None:
+        return value.tz_localize("UTC")
+    return value.tz_convert("UTC")
+
+
+def _gaps(timestamps, max_gap_days=MAX_GAP_DAYS):
+    """The (before, after) epoch nanoseconds of every hole of more than max_gap_days between two bars"""
+    if timestamps is None or len(timestamps) < 2:
+        return []
+    gaps = np.flatnonzero(np.diff(timestamps) > max_gap_days * 86_400 * 10**9)
+    return [(int(timestamps[i]), int(timestamps[i + 1])) for i in gaps]
+
+
+def _as_bars(symbol, bars):
+    """Accept either Bars or a DataFrame of bars"""
+    return bars if isinstance(bars, Bars) else Bars.from_pandas(symbol, bars)
+
+
+class BarCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, symbol):
+        # symbols like BRK/B would otherwise turn into nested directories
+        return os.path.join(self.root, symbol.replace("/", "_"))
+
+    def symbols(self):
+        """List every symbol that has bars (or corporate actions) in the cache"""
+        return [
+            name
+            for name in os.listdir(self.root)
+            if not name.startswith(".") and os.path.isdir(os.path.join(self.root, name))
+        ]
+
+    def has(self, symbol):
+        return os.path.exists(os.path.join(self._path(symbol), BARS_FILE))
+
+    def _meta(self, symbol):
+        with open(os.path.join(self._path(symbol), META_FILE)) as f:
+            return json.load(f)
+
+    def _records(self, symbol):
+        # a symbol is a few KB so it is read straight into memory, memory-mapping
+        # it would keep a file descriptor open for as long as the bars live
+        return np.load(os.path.join(self._path(symbol), BARS_FILE))
+
+    def dates(self, symbol):
+        """Get the stored bar dates of a symbol as a UTC DatetimeIndex"""
+        if not self.has(symbol):
+            return None
+        timestamps = np.ascontiguousarray(self._records(symbol)["timestamp"])
+        return pd.DatetimeIndex(timestamps.view("datetime64[ns]")).tz_localize("UTC")
+
+    def read_bars(self, symbol, start_date=None, end_date=None):
+        """Get the cached bars of a symbol between two dates as Bars"""
+        if not self.has(symbol):
+            return None
+
+        # factors are worked out over the full history, a dividend needs the close before its ex date
+        bars = self._with_factors(Bars.from_records(symbol, self._records(symbol))).between(start_date, end_date)
+
+        # touch the directory so eviction knows this symbol is still in use
+        os.utime(self._path(symbol))
+        return bars
+
+    def read(self, symbol, start_date=None, end_date=None):
+        """Get the cached bars of a symbol between two dates as a DataFrame indexed by Date"""
+        bars = self.read_bars(symbol, start_date, end_date)
+        return None if bars is None else bars.to_pandas()
+
+    def read_actions(self, symbol):
+        """The symbol's splits and dividends sorted by ex date, None if it has none"""
+        path = os.path.join(self._path(symbol), ACTIONS_FILE)
+        return np.load(path) if os.path.exists(path) else None
+
+    def actions_synced(self, symbol):
+        """The day (YYYY-MM-DD) the symbol's actions were last synced up to, None if they never were"""
+        try:
+            with open(os.path.join(self._path(symbol), ACTIONS_SYNC_FILE)) as f:
+                return json.load(f)["synced"]
+        except FileNotFoundError:
+            return None
+
+    def add_actions(self, symbol, actions, synced=None):
+        """Record splits and dividends of a symbol, returns whether any of them are new
+
+        Only this table changes, the bars stay as they were fetched. synced is
+        the day the actions are now complete up to.
+        """
+        os.makedirs(self._path(symbol), exist_ok=True)
+        actions = np.asarray(actions, dtype=ACTION_DTYPE)
+        old = self.read_actions(symbol)
+        merged = merge_actions(old, actions)
+        changed = len(merged) > (0 if old is None else len(old))
+
+        if changed:
+            with atomic_write(os.path.join(self._path(symbol), ACTIONS_FILE)) as f:
+                np.save(f, merged)
+        if synced is not None:
+            with atomic_write(os.path.join(self._path(symbol), ACTIONS_SYNC_FILE), "w") as f:
+                json.dump({"synced": str(synced)}, f)
+        return changed
+
+    def _with_factors(self, bars):
+        bars.factor = price_factors(bars.timestamp, bars.close, self.read_actions(bars.symbol))
+        return bars
+
+    def write(self, symbol, bars, start_date=None):
+        """Replace everything cached for a symbol with the given Bars (or DataFrame of bars)
+
+        start_date is the first day that was asked for when these bars were
+        fetched, so later runs know how far back the history is complete.
+        Returns the Bars that were written.
+        """
+        bars = _as_bars(symbol, bars)
+        if start_date is None:
+            start_date = pd.Timestamp(bars.timestamp[0], tz="UTC")
+
+        path = self._path(symbol)
+        with atomic_directory(path) as tmp:
+            np.save(os.path.join(tmp, BARS_FILE), bars.to_records())
+            # a full history is everything Alpaca has, so its holes are real (a halt) and not fetched again
+            meta = {"start": _to_timestamp(start_date).isoformat(), "gaps": _gaps(bars.timestamp)}
+            with open(os.path.join(tmp, META_FILE), "w") as f:
+                json.dump(meta, f)
+            # the splits and dividends don't change with the bars
+            for name in (ACTIONS_FILE, ACTIONS_SYNC_FILE):
+                if os.path.exists(os.path.join(path, name)):
+                    shutil.copy(os.path.join(path, name), os.path.join(tmp, name))
+        return self._with_factors(bars)
+
+    def append(self, symbol, bars, start_date=None):
+        """Add newly fetched bars to a symbol, newer bars replace cached ones with the same timestamp
+
+        Returns all the bars now cached for the symbol.
+        """
+        if not self.has(symbol):
+            return self.write(symbol, bars, start_date)
+
+        merged = self.read_bars(symbol).merge(_as_bars(symbol, bars))
+
+        # the start date doesn't change so only the bars file is replaced
+        with atomic_write(os.path.join(self._path(symbol), BARS_FILE)) as f:
+            np.save(f, merged.to_records())
+        return self._with_factors(merged)
+
+    def drop(self, symbol, keep_actions=False):
+        """Remove a symbol from the cache, the next run will fetch its full history
+
+        With keep_actions only the bars go, its splits and dividends stay.
+        """
+        path = self._path(symbol)
+        if keep_actions:
+            for name in (BARS_FILE, META_FILE):
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+        elif os.path.exists(path):
+            shutil.rmtree(path)
+
+    def find_gaps(self, symbol, max_gap_days=MAX_GAP_DAYS):
+        """Get the (before, after) dates of every hole in a symbol's history"""
+        if not self.has(symbol):
+            return []
+        return [
+            (pd.Timestamp(before, tz="UTC"), pd.Timestamp(after, tz="UTC"))
+            for before, after in _gaps(self._records(symbol)["timestamp"], max_gap_days)
+        ]
+
+    def _unknown_gaps(self, symbol, dates):
+        """The holes in dates that weren't there when the full history was fetched"""
+        known = {tuple(gap) for gap in self._meta(symbol).get("gaps", [])}
+        return [gap for gap in _gaps(dates.asi8) if gap not in known]
+
+    def missing_start(self, symbol, start_date, end_date):
+        """Work out where a fetch has to start so the cache covers start_date to end_date
+
+        Returns start_date when the full history has to be fetched, the last
+        cached day when only new bars are needed, or None when nothing is missing.
+        """
+        if not self.has(symbol):
+            return start_date
+
+        # the cached history doesn't go back far enough or has new holes, so fetch it all again
+        dates = self.dates(symbol)
+        if _to_timestamp(self._meta(symbol)["start"]) > _to_timestamp(start_date) or self._unknown_gaps(symbol, dates):
+            return start_date
+
+        # refetch the last cached day as well in case it was stored before the close
+        last = dates[-1]
+        if last.normalize() >= _to_timestamp(end_date).normalize():
+            return None
+        return last.to_pydatetime()
+
+    def size(self, symbol=None):
+        """Get the bytes used by one symbol or by the whole cache"""
+        symbols = [symbol] if symbol else self.symbols()
+        total = 0
+        for name in symbols:
+            path = self._path(name)
+            for file in os.listdir(path):
+                total += os.path.getsize(os.path.join(path, file))
+        return total
+
+    def evict(self, keep=()):
+        """Remove symbols that aren't in keep, least recently used first, until the cache fits"""
+        keep = {symbol.replace("/", "_") for symbol in keep}
+        total = self.size()
+        if total <= self.max_bytes:
+            return []
+
+        candidates = [symbol for symbol in self.symbols() if symbol not in keep]
+        candidates.sort(key=lambda symbol: os.path.getmtime(self._path(symbol)))
+
+        evicted = []
+        for symbol in candidates:
+            if total <= self.max_bytes:
+                break
+            total -= self.size(symbol)
+            self.drop(symbol)
+            evicted.append(symbol)
+
+        print(f"Evicted {len(evicted)} symbols from the bar cache ({total / 1024 / 1024:.1f} MB left)")
+        return evicted
+
+    def save_snapshot(self, location=CACHE_STORE):
+        """Save the whole cache to the store at location as one archive, returns its size in bytes"""
+        from storage import open_store
+
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz", compresslevel=1) as archive:
+            for symbol in self.symbols():
+                archive.add(self._path(symbol), arcname=symbol)
+        open_store(location).write(SNAPSHOT_KEY, buffer.getvalue())
+        print(f"Saved the bar cache to {location} ({buffer.tell() / 1024 / 1024:.1f} MB)")
+        return buffer.tell()
+
+    def restore_snapshot(self, location=CACHE_STORE):
+        """Fill the cache from the archive at location, returns the number of symbols restored
+
+        Symbols already in the local cache are kept as they are.
+        """
+        from storage import open_store
+
+        data = open_store(location).read(SNAPSHOT_KEY)
+        if data is None:
+            return 0
+        have = set(self.symbols())
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as archive:
+            members = [
+                member for member in archive.getmembers()
+                if (member.isfile() or member.isdir()) and member.name.split("/")[0] not in have
+                and not member.name.startswith((".", "/")) and ".." not in member.name.split("/")
+            ]
+            archive.extractall(self.root, members=members)
+        restored = len({member.name.split("/")[0] for member in members})
+        print(f"Restored {restored} symbols into the bar cache from {location}")
+        return restored
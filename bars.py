@@ -0,0 +1,179 @@
+# Description: Compact daily bars
+# Holds the bars of one symbol as contiguous NumPy arrays: int64 UTC
+# nanosecond timestamps plus float64 open, high, low, close and volume.
+# Built straight from Alpaca's bar objects or the bar cache without going
+# through per-bar dicts or a DataFrame, and only turned into pandas when
+# something asks for it.
+#
+# The prices are always as traded. When the bar cache has corporate actions
+# for a symbol (see adjustments.py) the bars also carry a per-bar price
+# factor, and "Adj Close" is the close times that factor, worked out when it
+# is asked for.
+
+import datetime as dt
+
+import numpy as np
+
+# field on an Alpaca bar / array on Bars -> column in the DataFrame we hand back
+COLUMNS = {
+    "open": "Open",
+    "high": "High",
+    "low": "Low",
+    "close": "Close",
+    "volume": "Volume",
+}
+
+# DataFrame column -> array, so bars["Close"] works like it does on a DataFrame
+_FIELDS = {ours: field for field, ours in COLUMNS.items()}
+_FIELDS["Adj Close"] = "adj_close"
+
+# One bar as a record, how bars are stored on disk
+DTYPE = np.dtype([("timestamp", np.int64)] + [(field, np.float64) for field in COLUMNS])
+
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+_MICROSECOND = dt.timedelta(microseconds=1)
+
+
+def _utc_nanoseconds(value):
+    """Convert a datetime, pandas Timestamp or date string to UTC epoch nanoseconds (naive means UTC)"""
+    if type(value) is dt.datetime:
+        # integer arithmetic is exact and far quicker than going through pandas for every bar
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=dt.timezone.utc)
+        return (value - _EPOCH) // _MICROSECOND * 1000
+
+    import pandas as pd
+
+    value = pd.Timestamp(value)
+    if value.tzinfo is None:
+        value = value.tz_localize("UTC")
+    return value.as_unit("ns").value
+
+
+class Bars:
+    __slots__ = ("symbol", "timestamp", "open", "high", "low", "close", "volume", "factor")
+
+    def __init__(self, symbol, timestamp, open, high, low, close, volume, factor=None):
+        self.symbol = symbol
+        self.timestamp = np.asarray(timestamp, dtype=np.int64)
+        self.open = np.asarray(open, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+        # multiplier that adjusts each bar's prices for the splits and dividends after it, None if there are none
+        self.factor = None if factor is None else np.asarray(factor, dtype=np.float64)
+
+    @classmethod
+    def from_alpaca(cls, symbol, bars):
+        """Build from a list of Alpaca bar objects (or dicts with the same keys)"""
+        n = len(bars)
+        if n and isinstance(bars[0], dict):
+            get = dict.get
+        else:
+            get = getattr
+
+        return cls(
+            symbol,
+            np.fromiter((_utc_nanoseconds(get(bar, "timestamp")) for bar in bars), dtype=np.int64, count=n),
+            *(np.fromiter((get(bar, field) for bar in bars), dtype=np.float64, count=n) for field in COLUMNS),
+        )
+
+    @classmethod
+    def from_pandas(cls, symbol, df):
+        """Build from a DataFrame indexed by date with either lowercase or capitalized bar columns"""
+        import pandas as pd
+
+        index = pd.DatetimeIndex(df.index)
+        index = index.tz_localize("UTC") if index.tz is None else index.tz_convert("UTC")
+        return cls(
+            symbol,
+            index.as_unit("ns").asi8,
+            *(df[ours] if ours in df.columns else df[field] for field, ours in COLUMNS.items()),
+        )
+
+    @classmethod
+    def from_records(cls, symbol, records):
+        """Build from a structured array with the DTYPE fields"""
+        # copy each field out so every array is contiguous
+        return cls(symbol, *(np.ascontiguousarray(records[field]) for field in DTYPE.names))
+
+    @classmethod
+    def empty(cls, symbol):
+        return cls(symbol, [], [], [], [], [], [])
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __getitem__(self, column):
+        # accept the DataFrame column names as well as the field names
+        return getattr(self, _FIELDS.get(column, column))
+
+    def __repr__(self):
+        return f"Bars({self.symbol!r}, {len(self)} bars)"
+
+    @property
+    def adj_close(self):
+        """The closes adjusted for splits and dividends, the closes themselves without any"""
+        return self.close if self.factor is None else self.close * self.factor
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, field).nbytes for field in DTYPE.names)
+
+    @property
+    def index(self):
+        """The bar dates as a UTC DatetimeIndex named Date"""
+        import pandas as pd
+
+        return pd.DatetimeIndex(self.timestamp.view("datetime64[ns]"), name="Date").tz_localize("UTC")
+
+    def _take(self, key):
+        factor = None if self.factor is None else self.factor[key]
+        return Bars(self.symbol, *(getattr(self, field)[key] for field in DTYPE.names), factor=factor)
+
+    def between(self, start_date=None, end_date=None):
+        """The bars from start_date to end_date (both included), as views of these arrays"""
+        # the timestamps are sorted so a date range is just a slice
+        lo = 0 if start_date is None else np.searchsorted(self.timestamp, _utc_nanoseconds(start_date), "left")
+        hi = len(self) if end_date is None else np.searchsorted(self.timestamp, _utc_nanoseconds(end_date), "right")
+        return self._take(slice(lo, hi))
+
+    def merge(self, newer):
+        """Combine with newer bars, a newer bar replaces one with the same timestamp
+
+        The result has no price factor, the bar cache works it out again for the combined bars.
+        """
+        if not len(newer):
+            return self
+        combined = Bars(self.symbol, *(
+            np.concatenate([getattr(self, field), getattr(newer, field)]) for field in DTYPE.names
+        ))
+        # the usual case: newer starts after the last bar we have
+        if not len(self) or newer.timestamp[0] > self.timestamp[-1]:
+            return combined
+
+        # a stable sort keeps the newer bar last among equal timestamps, keep only that one
+        order = np.argsort(combined.timestamp, kind="stable")
+        timestamps = combined.timestamp[order]
+        last = np.append(timestamps[1:] != timestamps[:-1], True)
+        return combined._take(order[last])
+
+    def to_records(self):
+        """The bars as one structured array with the DTYPE fields"""
+        records = np.empty(len(self), dtype=DTYPE)
+        for field in DTYPE.names:
+            records[field] = getattr(self, field)
+        return records
+
+    def to_pandas(self):
+        """The bars as a DataFrame indexed by Date with Open, High, Low, Close and Volume columns
+
+        Bars with a price factor also get an Adj Close column.
+        """
+        import pandas as pd
+
+        columns = {ours: getattr(self, field) for field, ours in COLUMNS.items()}
+        if self.factor is not None:
+            columns["Adj Close"] = self.adj_close
+        return pd.DataFrame(columns, index=self.index)
@@ -0,0 +1,467 @@
+# Description: Offline benchmark of the screener
+# Runs every stage of main() (screen, fetch, evaluate, compliance, publish)
+# against the stand-ins in fakes.py for synthetic universes of different
+# sizes, and appends the timings, throughput and peak memory of each stage
+# as one JSON line per run so runs can be compared over time.
+#
+# With --compare-bars it also fetches the same bars through the Alpaca SDK
+# and through the raw JSON client (alpaca_bars.py) and checks they match.
+# With --telegram N it sends N signals to a fake Bot API, one call at a
+# time and through telegram.Notifier. With --shards 1 2 4 it also fetches and
+# evaluates each universe in that many processes (shards.py). With --screens N
+# it evaluates N variant screens (screens.py) in one pass and one at a time.
+#
+# Example: python benchmark.py --sizes 50 500 10000 --latency 0.02
+
+import argparse
+import contextlib
+import datetime as dt
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import fakes
+from bars import DTYPE
+
+RESULTS_FILE = "bench_results.jsonl"
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StageTimer:
+    """Times each stage and records its peak traced memory when tracemalloc is running"""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, items):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        # main() prints a line per ticker, keep that out of the timings
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+        seconds = time.perf_counter() - started
+        self.stages[name] = {
+            "seconds": round(seconds, 4),
+            "items": items,
+            "items_per_second": round(items / seconds, 1) if seconds else None,
+            "peak_mb": round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2) if tracemalloc.is_tracing() else None,
+        }
+
+
+def run_once(size, latency, workdir):
+    """Run every stage of the screener once for a synthetic universe of `size` tickers"""
+    import aatinaa
+    import main
+    import rate_limit
+    from bar_cache import BarCache
+
+    # the fakes have no quota, so time the code rather than the providers' rate limits
+    for name in rate_limit.RATES:
+        rate_limit.set_rate(name, None)
+
+    tickers = fakes.synthetic_universe(size)
+    alpaca = fakes.FakeAlpacaClient(latency=latency)
+    main._alpaca_client = alpaca
+    cache = BarCache(root=os.path.join(workdir, "bars"))
+    aatinaa.CACHE_STORE = workdir
+
+    now = dt.datetime(2025, 6, 2, 22)
+    start = now - dt.timedelta(days=400)
+    timer = StageTimer()
+
+    with timer.stage("screen", size):
+        stocks = main.screen_stocks(fakes.FakeOverview(tickers, latency=latency))
+
+    with timer.stage("fetch", size):
+        frames = main.get_cached_stock_data(tickers, start, now, cache=cache)
+
+    # the next day only one new bar per ticker is missing from the cache
+    alpaca.requests = 0
+    with timer.stage("fetch_incremental", size):
+        frames = main.get_cached_stock_data(tickers, start + dt.timedelta(days=1), now + dt.timedelta(days=1), cache=cache)
+    incremental_requests = alpaca.requests
+
+    with timer.stage("evaluate", size):
+        output = main.evaluate_stocks(stocks, frames)
+
+    candidates = int((output["cond count"] > 0).sum())
+    with fakes.FakeAatinaaServer(latency=latency) as server:
+        aatinaa.URL = server.url
+        with timer.stage("compliance", candidates):
+            output = main.add_sharia_status(output)
+            aatinaa.flush_cache()
+        compliance_requests = server.requests
+
+    spreadsheet = fakes.FakeSpreadsheet(latency=latency)
+    with timer.stage("publish", len(output)):
+        main.publish_output(spreadsheet, output)
+
+    return {
+        "size": size,
+        "latency": latency,
+        "stages": timer.stages,
+        "total_seconds": round(sum(stage["seconds"] for stage in timer.stages.values()), 4),
+        "requests": {
+            "alpaca_incremental": incremental_requests,
+            "aatinaa": compliance_requests,
+            "sheets": spreadsheet.calls,
+        },
+        "sheets_bytes": spreadsheet.bytes_sent,
+        "passed_all_6": int((output["cond count"] == 6).sum()),
+    }
+
+
+def compare_bars_clients(size, latency):
+    """Fetch the same bars through the Alpaca SDK and through alpaca_bars and check they match
+
+    Both talk HTTP to a local stand-in of the data API, so the difference is
+    the client side work of parsing and converting the bars.
+    """
+    import alpaca_bars
+    import main
+    import rate_limit
+    from alpaca.data import StockHistoricalDataClient
+
+    rate_limit.set_rate("alpaca", None)
+    tickers = fakes.synthetic_universe(size)
+    now = dt.datetime(2025, 6, 2, 22)
+    start = now - dt.timedelta(days=400)
+    timer = StageTimer()
+    fetched = {}
+
+    # put back afterwards, the stages that follow must not talk to a server that is gone
+    saved = main._alpaca_client, alpaca_bars.URL, main.ALPACA_RAW_BARS
+    try:
+        with fakes.FakeAlpacaServer(latency=latency) as server:
+            main._alpaca_client = StockHistoricalDataClient("key", "secret", url_override=server.url)
+            alpaca_bars.URL = server.url
+            for name, raw in (("sdk", False), ("raw", True)):
+                main.ALPACA_RAW_BARS = raw
+                server.requests = 0
+                with timer.stage(name, size):
+                    fetched[name] = main.get_stock_data_many(tickers, start, now)
+                timer.stages[name]["requests"] = server.requests
+    finally:
+        main._alpaca_client, alpaca_bars.URL, main.ALPACA_RAW_BARS = saved
+
+    sdk, raw = fetched["sdk"], fetched["raw"]
+    mismatched = [
+        ticker
+        for ticker in tickers
+        if (ticker in sdk) != (ticker in raw)
+        or ticker in sdk and not all(np.array_equal(sdk[ticker][field], raw[ticker][field]) for field in DTYPE.names)
+    ]
+    return {
+        "kind": "bars_clients",
+        "size": size,
+        "latency": latency,
+        "stages": timer.stages,
+        "speedup": round(timer.stages["sdk"]["seconds"] / timer.stages["raw"]["seconds"], 2),
+        "mismatched": mismatched,
+    }
+
+
+def compare_telegram(count, latency):
+    """Send `count` signals to a local Bot API one call at a time and through the notification queue
+
+    The direct sends block the caller for every message. The queue hands
+    back at once and coalesces the signals into a few messages, so both the
+    time the caller is held up and the messages Telegram gets are recorded.
+    """
+    import rate_limit
+    import telegram
+
+    os.environ.setdefault("SECRET_TELEGRAM_BOT_TOKEN", "bench-token")
+    os.environ.setdefault("SECRET_TELEGRAM_CHAT_ID", "1")
+    tickers = fakes.synthetic_universe(count)
+    signals = [(f"BUY --> {ticker} at 100.0", "BUY", ticker, 100.0) for ticker in tickers]
+    timer = StageTimer()
+    results = {}
+
+    with fakes.FakeTelegramServer(latency=latency) as server:
+        telegram.API_URL = server.url
+        # the fake has no flood control, so time the client rather than Telegram's limits
+        rate_limit.set_rate("telegram", None)
+        rate_limit.set_rate(f"telegram_chat_{os.environ['SECRET_TELEGRAM_CHAT_ID']}", None)
+
+        with timer.stage("direct", count):
+            for signal in signals:
+                telegram.tgram_send_signal(*signal)
+        results["direct"] = {"messages": len(server.messages), "connections": server.connections}
+
+        server.messages.clear()
+        server.connections = 0
+        notifier = telegram.Notifier(coalesce=0.05)
+        with timer.stage("queued", count):
+            for signal in signals:
+                notifier.signal(*signal)
+        with timer.stage("delivered", count):
+            notifier.flush()
+        results["queued"] = {"messages": len(server.messages), "connections": server.connections}
+
+    return {
+        "kind": "telegram",
+        "count": count,
+        "latency": latency,
+        "stages": timer.stages,
+        "messages": results,
+    }
+
+
+def _use_fake_alpaca(latency):
+    """Process pool initializer: point main at the fake Alpaca client with no rate limits"""
+    import main
+    import rate_limit
+
+    main._alpaca_client = fakes.FakeAlpacaClient(latency=latency)
+    rate_limit.set_rate("alpaca", None)
+
+
+def compare_shards(size, worker_counts, latency):
+    """Fetch and evaluate the universe in one process and then in shards on 1, 2, 4... processes
+
+    The bar cache is warm by the time the shards run, like it is on a daily
+    run, so the timings are of reading bars and evaluating them. Every
+    sharded output is checked against the single process one.
+    """
+    import pandas as pd
+
+    import main
+    import rate_limit
+    from bar_cache import BarCache
+    from shards import run_sharded
+
+    rate_limit.set_rate("alpaca", None)
+    main._alpaca_client = fakes.FakeAlpacaClient(latency=latency)
+    tickers = fakes.synthetic_universe(size)
+    now = dt.datetime(2025, 6, 2, 22)
+    start = now - dt.timedelta(days=400)
+    timer = StageTimer()
+    mismatched = []
+
+    workdir = tempfile.mkdtemp(prefix="screener-bench-")
+    try:
+        cache_dir = os.path.join(workdir, "bars")
+        stocks = main.screen_stocks(fakes.FakeOverview(tickers))
+        main.get_cached_stock_data(tickers, start, now, cache=BarCache(cache_dir))
+
+        with timer.stage("single", size):
+            frames = main.get_cached_stock_data(tickers, start, now, cache=BarCache(cache_dir))
+            expected = main.evaluate_stocks([dict(stock) for stock in stocks], frames)
+
+        for workers in worker_counts:
+            name = f"shards_{workers}"
+            with timer.stage(name, size):
+                output = run_sharded(
+                    [dict(stock) for stock in stocks], start, now, shards=workers, workers=workers,
+                    cache_dir=cache_dir, initializer=_use_fake_alpaca, initargs=(latency,),
+                )
+            try:
+                pd.testing.assert_frame_equal(expected, output)
+            except AssertionError:
+                mismatched.append(workers)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "kind": "shards",
+        "size": size,
+        "latency": latency,
+        "cpus": os.cpu_count(),
+        "stages": timer.stages,
+        "mismatched": mismatched,
+    }
+
+
+def variant_screens(count):
+    """The six conditions plus count - 1 variants of them with other thresholds and SMAs"""
+    from screens import MINERVINI
+
+    screens = [MINERVINI]
+    for i in range(1, count):
+        screens.append({
+            "name": f"Variant {i}",
+            "conditions": {
+                **MINERVINI["conditions"],
+                "cond 5": f"close >= {1.2 + i % 5 * 0.05:.2f} * 52 week low",
+                "cond 6": f"close >= {0.75 + i % 10 * 0.02:.2f} * 52 week high",
+                "cond 7": f"sma {10 + i % 8 * 5} > sma 50",
+            },
+        })
+    return screens
+
+
+def compare_screens(size, count):
+    """Evaluate `count` screens on one universe compiled together and then one at a time, and check they match
+
+    The first screen is the six conditions, which also have to match evaluate_frames.
+    """
+    import pandas as pd
+
+    import main
+    import rate_limit
+    from bar_cache import BarCache
+    from conditions import evaluate_frames
+    from screens import compile_screens
+
+    rate_limit.set_rate("alpaca", None)
+    main._alpaca_client = fakes.FakeAlpacaClient()
+    tickers = fakes.synthetic_universe(size)
+    now = dt.datetime(2025, 6, 2, 22)
+    screens = variant_screens(count)
+    timer = StageTimer()
+
+    workdir = tempfile.mkdtemp(prefix="screener-bench-")
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            frames = main.get_cached_stock_data(tickers, now - dt.timedelta(days=400), now, cache=BarCache(workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with timer.stage("one_pass", size):
+        compiled = compile_screens(screens)
+        together = compiled.evaluate(frames)
+    with timer.stage("one_at_a_time", size):
+        separate = {}
+        for screen in screens:
+            separate.update(compile_screens([screen]).evaluate(frames))
+
+    mismatched = []
+    for screen in screens:
+        try:
+            pd.testing.assert_frame_equal(together[screen["name"]], separate[screen["name"]])
+        except AssertionError:
+            mismatched.append(screen["name"])
+    try:
+        pd.testing.assert_frame_equal(evaluate_frames(frames), together[screens[0]["name"]])
+    except AssertionError:
+        mismatched.append("evaluate_frames")
+
+    return {
+        "kind": "screens",
+        "size": size,
+        "screens": count,
+        "indicators": len(compiled.indicators),
+        "comparisons": len(compiled.comparisons),
+        "stages": timer.stages,
+        "mismatched": mismatched,
+    }
+
+
+def run(sizes, latency, output_file=RESULTS_FILE, track_memory=True, compare_bars=False, telegram_signals=0,
+        shard_workers=(), screens=0):
+    """Benchmark every universe size and append the results to output_file
+
+    tracemalloc slows Python code down a lot, turn track_memory off for timings
+    that are closer to a real run.
+    """
+    header = {
+        "time": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "track_memory": track_memory,
+    }
+
+    results = []
+    if track_memory:
+        tracemalloc.start()
+    try:
+        for size in sizes:
+            workdir = tempfile.mkdtemp(prefix="screener-bench-")
+            try:
+                result = {**header, **run_once(size, latency, workdir)}
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            results.append(result)
+
+            stages = ", ".join(f"{name} {stage['seconds']:.3f}s" for name, stage in result["stages"].items())
+            print(f"{size} tickers: {stages}")
+
+            if compare_bars:
+                result = {**header, **compare_bars_clients(size, latency)}
+                results.append(result)
+                print(
+                    f"{size} tickers, bars clients: sdk {result['stages']['sdk']['seconds']:.3f}s, "
+                    f"raw {result['stages']['raw']['seconds']:.3f}s ({result['speedup']}x), "
+                    f"{len(result['mismatched'])} mismatched"
+                )
+
+            if shard_workers:
+                result = {**header, **compare_shards(size, shard_workers, latency)}
+                results.append(result)
+                stages = ", ".join(f"{name} {stage['seconds']:.3f}s" for name, stage in result["stages"].items())
+                print(f"{size} tickers on {result['cpus']} cpus: {stages}, {len(result['mismatched'])} mismatched")
+
+            if screens:
+                result = {**header, **compare_screens(size, screens)}
+                results.append(result)
+                stages = result["stages"]
+                print(
+                    f"{size} tickers, {screens} screens ({result['indicators']} indicators, "
+                    f"{result['comparisons']} comparisons): one pass {stages['one_pass']['seconds']:.3f}s, "
+                    f"one at a time {stages['one_at_a_time']['seconds']:.3f}s, {len(result['mismatched'])} mismatched"
+                )
+
+        if telegram_signals:
+            result = {**header, **compare_telegram(telegram_signals, latency)}
+            results.append(result)
+            stages = result["stages"]
+            print(
+                f"{telegram_signals} signals: direct {stages['direct']['seconds']:.3f}s "
+                f"({result['messages']['direct']['messages']} messages), "
+                f"queued {stages['queued']['seconds']:.3f}s + {stages['delivered']['seconds']:.3f}s delivery "
+                f"({result['messages']['queued']['messages']} messages)"
+            )
+    finally:
+        tracemalloc.stop()
+
+    with open(output_file, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the screener offline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 500, 2000])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake service call")
+    parser.add_argument("--output", default=RESULTS_FILE)
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc for more realistic timings")
+    parser.add_argument("--compare-bars", action="store_true", help="also time the Alpaca SDK against alpaca_bars")
+    parser.add_argument("--telegram", type=int, default=0, help="also time sending this many signals to a fake Bot API")
+    parser.add_argument("--shards", type=int, nargs="+", default=[], help="also time sharded runs on these process counts")
+    parser.add_argument("--screens", type=int, default=0, help="also evaluate this many variant screens in one pass")
+    args = parser.parse_args()
+
+    run(
+        args.sizes,
+        args.latency,
+        args.output,
+        track_memory=not args.no_memory,
+        compare_bars=args.compare_bars,
+        telegram_signals=args.telegram,
+        shard_workers=args.shards,
+        screens=args.screens,
+    )
@@ -1,73 +1,220 @@
 import urllib.parse
 import hashlib
 import hmac
+import os
 import requests
+import threading
 import time
-import json
-from google.cloud import secretmanager
-import os
+from concurrent.futures import ThreadPoolExecutor
+import rate_limit
+from secret_store import get_secrets
+from telemetry import current
+
+api_url = os.getenv("BINANCE_API_URL", "https://api.binance.us")
+
+# Request weight of the endpoints we call, anything else weighs 1
+WEIGHTS = {
+    "/api/v3/account": 10,
+    "/api/v3/openOrders": 3,
+    "/sapi/v1/capital/config/getall": 10,
+}
+
+# How long a signed request is valid for after its timestamp, in milliseconds
+RECV_WINDOW = 5000
+
+# The offset to Binance's clock is measured again after this many seconds
+TIME_REFRESH_SECONDS = 10 * 60
+
+# Read only queries that are answered from memory for this many seconds,
+# so checking the balance over and over doesn't use up request weight
+CACHE_SECONDS = {
+    "/sapi/v1/capital/config/getall": 10,
+}
+
+# Timestamp for this request is outside of the recvWindow (or ahead of the server)
+TIMESTAMP_ERROR = -1021
+
+MAX_WORKERS = 8
+
+
+def request_weight(request):
+    return WEIGHTS.get(urllib.parse.urlsplit(request.url).path, 1)
+
+
+# Pooled session paced by the shared Binance limiter, which counts request weight
+session = rate_limit.install(requests.Session(), "binance", cost=request_weight, pool_maxsize=MAX_WORKERS)
+
+
+# Get Binance credentials from Secret Manager when they are needed
+def get_credentials():
+    try:
+        secrets = get_secrets(["binance_api_key", "binance_secret_key"])
+        return secrets["binance_api_key"], secrets["binance_secret_key"]
+    except Exception as e:
+        print(f"Error getting Binance credentials: {str(e)}")
+        return None, None
 
-api_url = "https://api.binance.us"
 
-# Get the project ID from environment variable
-PROJECT_ID = os.getenv("MY_PROJECT_ID")
+class BinanceClient:
+    """Signed Binance.US requests over the pooled session, safe to share between threads
 
+    The HMAC key is prepared once, timestamps follow Binance's clock rather
+    than ours, and the queries in CACHE_SECONDS are answered from memory
+    while they are fresh.
+    """
 
-def get_secret(secret_name: str):
-    """Get secret from Google Cloud Secret Manager"""
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{PROJECT_ID}/secrets/{secret_name}/versions/latest"
-    response = client.access_secret_version(name=name)
-    return response.payload.data.decode("UTF-8")
+    def __init__(self, api_key, api_sec, base_url=None, recv_window=RECV_WINDOW):
+        self.api_key = api_key
+        self.api_sec = api_sec
+        self.base_url = base_url or api_url
+        self.recv_window = recv_window
+        # copying a keyed HMAC is cheaper than keying a new one for every request
+        self._mac = hmac.new(api_sec.encode(), digestmod=hashlib.sha256)
+        self._offset = 0  # Binance's clock minus ours, in milliseconds
+        self._offset_time = None
+        self._time_lock = threading.Lock()
+        self._cache = {}
+        self._cache_lock = threading.Lock()
 
+    def sign(self, params):
+        mac = self._mac.copy()
+        mac.update(urllib.parse.urlencode(params).encode())
+        return mac.hexdigest()
 
-# Get Binance credentials from Secret Manager
-try:
-    api_key = get_secret("binance_api_key")
-    secret_key = get_secret("binance_secret_key")
-except Exception as e:
-    print(f"Error getting Binance credentials: {str(e)}")
-    api_key = None
-    secret_key = None
+    def _measure_offset(self):
+        # assume the server read its clock halfway through the request
+        sent = time.time()
+        response = session.get(f"{self.base_url}/api/v3/time")
+        received = time.time()
+        response.raise_for_status()
+        self._offset = response.json()["serverTime"] - int((sent + received) / 2 * 1000)
+        self._offset_time = received
+        current().count("binance.time_syncs")
 
+    def sync_time(self):
+        """Measure the offset to Binance's clock again, returns it in milliseconds"""
+        with self._time_lock:
+            self._measure_offset()
+            return self._offset
 
-# get binanceus signature
-def get_binanceus_signature(data, secret):
-    postdata = urllib.parse.urlencode(data)
-    message = postdata.encode()
-    byte_key = bytes(secret, "UTF-8")
-    mac = hmac.new(byte_key, message, hashlib.sha256).hexdigest()
-    return mac
+    def timestamp(self):
+        """Now on Binance's clock in milliseconds, measuring the offset first if it is stale"""
+        # threads arriving while it is measured wait for it rather than all asking Binance
+        with self._time_lock:
+            if self._offset_time is None or time.time() - self._offset_time > TIME_REFRESH_SECONDS:
+                self._measure_offset()
+            offset = self._offset
+        return int(time.time() * 1000) + offset
 
+    def signed(self, uri_path, params=None, method="GET"):
+        """Make a signed request and return the decoded JSON, Binance's error object included
 
-# Attaches auth headers and returns results of a POST request
+        A request rejected for its timestamp is made again once after the
+        clock offset is measured again.
+        """
+        cache_seconds = CACHE_SECONDS.get(uri_path) if method == "GET" else None
+        key = (uri_path, tuple(sorted((params or {}).items())))
+        if cache_seconds:
+            with self._cache_lock:
+                cached = self._cache.get(key)
+            if cached and time.monotonic() - cached[0] < cache_seconds:
+                current().count("binance.cache_hits")
+                return cached[1]
+
+        for attempt in range(2):
+            query = {**(params or {}), "recvWindow": self.recv_window, "timestamp": self.timestamp()}
+            query["signature"] = self.sign(query)
+            current().count("binance.requests")
+            response = session.request(
+                method, self.base_url + uri_path, params=query, headers={"X-MBX-APIKEY": self.api_key}
+            )
+            try:
+                result = response.json()
+            except ValueError:
+                # not an answer from the API itself, like a gateway error page
+                response.raise_for_status()
+                raise
+            if attempt == 0 and isinstance(result, dict) and result.get("code") == TIMESTAMP_ERROR:
+                current().event("binance_clock_resync", path=uri_path)
+                self.sync_time()
+                continue
+            break
+
+        if cache_seconds and response.ok:
+            with self._cache_lock:
+                self._cache[key] = (time.monotonic(), result)
+        return result
+
+    def signed_many(self, calls, max_workers=MAX_WORKERS):
+        """Make several signed requests at once, calls is a list of (uri_path, params), results come back in order"""
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda call: self.signed(*call), calls))
+
+    def capital_config(self):
+        """Every coin with its free and locked balance, cached for a few seconds"""
+        return self.signed("/sapi/v1/capital/config/getall")
+
+    def free_balance(self, coin):
+        """The free balance of a coin as Binance reports it (a string), None if it isn't there"""
+        coins = self.capital_config()
+        if not isinstance(coins, list):
+            print(f"Error getting the Binance balances: {coins}")
+            return None
+        for item in coins:
+            if item["coin"] == coin:
+                return item["free"]
+        return None
+
+
+_client = None
+_client_lock = threading.Lock()
+_signer = None  # the last client binanceus_request signed with, so it keeps the prepared HMAC key
+
+
+# The shared client for the credentials in Secret Manager, None if they aren't available
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            api_key, secret_key = get_credentials()
+            if not api_key or not secret_key:
+                print("Binance credentials not available")
+                return None
+            _client = BinanceClient(api_key, secret_key)
+        return _client
+
+
+# Attaches auth headers and returns results of a GET request, data has to carry its own timestamp
 def binanceus_request(uri_path, data, api_key, api_sec):
+    global _signer
     if not api_key or not api_sec:
         print("Binance credentials not available")
         return None
 
+    with _client_lock:
+        # one set of credentials is in use at a time, a new one replaces the client
+        if _signer is None or _signer.api_key != api_key or _signer.api_sec != api_sec:
+            _signer = BinanceClient(api_key, api_sec)
+        client = _signer
+
     headers = {}
     headers["X-MBX-APIKEY"] = api_key
-    signature = get_binanceus_signature(data, api_sec)
+    signature = client.sign(data)
     params = {
         **data,
         "signature": signature,
     }
-    req = requests.get((api_url + uri_path), params=params, headers=headers)
+    req = session.get((api_url + uri_path), params=params, headers=headers)
     return req.text
 
 
 # Example usage
 if __name__ == "__main__":
-    uri_path = "/sapi/v1/capital/config/getall"
-    data = {"timestamp": int(round(time.time() * 1000))}
-
-    result = binanceus_request(uri_path, data, api_key, secret_key)
-    if result:
-        result = json.loads(result)
-
-        # loop through result looking for USDT collateral
-        for item in result:
-            if item["coin"] == "USDT":
-                print(item["free"])
-                break
+    client = get_client()
+    if client:
+        print(client.free_balance("USDT"))
+
+    # or signing by hand with the local clock
+    # uri_path = "/sapi/v1/capital/config/getall"
+    # data = {"timestamp": int(round(time.time() * 1000))}
+    # print(binanceus_request(uri_path, data, *get_credentials()))
@@ -0,0 +1,117 @@
+# Description: Checkpoints for resuming a screener run
+# A run that times out or crashes leaves behind what it finished: the
+# screened universe, the condition results of every chunk of tickers it
+# evaluated and the sharia statuses it looked up. When the scheduler retries,
+# the run picks up from there instead of scraping FinViz again. Checkpoints
+# are keyed by the run date and cleared once the sheet is published.
+#
+# They live on local disk by default. Cloud Functions only keep /tmp for the
+# life of an instance and a retry can land on another one, so there
+# CHECKPOINT_STORE should point at a bucket: gs://bucket/prefix
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from storage import open_store
+from telemetry import current
+
+CHECKPOINT_STORE = os.getenv("CHECKPOINT_STORE", os.path.join(tempfile.gettempdir(), "screener_checkpoints"))
+
+
+def _json_default(value):
+    # numpy numbers from the condition results
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class Checkpoint:
+    """What one run has finished so far, stage by stage
+
+    A stage is either saved whole (the universe) or added to a part at a
+    time (evaluated chunks, compliance batches) so saving stays cheap however
+    far the run got.
+    """
+
+    def __init__(self, run_key, store):
+        self.run_key = run_key
+        self.store = store
+        self._parts = 0
+        self._lock = threading.Lock()
+
+    def _key(self, stage):
+        return f"{self.run_key}/{stage}"
+
+    def load(self, stage):
+        data = self.store.read(f"{self._key(stage)}.json")
+        return None if data is None else json.loads(data)
+
+    def save(self, stage, value):
+        self.store.write(f"{self._key(stage)}.json", json.dumps(value, default=_json_default).encode())
+
+    def add(self, stage, value):
+        """Save one more part of a stage"""
+        with self._lock:
+            self._parts += 1
+            # time first so parts from a retried run sort after the ones before it
+            name = f"{time.time_ns():020d}-{os.getpid()}-{self._parts}"
+        self.store.write(f"{self._key(stage)}/{name}.json", json.dumps(value, default=_json_default).encode())
+        current().count(f"checkpoint.{stage}_parts")
+
+    def parts(self, stage):
+        return [json.loads(self.store.read(key)) for key in self.store.list(self._key(stage))]
+
+    def add_evaluated(self, tickers, conditions):
+        """Record a chunk of tickers as done, conditions holds the results of the ones that had bars"""
+        self.add("evaluated", {"tickers": list(tickers), "conditions": conditions})
+
+    def evaluated(self):
+        """Every ticker done so far -> its conditions, None for tickers that had no bars"""
+        done = {}
+        for part in self.parts("evaluated"):
+            done.update(dict.fromkeys(part["tickers"]))
+            done.update(part["conditions"])
+        return done
+
+    def add_statuses(self, statuses):
+        # UNKNOWN means the lookup failed, leave it to be looked up again
+        statuses = {ticker: status for ticker, status in statuses.items() if status != "UNKNOWN"}
+        if statuses:
+            self.add("compliance", statuses)
+
+    def statuses(self):
+        statuses = {}
+        for part in self.parts("compliance"):
+            statuses.update(part)
+        return statuses
+
+    def clear(self):
+        self.store.delete(self.run_key)
+
+
+def resume(checkpoint, tickers):
+    """Split tickers into what a run that stopped part way already evaluated and what is left
+
+    Returns the conditions of every done ticker that had bars and the tickers
+    still to evaluate, in their order. Without a checkpoint nothing is done.
+    """
+    if checkpoint is None:
+        return {}, list(tickers)
+    evaluated = checkpoint.evaluated()
+    done = {ticker: evaluated[ticker] for ticker in tickers if evaluated.get(ticker) is not None}
+    todo = [ticker for ticker in tickers if ticker not in evaluated]
+    current().count("checkpoint.resumed_tickers", len(tickers) - len(todo))
+    return done, todo
+
+
+def open_checkpoint(run_date, location=CHECKPOINT_STORE):
+    """The checkpoint of the run for run_date, checkpoints of other days are removed"""
+    store = open_store(location)
+    run_key = f"{run_date:%Y-%m-%d}"
+    for run in store.runs():
+        if run != run_key:
+            store.delete(run)
+    return Checkpoint(run_key, store)
@@ -0,0 +1,195 @@
+# Description: Minervini template conditions for many tickers at once
+# Every ticker's closes go into one NumPy matrix and the six conditions are
+# worked out with a handful of array operations instead of a pandas loop.
+
+import numpy as np
+import pandas as pd
+
+# A year's worth of trading days, the longest window any condition looks at
+LOOKBACK = 255
+
+# (trading days back, weight) of the 3, 6, 9 and 12 month returns in the RS rating, the last quarter counts double
+RS_PERIODS = ((63, 0.4), (126, 0.2), (189, 0.2), (252, 0.2))
+
+CONDITION_COLUMNS = [
+    "cond count",
+    "cond 1",
+    "cond 2",
+    "cond 3",
+    "cond 4",
+    "cond 5",
+    "cond 6",
+]
+
+
+def build_close_panel(frames, close="Close", depth=LOOKBACK):
+    """Stack the last `depth` closes of every ticker into a ticker x day matrix
+
+    Each row is aligned on that ticker's most recent bar (the last column),
+    and tickers with a shorter history are padded with NaN on the left.
+    Returns the list of tickers and the matrix.
+    """
+    tickers = list(frames)
+    panel = np.full((len(tickers), depth), np.nan)
+
+    for row, ticker in enumerate(tickers):
+        closes = np.asarray(frames[ticker][close], dtype=float)[-depth:]
+        if len(closes):
+            panel[row, -len(closes):] = closes
+
+    return tickers, panel
+
+
+def _window_mean(panel, start, stop=None):
+    """Mean of each row over the columns [start:stop] ignoring missing values"""
+    window = panel[:, start:stop]
+    valid = ~np.isnan(window)
+    count = valid.sum(axis=1)
+    total = np.where(valid, window, 0.0).sum(axis=1)
+    # rows with no history in the window get NaN so every comparison is False
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def compute_indicators(panel):
+    """Get the current close, SMAs and 52 week extremes for every row of the panel"""
+    valid = ~np.isnan(panel)
+    has_data = valid.any(axis=1)
+
+    # the most recent close is the last column since rows are right aligned
+    current_close = panel[:, -1]
+
+    # Get SMA for 50, 150, 200 and round to 2 decimals
+    sma_50 = np.round(_window_mean(panel, -50), 2)
+    sma_150 = np.round(_window_mean(panel, -150), 2)
+    sma_200 = np.round(_window_mean(panel, -200), 2)
+
+    # Get the SMA_200 20 trading days ago to check if it's been trending up since
+    sma_200_20 = np.round(_window_mean(panel, -221, -21), 2)
+
+    # Go back a year's worth of trading days and get the min/max
+    window = panel[:, -LOOKBACK:]
+    window_valid = valid[:, -LOOKBACK:]
+    low_52 = np.where(window_valid, window, np.inf).min(axis=1)
+    high_52 = np.where(window_valid, window, -np.inf).max(axis=1)
+    low_52 = np.round(np.where(has_data, low_52, np.nan), 2)
+    high_52 = np.round(np.where(has_data, high_52, np.nan), 2)
+
+    return {
+        "close": current_close,
+        "sma 50": sma_50,
+        "sma 150": sma_150,
+        "sma 200": sma_200,
+        "sma 200 20": sma_200_20,
+        "52 week low": low_52,
+        "52 week high": high_52,
+    }
+
+
+def compute_conditions(indicators):
+    """Turn the indicator arrays into the six condition flags and their count"""
+    close = indicators["close"]
+    sma_50 = indicators["sma 50"]
+    sma_150 = indicators["sma 150"]
+    sma_200 = indicators["sma 200"]
+
+    with np.errstate(invalid="ignore"):
+        conditions = np.stack(
+            [
+                # Condition 1: Current Price > 150 SMA and > 200 SMA
+                (close > sma_150) & (sma_150 > sma_200),
+                # Condition 2: 200 SMA trending up for at least 1 month
+                sma_200 > indicators["sma 200 20"],
+                # Condition 3: 50 SMA > 150 SMA and 50 SMA > 200 SMA
+                (sma_50 > sma_150) & (sma_150 > sma_200),
+                # Condition 4: Current Price > 50 SMA
+                close > sma_50,
+                # Condition 5: Current Price is at least 30% above 52 week low
+                close >= 1.3 * indicators["52 week low"],
+                # Condition 6: Current Price is within 25% of 52 week high
+                close >= 0.75 * indicators["52 week high"],
+            ],
+            axis=1,
+        )
+
+    return conditions, conditions.sum(axis=1)
+
+
+def evaluate_frames(frames, close="Close"):
+    """Evaluate all six conditions for a dict of ticker -> bars DataFrame
+
+    Returns a DataFrame indexed by ticker with the "cond count" and
+    "cond 1" ... "cond 6" columns that main() adds to each stock.
+    """
+    tickers, panel = build_close_panel(frames, close)
+    conditions, count = compute_conditions(compute_indicators(panel))
+
+    result = pd.DataFrame(conditions, index=tickers, columns=CONDITION_COLUMNS[1:])
+    result.insert(0, "cond count", count.astype(int))
+    return result
+
+
+def prescreen_frames(frames, close="Close"):
+    """Get the tickers that pass FinViz's technical filters, worked out from their bars
+
+    Those are: price above the 200 SMA, price above the 50 SMA and price
+    30% or more above the 52 week low.
+    """
+    tickers, panel = build_close_panel(frames, close)
+    indicators = compute_indicators(panel)
+    current_close = indicators["close"]
+
+    with np.errstate(invalid="ignore"):
+        passed = (
+            (current_close > indicators["sma 200"])
+            & (current_close > indicators["sma 50"])
+            & (current_close >= 1.3 * indicators["52 week low"])
+        )
+    return [ticker for ticker, ok in zip(tickers, passed) if ok]
+
+
+def relative_strength(panel):
+    """Weighted 3/6/9/12 month return of every row of the panel
+
+    A ticker with less than a year of history is scored on the periods it
+    has, with their weights scaled up to add to 1. Without 3 months it gets NaN.
+    """
+    current_close = panel[:, -1]
+    total = np.zeros(len(panel))
+    weights = np.zeros(len(panel))
+    for days, weight in RS_PERIODS:
+        if days >= panel.shape[1]:
+            continue
+        with np.errstate(invalid="ignore", divide="ignore"):
+            returns = current_close / panel[:, -1 - days] - 1
+        valid = np.isfinite(returns)
+        total += np.where(valid, returns * weight, 0.0)
+        weights += np.where(valid, weight, 0.0)
+
+    shortest = np.isfinite(current_close / panel[:, -1 - RS_PERIODS[0][0]])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(shortest & (weights > 0), total / weights, np.nan)
+
+
+def percentile_ratings(values):
+    """Rank values from 1 to 99 by the share of the others that are lower, NaN stays NaN
+
+    Equal values get the same rating.
+    """
+    ratings = np.full(len(values), np.nan)
+    valid = ~np.isnan(values)
+    ranked = np.sort(values[valid])
+    if len(ranked):
+        lower = np.searchsorted(ranked, values[valid], side="left")
+        ratings[valid] = np.floor(lower / len(ranked) * 99) + 1
+    return ratings
+
+
+def rs_ratings(frames, close="Close"):
+    """Get the RS rating (1-99) of every ticker against all the others in frames, as a Series indexed by ticker
+
+    The weighted returns of the whole universe are worked out and ranked in
+    one pass over the close panel, so the ratings are only as wide as frames.
+    """
+    tickers, panel = build_close_panel(frames, close, RS_PERIODS[-1][0] + 1)
+    return pd.Series(percentile_ratings(relative_strength(panel)), index=tickers, name="RS")
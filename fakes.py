@@ -0,0 +1,509 @@
+# Description: Local stand-ins for the external services
+# Synthetic FinViz, Alpaca, Aatinaa, Telegram, Binance and Google Sheets so
+# the screener can be run and timed offline. Everything is generated from a
+# seed so two runs with the same settings see the same data.
+
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import socket
+import string
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+
+def synthetic_universe(size):
+    """Get `size` unique ticker symbols (AA, AB, ... then AAA, AAB, ...)"""
+    tickers = []
+    for length in itertools.count(2):
+        for letters in itertools.product(string.ascii_uppercase, repeat=length):
+            tickers.append("".join(letters))
+            if len(tickers) == size:
+                return tickers
+
+
+def _seed(ticker):
+    return int(hashlib.md5(ticker.encode()).hexdigest()[:8], 16)
+
+
+def _trading_days(start, end):
+    """Weekdays from start to end, stamped at 05:00 UTC like Alpaca daily bars"""
+    start = pd.Timestamp(start).tz_localize(None).normalize()
+    end = pd.Timestamp(end).tz_localize(None).normalize()
+    return pd.bdate_range(start, end).tz_localize("UTC") + pd.Timedelta(hours=5)
+
+
+def synthetic_closes(ticker, days):
+    """A random walk of closes for a ticker over the given days, the same on every call"""
+    # anchor the walk on a fixed date so overlapping ranges give the same prices
+    anchor = pd.Timestamp("2000-01-03", tz="UTC")
+    offsets = ((days - anchor).days).to_numpy()
+    rng = np.random.default_rng(_seed(ticker))
+    drift = rng.normal(0.0006, 0.0004)
+    start_price = rng.uniform(10, 400)
+    # a smooth trend plus a daily wiggle that only depends on the date
+    wiggle = np.sin(offsets * (0.05 + (_seed(ticker) % 97) / 1000)) * 0.03
+    return np.round(start_price * np.exp(drift * (offsets % 2000) + wiggle), 4)
+
+
+def synthetic_minute_bars(tickers, day, opens, minutes=390):
+    """A session of minute bars for the intraday screen, as (symbol, timestamp, close) ordered by time
+
+    Each ticker wanders away from its open (usually its last daily close) by a
+    few percent over the day, enough for some of them to cross into 6/6.
+    """
+    session_open = pd.Timestamp(day).tz_localize(None).normalize() + pd.Timedelta(hours=13, minutes=30)
+    times = [f"{t:%Y-%m-%dT%H:%M:%S}Z" for t in pd.date_range(session_open, periods=minutes, freq="min")]
+
+    walks = {}
+    for ticker in tickers:
+        rng = np.random.default_rng(_seed(ticker) + session_open.dayofyear)
+        steps = rng.normal(rng.normal(0, 0.0002), 0.0015, minutes)
+        walks[ticker] = np.round(opens[ticker] * np.exp(np.cumsum(steps)), 4)
+
+    return [(ticker, t, float(walks[ticker][i])) for i, t in enumerate(times) for ticker in tickers]
+
+
+class FakeOverview:
+    """Stands in for finvizfinance's Overview screener"""
+
+    def __init__(self, tickers, latency=0.0):
+        self.tickers = tickers
+        self.latency = latency
+
+    def set_filter(self, filters_dict=None):
+        self.filters = filters_dict
+
+    def screener_view(self):
+        time.sleep(self.latency)
+        rng = np.random.default_rng(len(self.tickers))
+        n = len(self.tickers)
+        return pd.DataFrame(
+            {
+                "Ticker": self.tickers,
+                "Company": [f"{ticker} Inc" for ticker in self.tickers],
+                "Sector": "Technology",
+                "Industry": "Software",
+                "Country": "USA",
+                "Market Cap": rng.uniform(2e9, 5e11, n),
+                "P/E": rng.uniform(5, 80, n),
+                "Price": rng.uniform(10, 400, n),
+                "Change": rng.normal(0, 0.02, n),
+                "Volume": rng.integers(1_000_000, 50_000_000, n).astype(float),
+            }
+        )
+
+
+class FakeAlpacaClient:
+    """Stands in for StockHistoricalDataClient, returns daily bars shaped like the SDK's
+
+    splits maps a ticker to (ex date, ratio). Its bars before the ex date are
+    priced ratio times higher, the way raw bars look around a forward split.
+    """
+
+    def __init__(self, latency=0.0, missing=(), splits=None):
+        self.latency = latency
+        self.missing = set(missing)
+        self.splits = splits or {}
+        self.requests = 0
+        self.bars_sent = 0
+
+    def get_stock_bars(self, request):
+        time.sleep(self.latency)
+        self.requests += 1
+        symbols = request.symbol_or_symbols
+        symbols = [symbols] if isinstance(symbols, str) else symbols
+
+        days = _trading_days(request.start, request.end)
+        data = {}
+        for symbol in symbols:
+            if symbol in self.missing or not len(days):
+                continue
+            closes = synthetic_closes(symbol, days)
+            if symbol in self.splits:
+                ex_date, ratio = self.splits[symbol]
+                closes = np.where(days < pd.Timestamp(ex_date, tz="UTC"), closes * ratio, closes)
+            data[symbol] = [
+                SimpleNamespace(
+                    timestamp=day.to_pydatetime(),
+                    open=close,
+                    high=close * 1.01,
+                    low=close * 0.99,
+                    close=close,
+                    volume=1_000_000.0,
+                )
+                for day, close in zip(days, closes)
+            ]
+            self.bars_sent += len(days)
+        return SimpleNamespace(data=data)
+
+
+class FakeCorporateActionsClient:
+    """Stands in for CorporateActionsClient(raw_data=True), answers with the forward splits given as ticker -> (ex date, ratio)"""
+
+    def __init__(self, splits=None):
+        self.splits = splits or {}
+        self.requests = 0
+
+    def get_corporate_actions(self, request):
+        self.requests += 1
+        splits = [
+            {"symbol": symbol, "new_rate": ratio, "old_rate": 1.0, "ex_date": str(ex_date)}
+            for symbol, (ex_date, ratio) in self.splits.items()
+            if symbol in request.symbols and request.start <= ex_date <= request.end
+        ]
+        return {"forward_splits": splits} if splits else {}
+
+
+class FakeAlpacaServer:
+    """A local Alpaca data API answering GET /v2/stocks/bars like the real one
+
+    Pages hold at most `limit` bars across all symbols (and never more than
+    page_limit), with a next_page_token until the last page, and are gzip'd
+    when asked. Point StockHistoricalDataClient(url_override=...) or
+    alpaca_bars.URL at .url. Use as a context manager.
+    """
+
+    def __init__(self, latency=0.0, page_limit=10_000, missing=()):
+        self.latency = latency
+        self.page_limit = page_limit
+        self.missing = set(missing)
+        self.requests = 0
+        self.bytes_sent = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                time.sleep(server.latency)
+                server.requests += 1
+
+                payload = json.dumps(server.page(query)).encode()
+                headers = {"Content-Type": "application/json"}
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    payload = gzip.compress(payload, compresslevel=1)
+                    headers["Content-Encoding"] = "gzip"
+                server.bytes_sent += len(payload)
+
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def page(self, query):
+        symbols = sorted(set(query["symbols"].split(",")) - self.missing)
+        days = _trading_days(query["start"], query["end"])
+        times = [day.strftime("%Y-%m-%dT%H:%M:%SZ") for day in days]
+
+        # the page token is just how many bars were already sent
+        offset = int(query.get("page_token") or 0)
+        limit = min(int(query.get("limit") or self.page_limit), self.page_limit)
+        first, last = offset, offset + limit
+
+        bars = {}
+        position = 0
+        for symbol in symbols:
+            if position >= last:
+                break
+            if position + len(days) > first:
+                closes = synthetic_closes(symbol, days)
+                lo, hi = max(first - position, 0), min(last - position, len(days))
+                bars[symbol] = [
+                    {"t": times[i], "o": closes[i], "h": closes[i] * 1.01, "l": closes[i] * 0.99, "c": closes[i],
+                     "v": 1_000_000, "n": 1000, "vw": closes[i]}
+                    for i in range(lo, hi)
+                ]
+            position += len(days)
+
+        total = len(symbols) * len(days)
+        return {"bars": bars, "next_page_token": str(last) if last < total else None}
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def sharia_fields(ticker):
+    """The statuses the fake Aatinaa API reports for a ticker"""
+    roll = _seed(ticker) % 3
+    return {
+        "ticker": ticker,
+        "interestBearingDebtStatus": "PASSED",
+        "interestBearingSecuritiesStatus": "PASSED" if roll else "FAILED",
+        "interestVsRevenueStatus": "PASSED",
+        "shariaCompliantStatus": "PASSED" if roll == 2 else "FAILED",
+    }
+
+
+class FakeAatinaaServer:
+    """A local GraphQL server answering getStockDetail, aliased or not
+
+    Use as a context manager and point aatinaa.URL at .url. With errors it
+    answers like GraphQL does when a query fails: {"data": null, "errors": [...]}.
+    """
+
+    def __init__(self, latency=0.0, errors=False):
+        self.latency = latency
+        self.errors = errors
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                time.sleep(server.latency)
+                server.requests += 1
+                variables = body.get("variables", {})
+                if "ticker" in variables:
+                    data = {"getStockDetail": sharia_fields(variables["ticker"])}
+                else:
+                    data = {alias: sharia_fields(ticker) for alias, ticker in variables.items()}
+                if server.errors:
+                    payload = json.dumps({"data": None, "errors": [{"message": "Internal server error"}]}).encode()
+                else:
+                    payload = json.dumps({"data": data}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/graphql"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeTelegramServer:
+    """A local Bot API answering sendMessage over GET or POST, with Telegram's flood control
+
+    Use as a context manager and point telegram.API_URL at .url. Every
+    message is kept in .messages. A chat that gets more than per_second
+    messages within a second is answered with a 429 and retry_after.
+    """
+
+    def __init__(self, latency=0.0, per_second=None, retry_after=1):
+        self.latency = latency
+        self.per_second = per_second
+        self.retry_after = retry_after
+        self.requests = 0
+        self.connections = 0
+        self.rejected = 0
+        self.messages = []
+        self._sent = {}  # chat id -> times of its recent messages
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so a client reusing its connection can be told apart
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # headers and body are written separately, don't let Nagle hold the body back
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                server.connections += 1
+
+            def do_GET(self):
+                query = urllib.parse.urlsplit(self.path).query
+                self.answer(dict(urllib.parse.parse_qsl(query)))
+
+            def do_POST(self):
+                self.answer(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+
+            def answer(self, message):
+                time.sleep(server.latency)
+                status, body = server.accept(self.path.split("?")[0], message)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def accept(self, path, message):
+        with self._lock:
+            self.requests += 1
+            if not path.endswith("/sendMessage"):
+                return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+
+            chat = str(message.get("chat_id"))
+            now = time.monotonic()
+            recent = [t for t in self._sent.get(chat, []) if now - t < 1]
+            if self.per_second is not None and len(recent) >= self.per_second:
+                self.rejected += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+
+            self._sent[chat] = recent + [now]
+            self.messages.append(message)
+            return 200, {"ok": True, "result": {"message_id": len(self.messages), "text": message.get("text")}}
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeBinanceServer:
+    """A local Binance.US API with a clock `skew` seconds off ours, checking signatures and timestamps
+
+    Answers /api/v3/time and /sapi/v1/capital/config/getall. A signed request
+    with a bad signature or a timestamp outside its recvWindow on the
+    server's clock gets Binance's error object. Use as a context manager and
+    pass .url to binance.BinanceClient.
+    """
+
+    def __init__(self, secret, skew=0.0, latency=0.0):
+        self.secret = secret.encode()
+        self.skew = skew
+        self.latency = latency
+        self.requests = {}  # path -> count
+        self.weight = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                time.sleep(server.latency)
+                status, body = server.answer(url.path, url.query)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.send_header("X-MBX-USED-WEIGHT-1M", str(server.weight))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def server_time(self):
+        return int((time.time() + self.skew) * 1000)
+
+    def answer(self, path, query):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+        if path == "/api/v3/time":
+            return 200, {"serverTime": self.server_time()}
+        if path != "/sapi/v1/capital/config/getall":
+            return 404, {"code": -1100, "msg": "Unknown path"}
+
+        with self._lock:
+            self.weight += 10
+        # the signature covers the query string as sent, up to the signature itself
+        unsigned, _, signature = query.rpartition("&signature=")
+        if not hmac.compare_digest(hmac.new(self.secret, unsigned.encode(), hashlib.sha256).hexdigest(), signature):
+            return 400, {"code": -1022, "msg": "Signature for this request is not valid."}
+
+        params = dict(urllib.parse.parse_qsl(unsigned))
+        now = self.server_time()
+        timestamp = int(params["timestamp"])
+        if timestamp > now + 1000 or now - timestamp > int(params.get("recvWindow", 5000)):
+            return 400, {"code": -1021, "msg": "Timestamp for this request is outside of the recvWindow."}
+
+        return 200, [
+            {"coin": "USD", "free": "1520.10", "locked": "0"},
+            {"coin": "USDT", "free": "250.50", "locked": "10.00"},
+            {"coin": "BTC", "free": "0.01200000", "locked": "0"},
+        ]
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeWorksheet:
+    def __init__(self, id, title, values=None):
+        self.id = id
+        self.title = title
+        self.values = values or []
+
+    def get_all_values(self, **kwargs):
+        return self.values
+
+
+class FakeSpreadsheet:
+    """Stands in for a gspread Spreadsheet, records every batch_update"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sheets = [FakeWorksheet(0, "Screener")]
+        self.calls = 0
+        self.bytes_sent = 0
+
+    def worksheets(self):
+        time.sleep(self.latency)
+        self.calls += 1
+        return list(self.sheets)
+
+    def batch_update(self, body):
+        time.sleep(self.latency)
+        self.calls += 1
+        self.bytes_sent += len(json.dumps(body))
+        for request in body["requests"]:
+            if "addSheet" in request:
+                properties = request["addSheet"]["properties"]
+                self.sheets.append(FakeWorksheet(properties["sheetId"], properties["title"]))
+            elif "deleteSheet" in request:
+                self.sheets = [sheet for sheet in self.sheets if sheet.id != request["deleteSheet"]["sheetId"]]
+        return {"replies": []}
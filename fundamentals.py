@@ -0,0 +1,43 @@
+# Description: Cache of the FinViz fundamentals screen
+# With LOCAL_PRESCREEN the technical FinViz filters are worked out from the
+# bar cache, which leaves FinViz only the fundamentals (market cap, average
+# volume, EPS and sales growth). Those change quarterly at most, so the
+# screen is kept in a store and FinViz is only scraped again once it expires
+# or the filters change.
+#
+# The store is a local directory by default. A Cloud Function's /tmp goes with
+# its instance, so there FUNDAMENTALS_CACHE_STORE should point at a bucket:
+# gs://bucket/prefix
+
+import json
+import os
+import tempfile
+import time
+
+from storage import open_store
+from telemetry import current
+
+CACHE_STORE = os.getenv("FUNDAMENTALS_CACHE_STORE", tempfile.gettempdir())
+CACHE_KEY = "finviz_fundamentals.json"
+
+# A week, market cap and average volume drift a little in that time but nothing the filters notice
+CACHE_TTL = int(os.getenv("FUNDAMENTALS_CACHE_TTL", 7 * 24 * 60 * 60))
+
+
+def load(filters, ttl=CACHE_TTL):
+    """Get the cached stocks of a screen with these filters, None if there is none younger than ttl"""
+    try:
+        data = open_store(CACHE_STORE).read(CACHE_KEY)
+        cached = json.loads(data) if data is not None else {}
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("filters") != filters or time.time() - cached.get("time", 0) >= ttl:
+        return None
+    current().count("finviz.cache_hits")
+    return cached["stocks"]
+
+
+def save(filters, stocks):
+    data = json.dumps({"time": time.time(), "filters": filters, "stocks": stocks}, default=str)
+    open_store(CACHE_STORE).write(CACHE_KEY, data.encode())
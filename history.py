@@ -0,0 +1,272 @@
+# Description: Screener result history
+# Every run's results are appended to a store (a directory or a gs:// bucket
+# prefix, see storage.py), one partition per date: the per-ticker condition bitmask, cond count, sharia status and
+# FinViz fields as one compressed file of records sorted by ticker. The daily
+# screener sheet only shows today, this keeps every day before it.
+#
+# Next to the partitions is an index: a ticker x session matrix of cond
+# counts and bitmasks. Questions about several sessions ("which names became
+# 6/6 in the last 10 sessions", "how long has this been 6/6") are then a few
+# array operations on it, with nothing fetched or evaluated again. The index
+# can always be rebuilt from the partitions.
+#
+# A session is a run date. Running again on the same date replaces that
+# date's partition, every other date is left as it was.
+
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from storage import open_store
+from telemetry import current
+
+# Cloud Functions only keep /tmp for the life of an instance, point this at a gs:// URL to keep the history
+HISTORY_DIR = os.getenv("RESULT_HISTORY_DIR", os.path.join(tempfile.gettempdir(), "screener_history"))
+
+CONDITIONS = ["cond 1", "cond 2", "cond 3", "cond 4", "cond 5", "cond 6"]
+
+# sharia status -> the code stored for it, anything else (no lookup) is stored as -1
+SHARIA_CODES = {"COMPLIANT": 0, "QUESTIONABLE": 1, "FAILED": 2, "UNKNOWN": 3}
+SHARIA_STATUSES = {code: status for status, code in SHARIA_CODES.items()}
+
+RESULTS_FILE = "results.npz"
+INDEX_DIR = "index"
+# cond count in the index for a ticker that wasn't in a session's results
+ABSENT = 255
+
+
+def _partition(date):
+    return f"date={date:%Y-%m-%d}"
+
+
+def to_records(output, conditions=CONDITIONS):
+    """Turn a screener output DataFrame into the records of a partition, sorted by ticker"""
+    output = output.sort_values("Ticker", kind="stable")
+    mask = np.zeros(len(output), dtype=np.uint16)
+    for bit, column in enumerate(conditions):
+        mask |= output[column].to_numpy(dtype=bool).astype(np.uint16) << bit
+
+    sharia = output["Sharia"] if "Sharia" in output else pd.Series(index=output.index, dtype=object)
+    columns = {
+        "Ticker": output["Ticker"].to_numpy(dtype=str),
+        "mask": mask,
+        "cond count": output["cond count"].to_numpy(dtype=np.uint8),
+        "sharia": np.array([SHARIA_CODES.get(status, -1) for status in sharia], dtype=np.int8),
+    }
+    # the FinViz fields as they are, text as UTF-8 bytes (a fixed width str would take 4 bytes a character)
+    for column in output.columns:
+        if column in columns or column in conditions or column == "Sharia":
+            continue
+        values = output[column]
+        integer = pd.api.types.is_integer_dtype(values)
+        if pd.api.types.is_bool_dtype(values) or integer and not values.isna().any():
+            columns[column] = values.to_numpy(dtype=np.int64)
+        elif integer or pd.api.types.is_float_dtype(values):
+            # a nullable integer column with gaps, like RS, is kept as floats with NaN
+            columns[column] = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            columns[column] = np.array([str(value).encode() for value in values.fillna("")], dtype=bytes)
+
+    records = np.empty(len(output), dtype=[(name, values.dtype) for name, values in columns.items()])
+    for name, values in columns.items():
+        records[name] = values
+    return records
+
+
+def to_frame(records, conditions=CONDITIONS):
+    """Turn the records of a partition back into a DataFrame shaped like the screener output"""
+    frame = pd.DataFrame({
+        name: np.char.decode(records[name]) if records[name].dtype.kind == "S" else records[name]
+        for name in records.dtype.names
+        if name not in ("mask", "sharia")
+    })
+    frame["cond count"] = frame["cond count"].astype(int)
+    for bit, column in enumerate(conditions):
+        frame[column] = ((records["mask"] >> bit) & 1).astype(int)
+    frame["Sharia"] = [SHARIA_STATUSES.get(code) for code in records["sharia"]]
+    return frame
+
+
+class ResultHistory:
+    """The result store at location, see the top of the file"""
+
+    def __init__(self, location=HISTORY_DIR):
+        self.store = open_store(location)
+        self._index = None
+
+    def sessions(self):
+        """Every date with results, oldest first"""
+        return sorted(pd.Timestamp(name[len("date="):]).date() for name in self.store.runs() if name.startswith("date="))
+
+    def append(self, date, output):
+        """Store a run's output as the partition of date, replacing the one already there"""
+        records = to_records(output)
+        buffer = io.BytesIO()
+        # the same names come back day after day, so the partitions compress well
+        np.savez_compressed(buffer, results=records)
+        self.store.write(f"{_partition(date)}/{RESULTS_FILE}", buffer.getvalue())
+
+        self._update_index(date, records)
+        current().count("history.rows", len(records))
+        return records
+
+    def read(self, date):
+        """The records of one session, None if there is no partition for it"""
+        data = self.store.read(f"{_partition(date)}/{RESULTS_FILE}")
+        if data is None:
+            return None
+        with np.load(io.BytesIO(data)) as partition:
+            return partition["results"]
+
+    def frame(self, date):
+        """One session as a DataFrame shaped like the screener output"""
+        records = self.read(date)
+        return None if records is None else to_frame(records)
+
+    def _load_index(self):
+        data = [self.store.read(f"{INDEX_DIR}/{name}") for name in ("index.json", "counts.npy", "masks.npy")]
+        if any(part is None for part in data):
+            return None
+        meta = json.loads(data[0])
+        counts, masks = (np.load(io.BytesIO(part)) for part in data[1:])
+        sessions = [pd.Timestamp(date).date() for date in meta["sessions"]]
+        if counts.shape != masks.shape or counts.shape != (len(meta["tickers"]), len(sessions)):
+            return None
+        return meta["tickers"], sessions, counts, masks
+
+    def index(self):
+        """(tickers, sessions, counts, masks), counts and masks are ticker x session matrices"""
+        if self._index is None:
+            index = self._load_index()
+            # built again if a run crashed between writing a partition and the index
+            if index is None or index[1] != self.sessions():
+                index = self.rebuild_index()
+            self._index = index
+        return self._index
+
+    def rebuild_index(self):
+        """Build the index again from every partition"""
+        partitions = {date: self.read(date) for date in self.sessions()}
+        # a local partition directory left without its file by a crash isn't a session
+        partitions = {date: records for date, records in partitions.items() if records is not None}
+        sessions = list(partitions)
+        partitions = list(partitions.values())
+        tickers = sorted({str(ticker) for records in partitions for ticker in records["Ticker"]})
+        counts = np.full((len(tickers), len(sessions)), ABSENT, dtype=np.uint8)
+        masks = np.zeros((len(tickers), len(sessions)), dtype=np.uint16)
+        for column, records in enumerate(partitions):
+            rows = np.searchsorted(tickers, records["Ticker"])
+            counts[rows, column] = records["cond count"]
+            masks[rows, column] = records["mask"]
+        self._save_index(tickers, sessions, counts, masks)
+        return self._index
+
+    def _update_index(self, date, records):
+        """Add or replace the column of date, which has to be the latest session"""
+        index = self._index or self._load_index()
+        if index is None or sorted(set(index[1]) | {date}) != self.sessions() or index[1] and date < index[1][-1]:
+            # no index yet, or it is out of step with the partitions, or a date in the middle of the history
+            self.rebuild_index()
+            return
+        tickers, sessions, counts, masks = index
+
+        new = sorted(set(records["Ticker"].tolist()) - set(tickers))
+        if new:
+            old_rows = np.searchsorted(sorted(tickers + new), tickers)
+            tickers = sorted(tickers + new)
+            grown_counts = np.full((len(tickers), len(sessions)), ABSENT, dtype=np.uint8)
+            grown_masks = np.zeros((len(tickers), len(sessions)), dtype=np.uint16)
+            grown_counts[old_rows] = counts
+            grown_masks[old_rows] = masks
+            counts, masks = grown_counts, grown_masks
+
+        if date not in sessions:
+            sessions = sessions + [date]
+            counts = np.hstack([counts, np.full((len(tickers), 1), ABSENT, dtype=np.uint8)])
+            masks = np.hstack([masks, np.zeros((len(tickers), 1), dtype=np.uint16)])
+
+        counts[:, -1] = ABSENT
+        masks[:, -1] = 0
+        rows = np.searchsorted(tickers, records["Ticker"])
+        counts[rows, -1] = records["cond count"]
+        masks[rows, -1] = records["mask"]
+        self._save_index(tickers, sessions, counts, masks)
+
+    def _save_index(self, tickers, sessions, counts, masks):
+        for name, array in (("counts.npy", counts), ("masks.npy", masks)):
+            buffer = io.BytesIO()
+            np.save(buffer, array)
+            self.store.write(f"{INDEX_DIR}/{name}", buffer.getvalue())
+        # written last, so a crash before it leaves an index that doesn't match and gets rebuilt
+        meta = {"tickers": tickers, "sessions": [date.isoformat() for date in sessions]}
+        self.store.write(f"{INDEX_DIR}/index.json", json.dumps(meta).encode())
+        self._index = (tickers, sessions, counts, masks)
+
+    def streaks(self, count=6):
+        """Ticker -> how many sessions in a row, up to the latest, it has had at least count conditions"""
+        tickers, sessions, counts, _ = self.index()
+        if not sessions:
+            return {}
+        met = (counts >= count) & (counts != ABSENT)
+        # the first session from the end that didn't meet it, or every session if all of them did
+        missed = ~met[:, ::-1]
+        lengths = np.where(missed.any(axis=1), missed.argmax(axis=1), met.shape[1])
+        return {ticker: int(length) for ticker, length in zip(tickers, lengths) if length}
+
+    def entered(self, sessions=10, count=6):
+        """Ticker -> the date it reached count conditions in the last `sessions` sessions, the latest time if more than once"""
+        return self._changes(sessions, count, entering=True)
+
+    def dropped(self, sessions=10, count=6):
+        """Ticker -> the date it dropped below count conditions in the last `sessions` sessions, the latest time if more than once"""
+        return self._changes(sessions, count, entering=False)
+
+    def _changes(self, sessions, count, entering):
+        tickers, dates, counts, _ = self.index()
+        met = (counts >= count) & (counts != ABSENT)
+        if met.shape[1] < 2:
+            return {}
+        # a change is a session that differs from the one before it
+        before, after = met[:, :-1], met[:, 1:]
+        changed = (after & ~before) if entering else (before & ~after)
+        changed = changed[:, -sessions:]
+        offset = len(dates) - changed.shape[1]
+        rows = np.flatnonzero(changed.any(axis=1))
+        # the last change in the window, counted from the end
+        last = changed.shape[1] - 1 - changed[rows, ::-1].argmax(axis=1)
+        return {tickers[row]: dates[offset + column] for row, column in zip(rows, last)}
+
+    def passed(self, ticker, condition=None):
+        """Date -> whether the ticker met condition (1-6, or all 6 if None), for every session it was in"""
+        tickers, dates, counts, masks = self.index()
+        row = np.searchsorted(tickers, ticker)
+        if row == len(tickers) or tickers[row] != ticker:
+            return {}
+        present = counts[row] != ABSENT
+        if condition is None:
+            met = counts[row] == len(CONDITIONS)
+        else:
+            met = (masks[row] >> (condition - 1)) & 1 == 1
+        return {date: bool(value) for date, value, here in zip(dates, met, present) if here}
+
+
+def annotate(output, history, count=len(CONDITIONS)):
+    """Add each ticker's streak at count conditions and "new"/"dropped" for a move in or out since the last session
+
+    The column is named after count ("6/6", or "7/7" with the RS condition).
+    A ticker that dropped out has less than count conditions, sheets.py keeps
+    its row visible through the filter.
+    """
+    streaks = history.streaks(count)
+    entered = history.entered(sessions=1, count=count)
+    dropped = history.dropped(sessions=1, count=count)
+    output = output.copy()
+    output["Streak"] = output["Ticker"].map(streaks).fillna(0).astype(int)
+    output[f"{count}/{count}"] = output["Ticker"].map(
+        lambda ticker: "new" if ticker in entered else "dropped" if ticker in dropped else ""
+    )
+    return output
@@ -0,0 +1,238 @@
+# Description: Incremental indicator state
+# Keeps what the six conditions need for every ticker (SMA running sums,
+# the lagged SMA200 window and the 52 week min/max) so a new daily bar is
+# folded in with a constant amount of work instead of reloading the history.
+#
+# The daily run saves the states as of the last close to INDICATOR_STATE_STORE
+# (a directory or gs://bucket/prefix) and the intraday screen starts from
+# them, only fetching the bars since. A state that is missing or no longer
+# matches the bars is rebuilt from the full history.
+
+import json
+import os
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from conditions import LOOKBACK, compute_conditions, CONDITION_COLUMNS
+from storage import open_store
+from telemetry import current
+
+# Where the daily run keeps the states, unset means they aren't kept and are always rebuilt
+STATE_STORE = os.getenv("INDICATOR_STATE_STORE")
+STATE_KEY = "indicator_state.json"
+
+# How far back a rebuild reads, enough for the lagged SMA200 and the 52 week range
+HISTORY_DAYS = 400
+
+# Tickers with fewer bars than this aren't screened so they get no state
+MIN_BARS = 50
+
+# Closes are summed as integers of 1/10000 of a dollar (Alpaca prices have at
+# most 4 decimals) so the running sums never drift and a rebuild is exact
+SCALE = 10_000
+
+SMA_WINDOWS = (50, 150, 200)
+
+# the lagged SMA200 covers the closes [-221:-21]
+LAG = 21
+LAG_WINDOW = 200
+
+
+class IndicatorState:
+    def __init__(self):
+        self.closes = deque(maxlen=LOOKBACK)  # ring buffer of the last year of closes
+        self.count = 0  # bars seen so far, used as the position of each bar
+        self.last_timestamp = None
+        self.last_close = None
+        self.sums = {window: 0 for window in SMA_WINDOWS}
+        self.lag_sum = 0
+        # monotonic deques of (position, price) for the 52 week low and high
+        self.lows = deque()
+        self.highs = deque()
+
+    def update(self, timestamp, close):
+        """Fold one new daily bar into the state, bars at or before the last one are skipped"""
+        timestamp = pd.Timestamp(timestamp).value
+        if self.last_timestamp is not None and timestamp <= self.last_timestamp:
+            return False
+
+        price = float(close)
+        close = int(round(price * SCALE))
+        closes = self.closes
+        n = len(closes)
+
+        # move each SMA window one bar forward
+        for window in SMA_WINDOWS:
+            self.sums[window] += close
+            if n >= window:
+                self.sums[window] -= closes[-window]
+
+        # the lagged window gains the bar that is now 21 back and loses the one 221 back
+        if n >= LAG:
+            self.lag_sum += closes[-LAG]
+        if n >= LAG + LAG_WINDOW:
+            self.lag_sum -= closes[-(LAG + LAG_WINDOW)]
+
+        position = self.count
+        oldest = position - LOOKBACK + 1
+        while self.lows and self.lows[-1][1] >= price:
+            self.lows.pop()
+        self.lows.append((position, price))
+        while self.lows[0][0] < oldest:
+            self.lows.popleft()
+        while self.highs and self.highs[-1][1] <= price:
+            self.highs.pop()
+        self.highs.append((position, price))
+        while self.highs[0][0] < oldest:
+            self.highs.popleft()
+
+        closes.append(close)
+        self.last_close = price
+        self.count += 1
+        self.last_timestamp = timestamp
+        return True
+
+    def indicators(self):
+        """Get the current close, SMAs and 52 week extremes the same way conditions.compute_indicators does"""
+        n = len(self.closes)
+        if n == 0:
+            return None
+
+        values = {"close": self.last_close}
+        for window in SMA_WINDOWS:
+            values[f"sma {window}"] = round(self.sums[window] / min(n, window) / SCALE, 2)
+
+        lag_count = min(max(n - LAG, 0), LAG_WINDOW)
+        values["sma 200 20"] = round(self.lag_sum / lag_count / SCALE, 2) if lag_count else np.nan
+
+        values["52 week low"] = round(self.lows[0][1], 2)
+        values["52 week high"] = round(self.highs[0][1], 2)
+        return values
+
+    def to_dict(self):
+        return {
+            "closes": list(self.closes),
+            "count": self.count,
+            "last_timestamp": self.last_timestamp,
+            "last_close": self.last_close,
+            "sums": {str(window): total for window, total in self.sums.items()},
+            "lag_sum": self.lag_sum,
+            "lows": list(self.lows),
+            "highs": list(self.highs),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls()
+        state.closes.extend(data["closes"])
+        state.count = data["count"]
+        state.last_timestamp = data["last_timestamp"]
+        state.last_close = data["last_close"]
+        state.sums = {int(window): total for window, total in data["sums"].items()}
+        state.lag_sum = data["lag_sum"]
+        state.lows = deque(tuple(item) for item in data["lows"])
+        state.highs = deque(tuple(item) for item in data["highs"])
+        return state
+
+    @classmethod
+    def rebuild(cls, df, close="Close"):
+        """Build a fresh state from a full bar history"""
+        state = cls()
+        for timestamp, value in zip(df.index, df[close]):
+            state.update(timestamp, value)
+        return state
+
+
+def load_states(location=STATE_STORE):
+    """Load the saved state of every ticker, returns an empty dict if there is none"""
+    if location is None:
+        return {}
+    try:
+        data = open_store(location).read(STATE_KEY)
+        saved = json.loads(data) if data is not None else {}
+    except (OSError, ValueError):
+        return {}
+    return {ticker: IndicatorState.from_dict(data) for ticker, data in saved.items()}
+
+
+def save_states(states, location=STATE_STORE):
+    if location is None:
+        return
+    data = json.dumps({ticker: state.to_dict() for ticker, state in states.items()})
+    open_store(location).write(STATE_KEY, data.encode())
+
+
+def update_states(states, frames, close="Close"):
+    """Feed the bars of each ticker that are newer than its state, creating states as needed"""
+    for ticker, df in frames.items():
+        state = states.setdefault(ticker, IndicatorState())
+        # only the tail after the last known bar needs looking at
+        start = 0
+        if state.last_timestamp is not None:
+            start = np.searchsorted(pd.DatetimeIndex(df.index).as_unit("ns").asi8, state.last_timestamp, "right")
+        for timestamp, value in zip(df.index[start:], np.asarray(df[close])[start:]):
+            state.update(timestamp, value)
+    return states
+
+
+def evaluate_states(states):
+    """Evaluate all six conditions from the states alone, same columns as conditions.evaluate_frames"""
+    tickers = [ticker for ticker, state in states.items() if state.closes]
+    if not tickers:
+        return pd.DataFrame(columns=CONDITION_COLUMNS)
+
+    rows = [states[ticker].indicators() for ticker in tickers]
+    indicators = {key: np.array([row[key] for row in rows], dtype=float) for key in rows[0]}
+
+    conditions, count = compute_conditions(indicators)
+    result = pd.DataFrame(conditions, index=tickers, columns=CONDITION_COLUMNS[1:])
+    result.insert(0, "cond count", count.astype(int))
+    return result
+
+
+def refresh_states(states, frames, close="Close"):
+    """Bring states up to date with the newer bars in frames, leaving out the stale ones
+
+    Each frame has to start at or before its state's last bar. A state whose
+    last bar isn't in its frame or has another close (the bars were fetched
+    again) is stale, as is a ticker without a frame.
+    """
+    fresh = {}
+    for ticker, df in frames.items():
+        state = states.get(ticker)
+        if state is None or not len(df):
+            continue
+        timestamps = pd.DatetimeIndex(df.index).as_unit("ns").asi8
+        i = np.searchsorted(timestamps, state.last_timestamp)
+        if i == len(timestamps) or timestamps[i] != state.last_timestamp:
+            continue
+        if np.asarray(df[close])[i] == state.last_close:
+            fresh[ticker] = state
+    return update_states(fresh, {ticker: frames[ticker] for ticker in fresh}, close)
+
+
+def sync_states(tickers, end_date, get_frames, states=None, close="Close"):
+    """Get the state of every ticker up to end_date, starting from the saved ones
+
+    get_frames(tickers, start_date, end_date) gets the bars. Tickers with a
+    saved state only need the bars from the oldest state's last bar on, the
+    others, and the ones whose state is stale, are rebuilt from HISTORY_DAYS.
+    """
+    report = current()
+    states = load_states() if states is None else states
+    known = [ticker for ticker in tickers if ticker in states]
+
+    fresh = {}
+    if known:
+        since = pd.Timestamp(min(states[ticker].last_timestamp for ticker in known), tz="UTC")
+        fresh = refresh_states(states, get_frames(known, since, end_date), close)
+    report.count("indicator_state.updated", len(fresh))
+
+    missing = [ticker for ticker in tickers if ticker not in fresh]
+    if missing:
+        frames = get_frames(missing, end_date - pd.Timedelta(days=HISTORY_DAYS), end_date)
+        update_states(fresh, {ticker: df for ticker, df in frames.items() if len(df) >= MIN_BARS}, close)
+        report.count("indicator_state.rebuilt", len(missing))
+    return fresh
@@ -0,0 +1,273 @@
+# Description: Intraday streaming screen
+# Watches minute bars during the trading day and sends a Telegram signal when
+# a ticker moves into 6/6. The daily IndicatorState of every ticker (as of the
+# last close, saved by the daily run when INDICATOR_STATE_STORE is set) is turned once per session into a few arrays: the SMA sums
+# without the bar that drops out, the lagged SMA200 and the 52 week extremes
+# of the bars that stay. Evaluating a new price is then a handful of vectorized
+# operations over the tickers in a batch, with no pandas on the way. Alerts
+# go through telegram's notification queue so the feed never waits on them.
+#
+# Bars come from Alpaca's websocket feed, or from a recorded JSON lines file
+# for testing: python intraday.py --replay bars.jsonl
+
+import argparse
+import datetime as dt
+import json
+import os
+
+import numpy as np
+
+from conditions import LOOKBACK, compute_conditions
+from indicator_state import LAG, LAG_WINDOW, SCALE, SMA_WINDOWS, evaluate_states
+from telemetry import current
+
+# A ticker that already alerted isn't alerted again for this long, even if it drops out of 6/6 and back
+DEBOUNCE_SECONDS = int(os.getenv("INTRADAY_DEBOUNCE_SECONDS", 60 * 60))
+
+# iex on the free plan, sip with a paid data subscription
+FEED = os.getenv("ALPACA_FEED", "iex")
+
+DAY_NS = 86_400 * 10**9
+
+
+def _nanoseconds(timestamp):
+    """Bar time as UTC epoch nanoseconds from a msgpack Timestamp, datetime or ISO string"""
+    if hasattr(timestamp, "to_unix_nano"):
+        return timestamp.to_unix_nano()
+    if isinstance(timestamp, str):
+        return int(np.datetime64(timestamp.rstrip("Z"), "ns").view(np.int64))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=dt.timezone.utc)
+    return (timestamp - dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)) // dt.timedelta(microseconds=1) * 1000
+
+
+def send_signal(ticker, price):
+    from telegram import notifier
+
+    # queued, so the feed never waits on Telegram and alerts close together go out as one message
+    action = "BUY"
+    notifier().signal(f"{action} --> {ticker} at {price} (6/6)", action, ticker, price)
+
+
+class IntradayScreen:
+    """Re-evaluates the six conditions on every minute bar, alerting when a ticker reaches 6/6"""
+
+    def __init__(self, states, alert=send_signal, debounce=DEBOUNCE_SECONDS):
+        self.states = {ticker: state for ticker, state in states.items() if state.closes}
+        self.tickers = list(self.states)
+        self.rows = {ticker: row for row, ticker in enumerate(self.tickers)}
+        self.alert = alert
+        self.debounce = debounce * 10**9
+
+        n = len(self.tickers)
+        self.prices = np.full(n, np.nan)
+        self.alerted_at = np.full(n, np.iinfo(np.int64).min // 2, dtype=np.int64)
+        self.session = None
+        self._prepare()
+
+    def _prepare(self):
+        """Work out, from the daily states, everything that doesn't depend on today's price"""
+        n = len(self.tickers)
+        self.base_sums = np.zeros((len(SMA_WINDOWS), n), dtype=np.int64)
+        self.counts = np.zeros((len(SMA_WINDOWS), n))
+        self.sma_200_20 = np.full(n, np.nan)
+        self.low_rest = np.full(n, np.inf)
+        self.high_rest = np.full(n, -np.inf)
+
+        for row, ticker in enumerate(self.tickers):
+            state = self.states[ticker]
+            closes = state.closes
+            size = len(closes)
+
+            # today's bar joins each SMA window and the oldest bar of a full window leaves it
+            for i, window in enumerate(SMA_WINDOWS):
+                self.base_sums[i, row] = state.sums[window] - (closes[-window] if size >= window else 0)
+                self.counts[i, row] = min(size + 1, window)
+
+            # the lagged SMA200 doesn't reach today's bar so it is fixed for the day
+            lag_sum = state.lag_sum
+            if size >= LAG:
+                lag_sum += closes[-LAG]
+            if size >= LAG + LAG_WINDOW:
+                lag_sum -= closes[-(LAG + LAG_WINDOW)]
+            lag_count = min(max(size + 1 - LAG, 0), LAG_WINDOW)
+            if lag_count:
+                self.sma_200_20[row] = round(lag_sum / lag_count / SCALE, 2)
+
+            # the 52 week extremes of the bars still in the window once today's bar is added
+            oldest = state.count - LOOKBACK + 1
+            self.low_rest[row] = min((price for position, price in state.lows if position >= oldest), default=np.inf)
+            self.high_rest[row] = max((price for position, price in state.highs if position >= oldest), default=-np.inf)
+
+        # where every ticker stood at the last close, so only moves into 6/6 alert
+        counts = evaluate_states(self.states)["cond count"]
+        self.condition_counts = counts.reindex(self.tickers).to_numpy(dtype=np.int64, copy=True)
+
+    def evaluate(self, rows, prices):
+        """Get the six conditions for the given rows as if today closed at prices, same as conditions.py"""
+        scaled = np.round(prices * SCALE).astype(np.int64)
+        smas = np.round((self.base_sums[:, rows] + scaled) / self.counts[:, rows] / SCALE, 2)
+        indicators = {
+            "close": prices,
+            "sma 50": smas[0],
+            "sma 150": smas[1],
+            "sma 200": smas[2],
+            "sma 200 20": self.sma_200_20[rows],
+            "52 week low": np.round(np.minimum(self.low_rest[rows], prices), 2),
+            "52 week high": np.round(np.maximum(self.high_rest[rows], prices), 2),
+        }
+        return compute_conditions(indicators)
+
+    def _roll_session(self, day):
+        """Fold the last price of the finished session into the daily states as that day's close"""
+        if self.session is not None:
+            timestamp = self.session * DAY_NS
+            for row in np.flatnonzero(~np.isnan(self.prices)):
+                self.states[self.tickers[row]].update(timestamp, self.prices[row])
+            self.prices[:] = np.nan
+            self._prepare()
+        self.session = day
+
+    def on_bars(self, bars):
+        """Handle a batch of (symbol, timestamp, close) minute bars, returns the tickers that alerted"""
+        batch = {}
+        latest = None
+        alerted = []
+        for symbol, timestamp, close in bars:
+            row = self.rows.get(symbol)
+            if row is None:
+                continue
+            timestamp = _nanoseconds(timestamp)
+            day = timestamp // DAY_NS
+            if self.session is None or day > self.session:
+                # a new trading day, everything before it is settled
+                alerted += self._on_batch(batch, latest)
+                batch = {}
+                self._roll_session(day)
+            batch[row] = close
+            latest = timestamp if latest is None else max(latest, timestamp)
+
+        current().count("intraday.bars", len(bars))
+        return alerted + self._on_batch(batch, latest)
+
+    def on_bar(self, symbol, timestamp, close):
+        return self.on_bars([(symbol, timestamp, close)])
+
+    def _on_batch(self, batch, timestamp):
+        if not batch:
+            return []
+        rows = np.fromiter(batch.keys(), dtype=np.int64, count=len(batch))
+        prices = np.fromiter(batch.values(), dtype=np.float64, count=len(batch))
+        self.prices[rows] = prices
+
+        _, count = self.evaluate(rows, prices)
+        # only a move into 6/6 alerts, and not again until the debounce has passed
+        entered = (count == 6) & (self.condition_counts[rows] < 6) & (timestamp - self.alerted_at[rows] >= self.debounce)
+        self.condition_counts[rows] = count
+
+        alerted = []
+        for row, price in zip(rows[entered], prices[entered]):
+            ticker = self.tickers[row]
+            self.alerted_at[row] = timestamp
+            alerted.append(ticker)
+            current().event("intraday_alert", ticker=ticker, price=float(price))
+            try:
+                self.alert(ticker, float(price))
+            except Exception as e:
+                print(f"Error sending the alert for {ticker}: {str(e)}")
+        return alerted
+
+
+class ReplaySource:
+    """Plays back recorded minute bars, one batch per minute
+
+    Each line of the file is one bar as Alpaca's websocket sends it:
+    {"S": "AAPL", "t": "2025-06-02T14:31:00Z", "c": 201.3, ...}
+    """
+
+    def __init__(self, bars):
+        self.bars = bars
+
+    @classmethod
+    def from_jsonl(cls, path):
+        with open(path) as f:
+            return cls([(bar["S"], bar["t"], bar["c"]) for bar in map(json.loads, f) if bar])
+
+    def run(self, screen):
+        batch = []
+        for bar in self.bars:
+            if batch and bar[1] != batch[-1][1]:
+                screen.on_bars(batch)
+                batch = []
+            batch.append(bar)
+        screen.on_bars(batch)
+
+
+class AlpacaSource:
+    """Minute bars from Alpaca's websocket feed, runs until interrupted"""
+
+    def __init__(self, symbols, api_key, secret_key, feed=FEED):
+        self.symbols = symbols
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.feed = feed
+
+    def run(self, screen):
+        from alpaca.data.enums import DataFeed
+        from alpaca.data.live import StockDataStream
+
+        # raw messages skip building a pydantic Bar for every update
+        stream = StockDataStream(self.api_key, self.secret_key, raw_data=True, feed=DataFeed(self.feed))
+
+        async def on_bar(bar):
+            screen.on_bar(bar["S"], bar["t"], bar["c"])
+
+        stream.subscribe_bars(on_bar, *self.symbols)
+        stream.run()
+
+
+def load_states(tickers, now=None, states=None):
+    """Get the daily indicator state of every ticker up to the last close before today
+
+    Starts from the states the daily run saved and only fetches the bars since,
+    a ticker without a saved state (or a stale one) is rebuilt from the bar cache.
+    """
+    import main
+    from indicator_state import sync_states
+
+    def get_frames(group, start_date, end_date):
+        return main.get_cached_stock_data(group, start_date, end_date, min_rows=1, evict=False)
+
+    now = now or dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+    # stop at midnight so a partial bar for today (cached by an earlier run) isn't counted as a close
+    today = dt.datetime.combine(now.date(), dt.time())
+    return sync_states(tickers, today - dt.timedelta(microseconds=1), get_frames, states)
+
+
+def run(source, tickers, alert=send_signal, debounce=DEBOUNCE_SECONDS):
+    screen = IntradayScreen(load_states(tickers), alert=alert, debounce=debounce)
+    print(f"Watching {len(screen.tickers)} tickers")
+    try:
+        source.run(screen)
+    finally:
+        if alert is send_signal:
+            from telegram import notifier
+
+            notifier().flush()
+    return screen
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Alert on Telegram when a ticker reaches 6/6 during the day")
+    parser.add_argument("--tickers", nargs="+", help="defaults to today's FinViz screen")
+    parser.add_argument("--replay", help="JSON lines file of recorded minute bars instead of the live feed")
+    args = parser.parse_args()
+
+    import main
+
+    tickers = args.tickers or [stock["Ticker"] for stock in (main.screen_stocks() or [])]
+    if args.replay:
+        source = ReplaySource.from_jsonl(args.replay)
+    else:
+        source = AlpacaSource(tickers, main.ALPACA_API_KEY, main.ALPACA_SECRET_KEY)
+    run(source, tickers)
@@ -1,57 +1,198 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from gspread_dataframe import set_with_dataframe
+import time
+
+# Taken before anything else is imported so the measurement mode can report import time
+_IMPORT_STARTED = time.perf_counter()
+
 import datetime as dt
-import pandas as pd
-from finvizfinance.screener.overview import Overview
-from google.cloud import secretmanager
 import json
-import pytz
 import os
-from aatinaa import sharia_status
-import time
-from alpaca.data import StockHistoricalDataClient
-from alpaca.data.requests import StockBarsRequest
-from alpaca.data.timeframe import TimeFrame
+import sys
 from dotenv import load_dotenv
+from telemetry import current, profiled, start_run
 
-# This is set upon gcloud deployment
-PROJECT_ID = os.getenv("MY_PROJECT_ID")
+# The heavy libraries (pandas, gspread, finvizfinance, the Alpaca SDK and Secret
+# Manager) are imported inside the functions that use them, so a cold start
+# only pays for what a request actually needs
 
 # Load environment variables
 load_dotenv()
 
+
+def _flag(name):
+    """Whether the environment variable name is set to 1, true or yes"""
+    return os.getenv(name, "").lower() in ("1", "true", "yes")
+
+
 # Alpaca API configuration
 ALPACA_API_KEY = os.getenv("ALPACA_API_KEY")
 ALPACA_SECRET_KEY = os.getenv("ALPACA_SECRET_KEY")
 
-# Create Alpaca client
-alpaca_client = StockHistoricalDataClient(ALPACA_API_KEY, ALPACA_SECRET_KEY)
+# How many tickers go into one multi-symbol bars request
+BARS_CHUNK_SIZE = 100
+
+# Set to throw away the local bar cache and fetch the full history again
+REFRESH_BAR_CACHE = _flag("REFRESH_BAR_CACHE")
+
+# Set to update the existing screener sheet with only the changed cells instead of replacing it
+UPDATE_SHEET_IN_PLACE = _flag("UPDATE_SHEET_IN_PLACE")
+
+# Set to fetch bars with the raw JSON client in alpaca_bars.py instead of the SDK
+ALPACA_RAW_BARS = _flag("ALPACA_RAW_BARS")
+
+# Set to fetch, evaluate and look up compliance at the same time (see pipeline.py)
+STREAMING_PIPELINE = _flag("STREAMING_PIPELINE")
+
+# The first set of filters, done by FinViz before we fetch any bars
+FINVIZ_FILTERS = {
+    "Market Cap.": "+Mid (over $2bln)",
+    "Average Volume": "Over 1M",
+    "200-Day Simple Moving Average": "Price above SMA200",
+    "50-Day Simple Moving Average": "Price above SMA50",
+    "52-Week High/Low": "30% or more above Low",
+    "EPS growthqtr over qtr": "Over 20%",
+    "Sales growthqtr over qtr": "Over 20%",
+}
+
+# Set to ask FinViz only for the fundamentals (cached, see fundamentals.py) and
+# apply these technical filters locally on the cached bars instead
+LOCAL_PRESCREEN = _flag("LOCAL_PRESCREEN")
+TECHNICAL_FILTERS = ("200-Day Simple Moving Average", "50-Day Simple Moving Average", "52-Week High/Low")
+
+# Set to checkpoint each stage so a retried run resumes where the last one stopped (see checkpoint.py)
+CHECKPOINTS = _flag("CHECKPOINTS")
+
+# How many sharia statuses are looked up between two checkpoints
+COMPLIANCE_CHECKPOINT_BATCH = 200
+
+# Set to screen every US listing FinViz knows (cached like the fundamentals) instead of filtering there
+FULL_MARKET = _flag("FULL_MARKET")
+
+# Set above 1 to fetch and evaluate the universe in that many processes (see shards.py)
+SCREENER_SHARDS = int(os.getenv("SCREENER_SHARDS", "0") or 0)
+
+# Set to send the tickers that passed all 6 to Telegram, delivered while the sheet is published
+TELEGRAM_SUMMARY = _flag("TELEGRAM_SUMMARY")
+
+# Set to keep every run's results (see history.py) and add each ticker's 6/6 streak and new/dropped to the sheet
+RESULT_HISTORY = _flag("RESULT_HISTORY")
+
+# Set to add each ticker's relative strength rating (1-99) against the rest of the universe as an RS column
+RS_RATING = _flag("RS_RATING")
+
+# Set to a rating (70 in the template) to also add "RS at least this" as a seventh condition, implies RS_RATING
+RS_CONDITION = int(os.getenv("RS_CONDITION", "0") or 0)
+
+# JSON file with a list of other screens (see screens.py) to evaluate on the same bars, each published to its own sheet
+SCREENS_FILE = os.getenv("SCREENS_FILE")
+
+# Set to evaluate on closes adjusted for splits and dividends (see adjustments.py) instead of the raw ones
+ADJUSTED_CLOSE = _flag("ADJUSTED_CLOSE")
+
+# Set to print import and request latency as JSON after every request
+MEASURE_COLD_START = _flag("MEASURE_COLD_START")
+
+# The client is kept here so warm invocations reuse it, secrets are cached in secret_store
+_alpaca_client = None
+_corporate_actions_client = None
+_requests_served = 0
+
+
+def _count_alpaca_bytes(response, *args, **kwargs):
+    """requests response hook for the SDK client"""
+    if response.ok:
+        current().count("alpaca.bytes", int(response.headers.get("Content-Length") or len(response.content)))
+
+
+def get_alpaca_client():
+    """Create the Alpaca client on first use"""
+    global _alpaca_client
+    if _alpaca_client is None:
+        from alpaca.data import StockHistoricalDataClient
+
+        import rate_limit
+
+        client = StockHistoricalDataClient(ALPACA_API_KEY, ALPACA_SECRET_KEY)
+        # every request, including the SDK's own paging, goes through the shared limiter
+        _alpaca_client = rate_limit.install_client(client, "alpaca")
+        # each page counts towards alpaca.bytes, the same as on the raw path in alpaca_bars.py
+        _alpaca_client._session.hooks["response"].append(_count_alpaca_bytes)
+    return _alpaca_client
+
+
+def get_corporate_actions_client():
+    """Create the Alpaca corporate actions client on first use, it shares the Alpaca limiter"""
+    global _corporate_actions_client
+    if _corporate_actions_client is None:
+        from alpaca.data.historical.corporate_actions import CorporateActionsClient
+
+        import rate_limit
+
+        # raw responses skip building a pydantic model for every action
+        client = CorporateActionsClient(ALPACA_API_KEY, ALPACA_SECRET_KEY, raw_data=True)
+        _corporate_actions_client = rate_limit.install_client(client, "alpaca")
+    return _corporate_actions_client
+
+
+def sync_corporate_actions(stocks, start_date, end_date, client=None):
+    """Record the new splits and dividends of the stocks in the bar cache so Adj Close reflects them"""
+    from adjustments import sync_actions
+
+    report = current()
+    with report.stage("corporate_actions"):
+        try:
+            client = client or get_corporate_actions_client()
+            sync_actions([stock["Ticker"] for stock in stocks], start_date, end_date, client)
+        except Exception as e:
+            # the actions we already have still apply, the rest are picked up next run
+            print(f"Error syncing corporate actions: {str(e)}")
+            report.event("corporate_actions_failed", error=str(e)[:200])
 
 
 def get_secret(secret_name: str):
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{PROJECT_ID}/secrets/{secret_name}/versions/latest"
-    response = client.access_secret_version(name=name)
-    secret = response.payload.data.decode("UTF-8")
-    # if the secret is a file we need to convert to a dict
-    # otherwise keep as is
-    try:
-        secret = json.loads(secret)
-    except:
-        pass
-    return secret  # returns a json or a string depending on the secret type
+    # returns a json or a string depending on the secret type
+    from secret_store import get_secret as get_shared_secret
+
+    return get_shared_secret(secret_name, parse_json=True)
+
+
+def to_bars(ticker, ticker_data, min_rows=50):
+    """Convert the Alpaca bars of one ticker into Bars, None if there aren't enough of them"""
+    from bars import Bars
+
+    if isinstance(ticker_data, Bars):
+        # already decoded by alpaca_bars
+        bars = ticker_data
+    else:
+        # Alpaca bar objects, or dicts with the same keys
+        ticker_data = [item for item in ticker_data if isinstance(item, dict) or hasattr(item, 'close')]
+        bars = Bars.from_alpaca(ticker, ticker_data)
 
+    if not len(bars):
+        print(f"Warning: No valid data found for {ticker}")
+        return None
 
-def get_stock_data(ticker, start_date, end_date, max_retries=3):
-    """Get stock data using Alpaca API (much more reliable and higher rate limits)"""
+    # Validate that we have enough data
+    if len(bars) < min_rows:
+        print(f"Warning: Insufficient data for {ticker} (only {len(bars)} days)")
+        return None
+
+    print(f"Successfully got data for {ticker} ({len(bars)} days)")
+    return bars
+
+
+def get_stock_data(ticker, start_date, end_date, max_retries=3, min_rows=50):
+    """Get the daily bars of a ticker as Bars using Alpaca API (much more reliable and higher rate limits)"""
+    from alpaca.data.requests import StockBarsRequest
+    from alpaca.data.timeframe import TimeFrame
+
+    from rate_limit import backoff_delay, status_of
+
+    alpaca_client = get_alpaca_client()
+    report = current()
+    started = time.perf_counter()
     
     for attempt in range(max_retries):
         try:
-            # Add small delay between requests to be respectful
-            if attempt > 0:
-                time.sleep(0.1)  # Very small delay since Alpaca has high rate limits
-            
             print(f"Fetching data for {ticker} from Alpaca...")
             
             # Create request for daily bars
@@ -63,10 +204,10 @@ def get_stock_data(ticker, start_date, end_date, max_retries=3):
             )
             
             # Get the data
+            report.count("alpaca.requests")
             bars = alpaca_client.get_stock_bars(request)
-            
+            report.observe("alpaca.ticker_seconds", ticker, time.perf_counter() - started)
 
-            
             if not bars or len(bars.data) == 0:
                 print(f"Warning: No data available for {ticker}")
                 return None
@@ -79,71 +220,14 @@ def get_stock_data(ticker, start_date, end_date, max_retries=3):
                 # Alpaca returns data as a dict with ticker as key
                 if isinstance(raw_data, dict) and ticker in raw_data:
                     # Extract the actual bar data for this ticker
-                    ticker_data = raw_data[ticker]
-                    
-                    # Convert raw data to DataFrame manually
-                    data_list = []
-                    for item in ticker_data:
-                        if hasattr(item, 'timestamp') and hasattr(item, 'close'):
-                            # This is a bar object
-                            data_list.append({
-                                'timestamp': item.timestamp,
-                                'open': item.open,
-                                'high': item.high,
-                                'low': item.low,
-                                'close': item.close,
-                                'volume': item.volume
-                            })
-                        elif isinstance(item, dict):
-                            # This is already a dict
-                            data_list.append(item)
-                        else:
-                            print(f"Debug: Unexpected item type: {type(item)}, value: {item}")
-                    
-                    if not data_list:
-                        print(f"Warning: No valid data found for {ticker}")
-                        return None
-                    
-                    # Create DataFrame from the data
-                    df = pd.DataFrame(data_list)
-                    
-                    # Set timestamp as index
-                    if 'timestamp' in df.columns:
-                        df['Date'] = pd.to_datetime(df['timestamp'])
-                        df.set_index('Date', inplace=True)
-                        df = df.drop('timestamp', axis=1)
-                    
-                    # Rename columns to match our expected format
-                    column_mapping = {
-                        'open': 'Open',
-                        'high': 'High',
-                        'low': 'Low',
-                        'close': 'Close',
-                        'volume': 'Volume'
-                    }
-                    
-                    for alpaca_col, our_col in column_mapping.items():
-                        if alpaca_col in df.columns:
-                            df[our_col] = df[alpaca_col]
-                    
-                    # Ensure we have the Close column
-                    if 'Close' not in df.columns:
-                        print(f"Warning: No Close price data for {ticker}")
-                        return None
-                    
-                    # Validate that we have enough data
-                    if len(df) < 50:
-                        print(f"Warning: Insufficient data for {ticker} (only {len(df)} days)")
-                        return None
-                    
-                    print(f"Successfully got data for {ticker} ({len(df)} days)")
-                    return df
+                    report.count("alpaca.bars", len(raw_data[ticker]))
+                    return to_bars(ticker, raw_data[ticker], min_rows)
                 else:
                     print(f"Warning: No data found for ticker {ticker} in response")
                     return None
                 
-            except Exception as df_error:
-                print(f"DataFrame conversion error for {ticker}: {str(df_error)}")
+            except Exception as bars_error:
+                print(f"Bar conversion error for {ticker}: {str(bars_error)}")
                 if attempt < max_retries - 1:
                     continue
                 else:
@@ -151,23 +235,22 @@ def get_stock_data(ticker, start_date, end_date, max_retries=3):
             
         except Exception as e:
             error_msg = str(e)
+            status = status_of(e)
             print(f"Full error for {ticker}: {error_msg}")
             print(f"Error type: {type(e)}")
             
-            if "not found" in error_msg.lower() or "404" in error_msg:
+            if status == 404:
                 print(f"Warning: {ticker} not found in Alpaca database")
                 return None
-            elif "rate limit" in error_msg.lower() or "429" in error_msg:
-                if attempt < max_retries - 1:
-                    print(f"Rate limited for {ticker}, attempt {attempt + 1}/{max_retries}")
-                    time.sleep(1 * (attempt + 1))  # Small delay for rate limiting
-                else:
-                    print(f"Failed to get data for {ticker} after {max_retries} attempts: Rate limited")
-                    return None
+            elif status == 429:
+                # the limiter has backed off and retried it already, asking again would only add to the pile
+                print(f"Failed to get data for {ticker}: Rate limited")
+                return None
             else:
+                report.event("retry", upstream="alpaca", ticker=ticker, attempt=attempt + 1, error=error_msg[:200])
                 if attempt < max_retries - 1:
                     print(f"Attempt {attempt + 1} failed for {ticker}: {error_msg}")
-                    time.sleep(0.5 * (attempt + 1))
+                    time.sleep(backoff_delay(attempt))
                 else:
                     print(f"Failed to get data for {ticker} after {max_retries} attempts: {error_msg}")
                     return None
@@ -175,7 +258,234 @@ def get_stock_data(ticker, start_date, end_date, max_retries=3):
     return None
 
 
+def get_stock_data_many(tickers, start_date, end_date, chunk_size=BARS_CHUNK_SIZE, max_retries=3, min_rows=50):
+    """Get stock data for many tickers with one Alpaca request per chunk of tickers
+
+    Returns a dict of ticker -> Bars. Tickers without usable data are left out.
+    A chunk that keeps failing falls back to get_stock_data for its tickers only.
+    """
+    from rate_limit import backoff_delay, status_of
+
+    report = current()
+    frames = {}
+
+    for i in range(0, len(tickers), chunk_size):
+        chunk = list(tickers[i:i + chunk_size])
+        print(f"Fetching data for {len(chunk)} tickers from Alpaca ({i + len(chunk)}/{len(tickers)})...")
+
+        raw_data = None
+        rate_limited = False
+        started = time.perf_counter()
+        for attempt in range(max_retries):
+            try:
+                if ALPACA_RAW_BARS:
+                    import alpaca_bars
+
+                    raw_data = alpaca_bars.get_bars(chunk, start_date, end_date, ALPACA_API_KEY, ALPACA_SECRET_KEY)
+                else:
+                    from alpaca.data.requests import StockBarsRequest
+                    from alpaca.data.timeframe import TimeFrame
+
+                    # The SDK follows next_page_token for us so every page of the chunk comes back here
+                    request = StockBarsRequest(
+                        symbol_or_symbols=chunk,
+                        timeframe=TimeFrame.Day,
+                        start=start_date,
+                        end=end_date
+                    )
+                    report.count("alpaca.requests")
+                    bars = get_alpaca_client().get_stock_bars(request)
+                    raw_data = bars.data if bars else {}
+                report.count("alpaca.bars", sum(len(ticker_data) for ticker_data in raw_data.values()))
+                break
+
+            except Exception as e:
+                error_msg = str(e)
+                # a 429 only gets here once the limiter has retried it, so it isn't retried again
+                rate_limited = status_of(e) == 429
+                if rate_limited or attempt == max_retries - 1:
+                    report.event("chunk_failed", upstream="alpaca", first=chunk[0], size=len(chunk), error=error_msg[:200])
+                    print(f"Failed to get data for chunk after {attempt + 1} attempts: {error_msg}")
+                    break
+                else:
+                    report.event("retry", upstream="alpaca", first=chunk[0], attempt=attempt + 1, error=error_msg[:200])
+                    print(f"Attempt {attempt + 1} failed for chunk: {error_msg}")
+                    time.sleep(backoff_delay(attempt))
+        report.observe("alpaca.chunk_seconds", f"{chunk[0]}..{chunk[-1]}", time.perf_counter() - started)
+
+        # The whole chunk failed so try each of its tickers on its own, unless Alpaca is refusing us
+        if raw_data is None:
+            failed = [] if rate_limited else chunk
+        else:
+            failed = []
+            for ticker in chunk:
+                if ticker not in raw_data:
+                    print(f"Warning: No data found for ticker {ticker} in response")
+                    continue
+                try:
+                    bars = to_bars(ticker, raw_data[ticker], min_rows)
+                except Exception as bars_error:
+                    print(f"Bar conversion error for {ticker}: {str(bars_error)}")
+                    failed.append(ticker)
+                    continue
+                if bars is not None:
+                    frames[ticker] = bars
+
+        report.count("alpaca.fallback_tickers", len(failed))
+        for ticker in failed:
+            bars = get_stock_data(ticker, start_date, end_date, max_retries=max_retries, min_rows=min_rows)
+            if bars is not None:
+                frames[ticker] = bars
+
+    return frames
+
+
+def get_cached_stock_data(tickers, start_date, end_date, refresh=False, min_rows=50, cache=None, evict=True):
+    """Get stock data for many tickers, reading history from the local bar cache
+
+    Only the days after the last cached bar are fetched from Alpaca and then
+    appended to the cache. Set refresh to throw away the cache and fetch it all.
+    Set evict to False when tickers is only part of the universe.
+    """
+    from bar_cache import BarCache
+
+    cache = cache or BarCache()
+    report = current()
+
+    # tickers that need bars from the same day onwards get fetched together
+    to_fetch = {}
+    for ticker in tickers:
+        if refresh:
+            # the splits and dividends were just synced, only the bars are fetched again
+            cache.drop(ticker, keep_actions=True)
+        fetch_start = cache.missing_start(ticker, start_date, end_date)
+        if fetch_start is None:
+            report.count("bar_cache.up_to_date")
+        else:
+            to_fetch.setdefault(fetch_start, []).append(ticker)
+
+    written = {}
+    for fetch_start, group in to_fetch.items():
+        print(f"Fetching {len(group)} tickers from {fetch_start:%Y-%m-%d}")
+        full_history = fetch_start == start_date
+        report.count("bar_cache.full_fetch" if full_history else "bar_cache.incremental_fetch", len(group))
+        fresh = get_stock_data_many(group, fetch_start, end_date, min_rows=min_rows if full_history else 1)
+        # keep what was written so those tickers don't have to be read back
+        for ticker, bars in fresh.items():
+            if full_history:
+                written[ticker] = cache.write(ticker, bars, start_date)
+            else:
+                written[ticker] = cache.append(ticker, bars)
+
+    frames = {}
+    for ticker in tickers:
+        if ticker in written:
+            bars = written[ticker].between(start_date, end_date)
+        else:
+            bars = cache.read_bars(ticker, start_date, end_date)
+        if bars is None or len(bars) < min_rows:
+            continue
+        frames[ticker] = bars
+
+    # make room by dropping the symbols that aren't in the universe anymore
+    if evict:
+        report.count("bar_cache.evicted", len(cache.evict(keep=tickers)))
+    return frames
+
+
+def restore_bar_cache():
+    """Fill an empty local bar cache (a new instance) from BAR_CACHE_STORE, see bar_cache.py"""
+    import bar_cache
+
+    cache = bar_cache.BarCache()
+    if bar_cache.CACHE_STORE is None or cache.symbols():
+        return
+    report = current()
+    with report.stage("bar_cache_restore"):
+        try:
+            report.count("bar_cache.restored", cache.restore_snapshot())
+        except Exception as e:
+            # without it the run fetches the full history, like it would have anyway
+            print(f"Error restoring the bar cache: {str(e)}")
+            report.event("bar_cache_restore_failed", error=str(e)[:200])
+
+
+def save_bar_cache():
+    """Save the local bar cache to BAR_CACHE_STORE for the next instance"""
+    import bar_cache
+
+    if bar_cache.CACHE_STORE is None:
+        return
+    report = current()
+    with report.stage("bar_cache_save"):
+        try:
+            report.count("bar_cache.snapshot_bytes", bar_cache.BarCache().save_snapshot())
+        except Exception as e:
+            print(f"Error saving the bar cache: {str(e)}")
+            report.event("bar_cache_save_failed", error=str(e)[:200])
+
+
+def save_indicator_states(tickers, now):
+    """Save the indicator state of every ticker as of the last close to INDICATOR_STATE_STORE for intraday.py"""
+    import indicator_state
+
+    if indicator_state.STATE_STORE is None:
+        return
+    report = current()
+    with report.stage("indicator_states"):
+        try:
+            # only whole days, like intraday.py, a bar for today may still be forming
+            today = dt.datetime.combine(now.date(), dt.time())
+            states = indicator_state.sync_states(tickers, today - dt.timedelta(microseconds=1), read_cached_frames)
+            indicator_state.save_states(states)
+        except Exception as e:
+            # the intraday screen rebuilds them from the bars instead
+            print(f"Error saving the indicator states: {str(e)}")
+            report.event("indicator_states_save_failed", error=str(e)[:200])
+
+
+def save_sharia_cache():
+    """Write the sharia statuses looked up this run back to SHARIA_CACHE_STORE"""
+    from aatinaa import flush_cache
+
+    try:
+        flush_cache()
+    except Exception as e:
+        # they are looked up again next run
+        print(f"Error saving the sharia cache: {str(e)}")
+        current().event("sharia_cache_save_failed", error=str(e)[:200])
+
+
 def main(request):
+    global _requests_served
+    started = time.perf_counter()
+
+    # every invocation emits one JSON run report, even when it fails
+    report = start_run()
+    report.set(cold=_requests_served == 0, import_seconds=round(_IMPORT_SECONDS, 3))
+    try:
+        with profiled(report):
+            result = run_screener(request)
+        report.set(result=result)
+    finally:
+        report.emit()
+
+    if MEASURE_COLD_START:
+        report = {
+            "import_seconds": round(_IMPORT_SECONDS, 3),
+            "request_seconds": round(time.perf_counter() - started, 3),
+            "cold": _requests_served == 0,
+            "modules_loaded": len(sys.modules),
+        }
+        print(json.dumps(report))
+
+    _requests_served += 1
+    return result
+
+
+def get_sheets_credentials(request):
+    from oauth2client.service_account import ServiceAccountCredentials
+
     # If we are testing locally get the json file locally otherwise get from cloud
     if request == "test":
         with open("service_account.json") as json_file:
@@ -189,284 +499,556 @@ def main(request):
         "https://spreadsheets.google.com/feeds",
         "https://www.googleapis.com/auth/drive",
     ]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(
+    return ServiceAccountCredentials.from_json_keyfile_dict(
         service_account_json, scope  # type: ignore
     )
 
-    # we need to get roughly a year's worth of data to evaluate a stock for all the metrics
-    now = dt.datetime.now()
-    start = now - dt.timedelta(days=400)
 
-    # Choose either Adjusted Close or Regular Close
-    closing_types = ["Adj Close", "Close"]
-    close = closing_types[1]
-
-    # Use the FinViz API to get the first set of filters out of the way
-    foverview = Overview()
-    filters_dict = {
-        "Market Cap.": "+Mid (over $2bln)",
-        "Average Volume": "Over 1M",
-        "200-Day Simple Moving Average": "Price above SMA200",
-        "50-Day Simple Moving Average": "Price above SMA50",
-        "52-Week High/Low": "30% or more above Low",
-        "EPS growthqtr over qtr": "Over 20%",
-        "Sales growthqtr over qtr": "Over 20%",
-    }
-
-    foverview.set_filter(filters_dict=filters_dict)
-    finviz = foverview.screener_view()
+def screen_stocks(foverview=None, filters=FINVIZ_FILTERS):
+    """Use the FinViz API to get the first set of filters out of the way
 
-    if isinstance(finviz, pd.DataFrame):
-        finviz = finviz.drop(columns=["P/E"])  # we don't care about P/E
+    Returns the stocks as a list of dicts, or None if FinViz didn't answer.
+    """
+    import pandas as pd
 
-        # Get the DataFrame as list of dicts to loop through
-        stocks = finviz.to_dict("records")
-        print(f"\nFound {len(stocks)} stocks from Finviz")
+    if foverview is None:
+        from finvizfinance.screener.overview import Overview
 
-    else:
-        return "We couldn't get the stocks from FinViz"
+        foverview = Overview()
 
-    output = pd.DataFrame()  # Create the empty output DataFrame
+    foverview.set_filter(filters_dict=filters)
+    finviz = foverview.screener_view()
 
-    # Loop through all the stocks we got from FinViz
-    stock_data = []
-    
-    # For testing, you can limit the number of stocks processed
-    # Set to None to process all stocks, or set to a number (e.g., 5) for testing
-    MAX_STOCKS_TO_PROCESS = None  # Process all stocks
-    
-    stocks_to_process = stocks[:MAX_STOCKS_TO_PROCESS] if MAX_STOCKS_TO_PROCESS else stocks
-    print(f"Processing {len(stocks_to_process)} stocks (out of {len(stocks)} total)")
-    
-    for i, stock in enumerate(stocks_to_process):
+    if not isinstance(finviz, pd.DataFrame):
+        return None
+
+    finviz = finviz.drop(columns=["P/E"])  # we don't care about P/E
+
+    # Get the DataFrame as list of dicts to loop through
+    stocks = finviz.to_dict("records")
+    print(f"\nFound {len(stocks)} stocks from Finviz")
+
+    for stock in stocks:
         # added this short if statement because finviz changed Ticker to Ticker\n\n
         # if they ever fix it this shoould still work
         if "Ticker\n\n" in stock:
             stock["Ticker"] = stock.pop("Ticker\n\n")
 
+    return stocks
+
+
+def screen_fundamentals(foverview=None, refresh=False, filters=None):
+    """Get the stocks that pass only the fundamental FinViz filters, from the cache while it is fresh
+
+    filters defaults to FINVIZ_FILTERS without the technical ones.
+    Returns the stocks as a list of dicts, or None if FinViz didn't answer.
+    """
+    import fundamentals
+
+    if filters is None:
+        filters = {name: value for name, value in FINVIZ_FILTERS.items() if name not in TECHNICAL_FILTERS}
+    stocks = None if refresh else fundamentals.load(filters)
+    if stocks is None:
+        stocks = screen_stocks(foverview, filters)
+        if stocks is not None:
+            fundamentals.save(filters, stocks)
+    else:
+        print(f"\nFound {len(stocks)} stocks in the cached FinViz fundamentals")
+    return stocks
+
+
+def screen_universe():
+    """Get the stocks to evaluate: every listing with FULL_MARKET, the fundamentals with LOCAL_PRESCREEN, else FinViz's screen"""
+    if FULL_MARKET:
+        return screen_fundamentals(filters={})
+    if LOCAL_PRESCREEN:
+        return screen_fundamentals()
+    return screen_stocks()
+
+
+def prescreen_stocks(stocks, start_date, end_date, close="Close"):
+    """Apply FinViz's technical filters locally to the stocks from screen_fundamentals
+
+    Returns the stocks that pass, with price, change and volume taken from
+    the latest bar since the cached FinViz numbers can be days old, and
+    their bars so they don't have to be read again.
+    """
+    frames = get_cached_stock_data([stock["Ticker"] for stock in stocks], start_date, end_date, refresh=REFRESH_BAR_CACHE)
+    return apply_prescreen(stocks, frames, close)
+
+
+def latest_bar_fields(frames):
+    """Price, Volume and Change of every ticker from its latest bar, for stocks from a FinViz cache that can be days old"""
+    fields = {}
+    for ticker, bars in frames.items():
+        fields[ticker] = {"Price": float(bars.close[-1]), "Volume": float(bars.volume[-1])}
+        if len(bars) > 1:
+            fields[ticker]["Change"] = float(bars.close[-1] / bars.close[-2] - 1)
+    return fields
+
+
+def apply_prescreen(stocks, frames, close="Close"):
+    """The prescreen_stocks part that works on bars that are already loaded"""
+    from conditions import prescreen_frames
+
+    passed = set(prescreen_frames(frames, close))
+    fields = latest_bar_fields({ticker: frames[ticker] for ticker in passed})
+
+    kept = []
+    for stock in stocks:
+        if stock["Ticker"] in passed:
+            kept.append(dict(stock, **fields[stock["Ticker"]]))
+
+    print(f"{len(kept)} of {len(stocks)} stocks passed the technical filters")
+    return kept, {ticker: frames[ticker] for ticker in passed}
+
+
+def evaluate_results(frames, close="Close"):
+    """The six conditions of every ticker in frames, as ticker -> the columns to add to its stock
+
+    With FULL_MARKET the stocks come from a listing cached for up to a week,
+    so their Price, Change and Volume are taken from the latest bar as well.
+    """
+    from conditions import evaluate_frames
+
+    if not frames:
+        return {}
+    results = evaluate_frames(frames, close).to_dict("index")
+    if FULL_MARKET:
+        for ticker, fields in latest_bar_fields(frames).items():
+            results[ticker].update(fields)
+    return results
+
+
+def evaluate_stocks(stocks, frames, close="Close"):
+    """Add the six conditions to every stock we have bars for
+
+    Returns the output DataFrame, or None if no stock could be evaluated.
+    """
+    # Work out all six conditions for every ticker in one pass
+    # Some of these conditions are already checked in Finviz but I'll do a double check here in case the code is updated
+    conditions = evaluate_results(frames, close)
+
+    stock_data = []
+    for i, stock in enumerate(stocks):
         ticker = stock["Ticker"]
-        print(f"\nProcessing {ticker}... ({i+1}/{len(stocks_to_process)})")
-        
-        # Add minimal delay between requests since Alpaca has high rate limits
-        if i > 0:
-            time.sleep(0.1)  # 0.1 second delay between requests
+        print(f"\nProcessing {ticker}... ({i+1}/{len(stocks)})")
 
-        try:
-            # Get stock data using our new function
-            df = get_stock_data(ticker, start, now)
-
-            if df is None:
-                continue
-
-            # Get most recently close (last row in df)
-            currentClose = df[close].iloc[-1]
-
-            # Get SMA for 50, 150, 200 and round to 2 decimals
-            moving_average_50 = round(df.tail(50)[close].mean(), 2)
-            moving_average_150 = round(df.tail(150)[close].mean(), 2)
-            moving_average_200 = round(df.tail(200)[close].mean(), 2)
-
-            # Get the SMA_200 20 trading days ago to check if it's been trending up since
-            moving_average_200_20 = round(df[close][-221:-21].mean(), 2)
-
-            # Go back a year's worth of trading days and get the min/max
-            low_of_52week = round(min(df.tail(255)[close]), 2)
-            high_of_52week = round(max(df.tail(255)[close]), 2)
-
-            # Some of the following conditions are already checked in Finviz but I'll do a double check here in case the code is updated
-            conditions = []
-            # Condition 1: Current Price > 150 SMA and > 200 SMA
-            cond_1 = currentClose > moving_average_150 > moving_average_200
-            conditions.append(cond_1)
-
-            # Condition 2: 200 SMA trending up for at least 1 month (ideally 4-5 months)
-            cond_2 = True if (moving_average_200 > moving_average_200_20) else False
-            conditions.append(cond_2)
-
-            # Condition 3: 50 SMA > 150 SMA and 50 SMA > 200 SMA
-            cond_3 = (
-                True
-                if (moving_average_50 > moving_average_150 > moving_average_200)
-                else False
-            )
-            conditions.append(cond_3)
+        if ticker not in conditions:
+            continue
+
+        # Set values and add to output DataFrame
+        stock.update(conditions[ticker])
+        stock_data.append(stock)
+        print(f"Successfully processed {ticker}")
+
+    return build_output(stock_data)
 
-            # Condition 4: Current Price > 50 SMA
-            cond_4 = True if (currentClose > moving_average_50) else False
-            conditions.append(cond_4)
 
-            # Condition 5: Current Price is at least 30% above 52 week low (Many of the best are up 100-300% before coming out of consolidation)
-            cond_5 = True if (currentClose >= (1.3 * low_of_52week)) else False
-            conditions.append(cond_5)
+def evaluate_in_chunks(stocks, start_date, end_date, close, checkpoint, frames=None):
+    """Fetch and evaluate the stocks a chunk at a time, saving each chunk to the checkpoint
 
-            # Condition 6: Current Price is within 25% of 52 week high
-            cond_6 = True if (currentClose >= (0.75 * high_of_52week)) else False
-            conditions.append(cond_6)
+    Stocks the checkpoint already has are not fetched again. frames can hold
+    bars that are already loaded (from the pre-screen). Returns the same
+    output as evaluate_stocks.
+    """
+    from bar_cache import BarCache
+    from checkpoint import resume
 
-            # count how many conditions are true
-            count = sum(1 for cond in conditions if cond)
+    report = current()
+    tickers = [stock["Ticker"] for stock in stocks]
+    conditions, todo = resume(checkpoint, tickers)
 
-            # Set values and add to output DataFrame
-            stock["cond count"] = count
-            stock["cond 1"] = cond_1
-            stock["cond 2"] = cond_2
-            stock["cond 3"] = cond_3
-            stock["cond 4"] = cond_4
-            stock["cond 5"] = cond_5
-            stock["cond 6"] = cond_6
+    cache = BarCache()
+    for i in range(0, len(todo), BARS_CHUNK_SIZE):
+        chunk = todo[i:i + BARS_CHUNK_SIZE]
+        if frames is not None:
+            chunk_frames = {ticker: frames[ticker] for ticker in chunk if ticker in frames}
+        else:
+            chunk_frames = get_cached_stock_data(chunk, start_date, end_date, refresh=REFRESH_BAR_CACHE, cache=cache, evict=False)
+        report.count("tickers.with_bars", len(chunk_frames))
 
+        result = evaluate_results(chunk_frames, close)
+        checkpoint.add_evaluated(chunk, result)
+        conditions.update(result)
+
+    # make room by dropping the symbols that aren't in the universe anymore
+    if frames is None:
+        report.count("bar_cache.evicted", len(cache.evict(keep=tickers)))
+
+    stock_data = []
+    for stock in stocks:
+        if conditions.get(stock["Ticker"]) is not None:
+            stock.update(conditions[stock["Ticker"]])
             stock_data.append(stock)
-            print(f"Successfully processed {ticker}")
+    return build_output(stock_data)
 
-        except Exception as e:
-            print(f"Error processing {ticker}: {str(e)}")
+
+def build_output(stock_data, condition_columns=None):
+    """Turn the evaluated stocks into the output DataFrame, None if there are none
+
+    condition_columns are the columns of a screen from screens.py, the six conditions by default.
+    """
+    import pandas as pd
 
     if not stock_data:
-        print("\nNo stocks were successfully processed!")
-        return "No stocks were successfully processed"
+        return None
 
     output = pd.DataFrame(stock_data)  # type: ignore
     print(f"\nSuccessfully processed {len(output)} stocks")
 
     # set the type of each column for formatting
-    output = output.astype(
+    if condition_columns is None:
+        condition_columns = ["cond 1", "cond 2", "cond 3", "cond 4", "cond 5", "cond 6"]
+    return output.astype(
         {
             "cond count": "int",
-            "cond 1": "int",
-            "cond 2": "int",
-            "cond 3": "int",
-            "cond 4": "int",
-            "cond 5": "int",
-            "cond 6": "int",
+            **{column: "int" for column in condition_columns},
             "Volume": "int",
             "Market Cap": "int",
         }
     )
 
-    # Add the sharia status to the output
-    for index, row in output.iterrows():
-        if row["cond count"] > 0:
-            ticker = row["Ticker"]
-            sharia = sharia_status(ticker)
-            output.at[index, "Sharia"] = sharia
+
+def load_other_screens(path):
+    """Read the screen definitions in path, checking their names can be told apart from the main screen's sheets"""
+    from screens import load_screens
+
+    screens = load_screens(path)
+    for screen in screens:
+        if "Screener" in screen["name"]:
+            raise ValueError(f"Screen names can't contain \"Screener\", that's the main screen's sheet: {screen['name']!r}")
+    return screens
+
+
+def evaluate_other_screens(stocks, frames, screens, close="Close", statuses=None):
+    """Evaluate the screens from SCREENS_FILE in one pass over the bars
+
+    Returns screen name -> (output, its condition columns) for every screen
+    that evaluated any stock.
+    statuses holds sharia statuses already looked up (the main output's), so
+    only tickers new to a screen are looked up.
+    """
+    from conditions import CONDITION_COLUMNS
+    from screens import evaluate_screens
+
+    outputs = {}
+    for name, table in evaluate_screens(frames, screens, close).items():
+        conditions = table.to_dict("index")
+        stock_data = []
+        for stock in stocks:
+            if stock["Ticker"] in conditions:
+                stock = {key: value for key, value in stock.items() if key not in CONDITION_COLUMNS and key != "Sharia"}
+                stock_data.append(dict(stock, **conditions[stock["Ticker"]]))
+        columns = list(table.columns[1:])
+        output = build_output(stock_data, columns)
+        if output is not None:
+            output = add_sharia_status(output, statuses)
+            if "Sharia" in output:
+                known = output.dropna(subset=["Sharia"])
+                statuses = dict(statuses or {}, **dict(zip(known["Ticker"], known["Sharia"])))
+            outputs[name] = (output, columns)
+    return outputs
+
+
+def add_sharia_status(output, statuses=None, checkpoint=None):
+    """Add the sharia status of every ticker that met a condition, looked up all at once
+
+    statuses can hold results that were already looked up, the rest are fetched.
+    With a checkpoint the statuses it holds are reused and new ones are saved
+    to it a batch at a time.
+    """
+    from aatinaa import sharia_status_many
+
+    candidates = output["cond count"] > 0
+    if candidates.any():
+        statuses = dict(statuses or {})
+        if checkpoint is not None:
+            statuses.update(checkpoint.statuses())
+        missing = [ticker for ticker in output.loc[candidates, "Ticker"] if ticker not in statuses]
+        if missing and checkpoint is not None:
+            for i in range(0, len(missing), COMPLIANCE_CHECKPOINT_BATCH):
+                batch = sharia_status_many(missing[i:i + COMPLIANCE_CHECKPOINT_BATCH])
+                checkpoint.add_statuses(batch)
+                statuses.update(batch)
+        elif missing:
+            statuses.update(sharia_status_many(missing))
+        output.loc[candidates, "Sharia"] = output.loc[candidates, "Ticker"].map(statuses)
+    return output
+
+
+def open_spreadsheet(creds):
+    import gspread
+
+    import rate_limit
+
+    gc = gspread.authorize(creds)
+    # gspread 6 keeps its session on http_client
+    rate_limit.install(getattr(gc, "http_client", gc).session, "sheets")
+    return gc.open("Stock Screener")
+
+
+def read_cached_frames(tickers, start_date, end_date, frames=None):
+    """Get the bars of the tickers from the local bar cache only, starting from frames that are already loaded
+
+    Tickers that aren't cached are left out rather than fetched.
+    """
+    from bar_cache import BarCache
+
+    cache = BarCache()
+    loaded = dict(frames or {})
+    for ticker in tickers:
+        if ticker not in loaded:
+            bars = cache.read_bars(ticker, start_date, end_date)
+            if bars is not None and len(bars):
+                loaded[ticker] = bars
+    return loaded
+
+
+def add_rs_rating(output, frames, close="Close", minimum=RS_CONDITION):
+    """Add the RS rating of every stock, ranked against every ticker in frames
+
+    With a minimum, "cond 7" (RS at least minimum) is added after the six
+    conditions and counted in "cond count".
+    """
+    from conditions import rs_ratings
+
+    output = output.copy()
+    output["RS"] = output["Ticker"].map(rs_ratings(frames, close)).astype("Int64")
+    if minimum:
+        # a ticker without enough history for a rating doesn't meet it
+        met = (output["RS"] >= minimum).fillna(False).astype(int)
+        output.insert(output.columns.get_loc("cond 6") + 1, "cond 7", met)
+        output["cond count"] += met
+    return output
+
+
+def publish_output(gs, output, screen=None, condition_columns=None):
+    """Publish the output to today's screener sheet in one batch update
+
+    screen is the name of another screen from SCREENS_FILE, published to a
+    sheet of its own with its condition_columns hidden.
+    """
+    import pytz
+
+    from sheets import publish
 
     # Round for appearance
     output = output.round({"Volume": 0, "Market Cap": 0, "Price": 2, "Change": 4})
-    col_count = len(output.columns)  # how many columns are in the df
-    # convert col count to column letter in sheet for formatting
-    letter = chr(col_count + 64)
-    first_row = f"A1:{letter}1"  # the range for first row in the sheet
 
     # get New York time to put in the sheet name
     newYorkTz = pytz.timezone("America/New_York")
     timeInNewYork = dt.datetime.now(newYorkTz)
     newYorkTz = timeInNewYork.strftime("%m-%d-%Y")
 
-    # open up the Google Sheets page delete and create a new one
-    gc = gspread.authorize(creds)
-    gs = gc.open("Stock Screener")
-    worksheet_list = gs.worksheets()
-    for sheet in worksheet_list:
-        if "Screener" in sheet.title:
-            sheet = gs.worksheet(sheet.title)
-            gs.del_worksheet(sheet)
-    sheet = gs.add_worksheet(title=f"Screener {newYorkTz}", rows=1, cols=1)
-
-    # Drop in the data from the data frame to the sheet
-    set_with_dataframe(
-        worksheet=sheet,
-        dataframe=output,
-        include_index=False,
-        include_column_header=True,
-        resize=True,
-    )
+    if screen is not None:
+        return publish(
+            gs, output, f"{screen} {newYorkTz}", in_place=UPDATE_SHEET_IN_PLACE, kind=screen,
+            condition_columns=condition_columns,
+        )
+    # the six conditions, and the RS condition when there is one
+    conditions = [column for column in output.columns if column.startswith("cond ") and column != "cond count"]
+    return publish(gs, output, f"Screener {newYorkTz}", in_place=UPDATE_SHEET_IN_PLACE, condition_columns=conditions)
 
-    # Format the header row
-    sheet.format(
-        first_row,
-        {
-            "backgroundColor": {
-                "red": 216 / 255,
-                "green": 229 / 255,
-                "blue": 252 / 255,
-            },
-            "horizontalAlignment": "CENTER",
-            "textFormat": {"fontSize": 12, "bold": True},
-        },
-    )
 
-    # Format cells for their numbers
-    cell = sheet.find("Change")
-    if cell:
-        letter = chr(cell.col + 64)  # convert col num to letter
-        sheet.format(f"{letter}:{letter}", {"numberFormat": {"type": "PERCENT"}})
-
-    cell = sheet.find("Market Cap")
-    if cell:
-        letter = chr(cell.col + 64)  # convert col num to letter
-        sheet.format(
-            f"{letter}:{letter}",
-            {"numberFormat": {"type": "NUMBER", "pattern": '0,,"M"'}},
-        )
+def run_screener(request):
+    report = current()
 
-    cell = sheet.find("Price")
-    if cell:
-        letter = chr(cell.col + 64)  # convert col num to letter
-        sheet.format(f"{letter}:{letter}", {"numberFormat": {"type": "CURRENCY"}})
-
-    cell = sheet.find("Volume")
-    if cell:
-        letter = chr(cell.col + 64)  # convert col num to letter
-        sheet.format(
-            f"{letter}:{letter}",
-            {"numberFormat": {"type": "NUMBER", "pattern": '0.0,,"M"'}},
-        )
+    with report.stage("credentials"):
+        creds = get_sheets_credentials(request)
 
-    # Sort and Filter. Filter out to only show the ones that met all 6 conditions, and sort by Volume
-
-    # Here we identify the 3 different columns we need to filter and sort by
-    cond_count_cell = sheet.find("cond count")
-    if cond_count_cell:
-        cond_count_cell = cond_count_cell.col
-
-    vol_cell = sheet.find("Volume")
-    if vol_cell:
-        vol_cell = vol_cell.col
-
-    sharia_cell = sheet.find("Sharia")
-    if sharia_cell:
-        sharia_cell = sharia_cell.col
-
-    if vol_cell and cond_count_cell and sharia_cell:
-        filterSettings = {
-            "range": {"sheetId": sheet.id},
-            "filterSpecs": [
-                {
-                    "filterCriteria": {"hiddenValues": ["0,", "1", "2", "3", "4", "5"]},
-                    "columnIndex": cond_count_cell - 1,
-                },
-                {
-                    "filterCriteria": {"hiddenValues": ["FAILED"]},
-                    "columnIndex": sharia_cell - 1,
-                },
-            ],
-            "sortSpecs": [
-                {
-                    "sortOrder": "DESCENDING",
-                    "dimensionIndex": vol_cell - 1,
-                }
-            ],
-        }
+    # read the other screens first so a bad definition fails before anything is fetched
+    screens = load_other_screens(SCREENS_FILE) if SCREENS_FILE else None
+
+    # a new instance starts with an empty /tmp, so the bars cached by the last run come from the store
+    restore_bar_cache()
+
+    # we need to get roughly a year's worth of data to evaluate a stock for all the metrics
+    now = dt.datetime.now()
+    start = now - dt.timedelta(days=400)
+
+    # Choose either Adjusted Close or Regular Close
+    closing_types = ["Adj Close", "Close"]
+    close = closing_types[0] if ADJUSTED_CLOSE else closing_types[1]
+
+    checkpoint = None
+    if CHECKPOINTS:
+        import pytz
+
+        from checkpoint import open_checkpoint
+
+        # keyed by the New York date like the sheet, so a retry the same day resumes
+        checkpoint = open_checkpoint(dt.datetime.now(pytz.timezone("America/New_York")).date())
+
+    # a retried run starts from the universe the last one screened
+    frames = None
+    stocks_to_process = checkpoint.load("universe") if checkpoint else None
+    if stocks_to_process is not None:
+        print(f"Resuming the {checkpoint.run_key} run with {len(stocks_to_process)} stocks")
+        report.set(resumed=True)
+        # the tickers from before the pre-screen, which RS is ranked against
+        screened = checkpoint.load("screened") or [stock["Ticker"] for stock in stocks_to_process]
+        if ADJUSTED_CLOSE:
+            sync_corporate_actions(stocks_to_process, start, now)
+    else:
+        with report.stage("screen"):
+            stocks = screen_universe()
+        if stocks is None:
+            return "We couldn't get the stocks from FinViz"
+        screened = [stock["Ticker"] for stock in stocks]
+
+        # For testing, you can limit the number of stocks processed
+        # Set to None to process all stocks, or set to a number (e.g., 5) for testing
+        MAX_STOCKS_TO_PROCESS = None  # Process all stocks
+
+        stocks_to_process = stocks[:MAX_STOCKS_TO_PROCESS] if MAX_STOCKS_TO_PROCESS else stocks
+        print(f"Processing {len(stocks_to_process)} stocks (out of {len(stocks)} total)")
 
-        gs.batch_update({"requests": [{"setBasicFilter": {"filter": filterSettings}}]})
-        sheet.columns_auto_resize(0, col_count)  # resize the columns
+        # before any bars are read so they come back with today's factors
+        if ADJUSTED_CLOSE:
+            sync_corporate_actions(stocks_to_process, start, now)
 
-    # hide the conditions columns (we have 6 of them)
-    # we added the sharia column at the end so hide the 6 before it
-    sheet.hide_columns(col_count - 7, col_count - 1)
+        # in shards every shard pre-screens its own stocks
+        if LOCAL_PRESCREEN and SCREENER_SHARDS <= 1:
+            report.count("tickers.fundamentals", len(stocks_to_process))
+            with report.stage("prescreen"):
+                stocks_to_process, frames = prescreen_stocks(stocks_to_process, start, now, close)
+
+        if checkpoint is not None:
+            # the universe last, a retry only resumes once it is there
+            checkpoint.save("screened", screened)
+            checkpoint.save("universe", stocks_to_process)
+
+    # Get the bars for every ticker, only fetching what the local bar cache is missing
+    tickers = [stock["Ticker"] for stock in stocks_to_process]
+    report.count("tickers.screened", len(tickers))
+
+    if SCREENER_SHARDS > 1:
+        from shards import run_sharded
+
+        # fetch and evaluate run in one process per shard, compliance looks up all of them at once
+        with report.stage("sharded"):
+            output = run_sharded(
+                stocks_to_process, start, now, close, shards=SCREENER_SHARDS, workers=SCREENER_SHARDS,
+                refresh=REFRESH_BAR_CACHE, prescreen=LOCAL_PRESCREEN, checkpoint=checkpoint,
+            )
+
+        if output is not None:
+            with report.stage("compliance"):
+                output = add_sharia_status(output, checkpoint=checkpoint)
+    elif STREAMING_PIPELINE:
+        from pipeline import run_pipeline
+
+        # fetch, evaluate and compliance overlap so they are timed as one stage
+        with report.stage("pipeline"):
+            # a refresh already happened in the pre-screen if there was one
+            refresh = REFRESH_BAR_CACHE and not LOCAL_PRESCREEN
+            output = run_pipeline(stocks_to_process, start, now, close, refresh=refresh, checkpoint=checkpoint)
+    elif checkpoint is not None:
+        # fetched and evaluated a chunk at a time so every chunk is saved as it is done
+        with report.stage("fetch_evaluate"):
+            output = evaluate_in_chunks(stocks_to_process, start, now, close, checkpoint, frames)
+
+        if output is not None:
+            with report.stage("compliance"):
+                output = add_sharia_status(output, checkpoint=checkpoint)
+    else:
+        # the pre-screen already has the bars of every stock that passed it
+        if frames is None:
+            with report.stage("fetch"):
+                frames = get_cached_stock_data(tickers, start, now, refresh=REFRESH_BAR_CACHE)
+        report.count("tickers.with_bars", len(frames))
+
+        with report.stage("evaluate"):
+            output = evaluate_stocks(stocks_to_process, frames, close)
+
+        if output is not None:
+            with report.stage("compliance"):
+                output = add_sharia_status(output)
+
+    if output is None:
+        print("\nNo stocks were successfully processed!")
+        return "No stocks were successfully processed"
+
+    report.count("tickers.evaluated", len(output))
+    report.count("tickers.passed_all_6", int((output["cond count"] == 6).sum()))
+
+    if RS_RATING or RS_CONDITION:
+        # ranked against the whole screened universe, before the pre-screen, from bars that are cached by now
+        with report.stage("rs"):
+            frames = read_cached_frames(screened, start, now, frames)
+            output = add_rs_rating(output, frames, close)
+        report.count("tickers.rs_ranked", len(frames))
+
+    # the six conditions, and the RS condition when there is one
+    conditions = 7 if "cond 7" in output else 6
+
+    history = None
+    if RESULT_HISTORY:
+        import pytz
+
+        from history import ResultHistory, annotate
+
+        # after RS so cond 7 is kept too, one session per New York date like the sheet,
+        # a second run that day replaces the first
+        with report.stage("history"):
+            history = ResultHistory()
+            history.append(dt.datetime.now(pytz.timezone("America/New_York")).date(), output)
+            output = annotate(output, history, conditions)
+
+    other_outputs = {}
+    if screens:
+        # the same stocks as the main screen, their bars are all in the local cache by now
+        with report.stage("other_screens"):
+            evaluated = set(output["Ticker"])
+            others = [stock for stock in stocks_to_process if stock["Ticker"] in evaluated]
+            if frames is None:
+                # only the evaluated part of the universe, the rest stays cached
+                frames = get_cached_stock_data(list(evaluated), start, now, evict=False)
+            known = output.dropna(subset=["Sharia"]) if "Sharia" in output else output.iloc[:0]
+            statuses = dict(zip(known["Ticker"], known["Sharia"]))
+            other_outputs = evaluate_other_screens(others, frames, screens, close, statuses)
+        report.count("screens", len(screens))
+
+    if TELEGRAM_SUMMARY:
+        from telegram import notifier
+
+        # queued so it goes out while the sheet is being published
+        passed = output.loc[output["cond count"] == conditions, "Ticker"].tolist()
+        summary = f"Screener: {len(passed)} of {len(output)} passed all {conditions}\n" + ", ".join(passed)
+        if history is not None:
+            summary += f"\nNew: {', '.join(sorted(history.entered(1, conditions))) or '-'}"
+            summary += f"\nDropped: {', '.join(sorted(history.dropped(1, conditions))) or '-'}"
+        notifier().send(summary)
+
+    # every lookup is done, the statuses are written back to the store once
+    save_sharia_cache()
+
+    # open up the Google Sheets page and publish everything in one batch update
+    with report.stage("publish"):
+        gs = open_spreadsheet(creds)
+        publish_output(gs, output)
+        for name, (screen_output, condition_columns) in other_outputs.items():
+            publish_output(gs, screen_output, name, condition_columns)
+
+    # the intraday screen starts tomorrow from where today's bars leave every ticker
+    save_indicator_states(screened, now)
+    save_bar_cache()
+
+    # the run is done, the next one starts from scratch
+    if checkpoint is not None:
+        checkpoint.clear()
+
+    if TELEGRAM_SUMMARY:
+        # the function can be frozen once it returns so don't leave the message behind
+        with report.stage("notify"):
+            notifier().flush(timeout=30)
     return "Yay Stocks!"
 
 
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
+
 # running locally to test
 if __name__ == "__main__":
     import tracemalloc
@@ -0,0 +1,172 @@
+# Description: Streaming screener pipeline
+# Runs fetching, evaluation and the sharia lookups at the same time instead
+# of one after the other. Each stage is a thread connected to the next by a
+# bounded queue: bars are fetched a chunk at a time, each chunk is evaluated
+# as soon as it arrives and its tickers that met a condition go straight to
+# the compliance lookup. Only a few chunks of bars are ever held in memory.
+
+import queue
+import threading
+import time
+
+from telemetry import current
+
+# How many chunks of bars can wait for evaluation before fetching pauses
+QUEUE_SIZE = 4
+
+# How many tickers are looked up in one compliance request
+COMPLIANCE_BATCH = 20
+COMPLIANCE_WORKERS = 2
+
+# Put on a queue when the stage feeding it is finished
+_DONE = object()
+
+
+class _Stage(threading.Thread):
+    """A pipeline stage thread that keeps the exception it died with"""
+
+    def __init__(self, name, target, failed):
+        super().__init__(name=name, daemon=True)
+        self._target_fn = target
+        self.failed = failed
+        self.error = None
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            self._target_fn()
+        except BaseException as e:
+            self.error = e
+            self.failed.set()
+        finally:
+            current().count(f"pipeline.{self.name}_seconds", round(time.perf_counter() - started, 4))
+
+
+def _put(q, item, failed):
+    """Put on a bounded queue without blocking forever if another stage failed"""
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, failed):
+    while True:
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            if failed.is_set():
+                return _DONE
+
+
+def run_pipeline(stocks, start_date, end_date, close="Close", chunk_size=None, cache=None, refresh=False,
+                 queue_size=QUEUE_SIZE, compliance_batch=COMPLIANCE_BATCH, compliance_workers=COMPLIANCE_WORKERS,
+                 checkpoint=None):
+    """Fetch, evaluate and look up the sharia status of every stock with the stages overlapping
+
+    Returns the same output DataFrame as evaluate_stocks followed by
+    add_sharia_status, or None if no stock could be evaluated. With a
+    checkpoint, stocks it already has are skipped and every evaluated chunk
+    and compliance batch is saved to it.
+    """
+    import main
+    from aatinaa import sharia_status_many
+    from bar_cache import BarCache
+    from checkpoint import resume
+
+    chunk_size = chunk_size or main.BARS_CHUNK_SIZE
+    cache = cache or BarCache()
+    tickers = [stock["Ticker"] for stock in stocks]
+    by_ticker = {stock["Ticker"]: stock for stock in stocks}
+
+    frames_queue = queue.Queue(maxsize=queue_size)
+    compliance_queue = queue.Queue(maxsize=queue_size * compliance_workers)
+    failed = threading.Event()
+
+    evaluated = set()
+    statuses = {}
+    statuses_lock = threading.Lock()
+
+    # pick up what a run that stopped part way already did
+    done, todo = resume(checkpoint, tickers)
+    for ticker, conditions in done.items():
+        by_ticker[ticker].update(conditions)
+        evaluated.add(ticker)
+
+    def fetch():
+        try:
+            for i in range(0, len(todo), chunk_size):
+                chunk = todo[i:i + chunk_size]
+                frames = main.get_cached_stock_data(chunk, start_date, end_date, refresh=refresh, cache=cache, evict=False)
+                if not _put(frames_queue, (chunk, frames), failed):
+                    return
+        finally:
+            _put(frames_queue, _DONE, failed)
+
+    def evaluate():
+        pending = []
+        try:
+            while True:
+                item = _get(frames_queue, failed)
+                if item is _DONE:
+                    break
+                chunk, frames = item
+
+                results = main.evaluate_results(frames, close)
+                if checkpoint is not None:
+                    checkpoint.add_evaluated(chunk, results)
+                for ticker, conditions in results.items():
+                    by_ticker[ticker].update(conditions)
+                    evaluated.add(ticker)
+                    if conditions["cond count"] > 0:
+                        pending.append(ticker)
+
+                # the bars aren't needed anymore once the chunk is evaluated
+                del frames
+
+                while len(pending) >= compliance_batch:
+                    if not _put(compliance_queue, pending[:compliance_batch], failed):
+                        return
+                    pending = pending[compliance_batch:]
+
+            if pending:
+                _put(compliance_queue, pending, failed)
+        finally:
+            for _ in range(compliance_workers):
+                _put(compliance_queue, _DONE, failed)
+
+    def compliance():
+        while True:
+            batch = _get(compliance_queue, failed)
+            if batch is _DONE:
+                break
+            # one batch is one GraphQL request, so run it on this thread
+            result = sharia_status_many(batch, batch_size=len(batch), max_workers=1)
+            if checkpoint is not None:
+                checkpoint.add_statuses(result)
+            with statuses_lock:
+                statuses.update(result)
+
+    stages = [_Stage("fetch", fetch, failed), _Stage("evaluate", evaluate, failed)]
+    stages += [_Stage("compliance", compliance, failed) for _ in range(compliance_workers)]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+    # make room by dropping the symbols that aren't in the universe anymore
+    current().count("bar_cache.evicted", len(cache.evict(keep=tickers)))
+
+    # keep the order the stocks came from FinViz in
+    output = main.build_output([stock for stock in stocks if stock["Ticker"] in evaluated])
+    if output is None:
+        return None
+    # tickers evaluated before a restart that are still missing a status are looked up here
+    return main.add_sharia_status(output, statuses, checkpoint)
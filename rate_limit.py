@@ -0,0 +1,250 @@
+# Description: Shared rate limiting for the upstream APIs
+# One token bucket per upstream (alpaca, aatinaa, telegram, binance, sheets)
+# shared by every thread and coroutine that calls it. A bucket starts at the
+# provider's published rate and then follows what the provider says: the
+# rate limit headers it sends back, Retry-After on a 429, and a halved rate
+# after every 429 that creeps back up as requests succeed again. Retries
+# wait with exponential backoff and jitter so threads don't retry in step.
+
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+from telemetry import current
+
+# Requests (Binance: request weight) per minute each upstream allows,
+# override with RATE_LIMIT_<NAME>, 0 turns the limit off
+RATES = {
+    "alpaca": 200,  # free data plan
+    "aatinaa": 300,
+    "telegram": 1800,  # 30 messages a second across all chats, telegram.py also paces each chat
+    "binance": 1200,
+    "sheets": 60,  # write requests per user
+}
+DEFAULT_RATE = 60
+
+# Responses that mean "slow down and try again"
+RETRY_STATUSES = (418, 429, 503)
+MAX_RETRIES = 3
+
+# Backoff starts at BASE_BACKOFF seconds and doubles each attempt up to MAX_BACKOFF.
+# A server asking us to wait longer than MAX_BACKOFF gets its response back instead
+# of hanging the run.
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 60
+
+# A 429 never drops the rate below this fraction of the allowed rate
+MIN_RATE_FRACTION = 1 / 16
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(headers):
+    """Seconds a Retry-After header asks for, it can be a number or an HTTP date"""
+    value = (headers or {}).get("Retry-After")
+    if value is None:
+        return None
+    seconds = _number(value)
+    if seconds is not None:
+        return max(0.0, seconds)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def status_of(error):
+    """The HTTP status behind an exception from requests or the Alpaca SDK, if any"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Exponential backoff with jitter for the given attempt (0 based), or Retry-After if longer"""
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class RateLimiter:
+    """A token bucket that can be shared by threads and asyncio tasks"""
+
+    def __init__(self, name, per_minute):
+        self.name = name
+        self._lock = threading.Lock()
+        self.set_rate(per_minute)
+
+    def set_rate(self, per_minute):
+        """Change the allowed rate, None or 0 turns the limit off"""
+        with self._lock:
+            self.max_rate = per_minute / 60 if per_minute else None
+            self.rate = self.max_rate
+            # allow up to a second's worth of requests at once
+            self.burst = max(1.0, self.max_rate or 1.0)
+            self.tokens = self.burst
+            self.updated = time.monotonic()
+            self.blocked_until = 0.0
+
+    def _reserve(self, cost):
+        """Take cost tokens and return how long the caller has to wait before using them"""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.rate is None:
+                return wait
+
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            # tokens can go negative, that's the queue of callers already waiting
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def acquire(self, cost=1):
+        """Block until cost requests can be made"""
+        wait = self._reserve(cost)
+        if wait > 0:
+            current().count(f"rate_limit.{self.name}.wait_seconds", round(wait, 4))
+            time.sleep(wait)
+
+    async def acquire_async(self, cost=1):
+        """Like acquire but waits without blocking the event loop"""
+        wait = self._reserve(cost)
+        if wait > 0:
+            current().count(f"rate_limit.{self.name}.wait_seconds", round(wait, 4))
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold every caller of this upstream for the given seconds"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def observe(self, status, headers=None, attempt=0, wait=None):
+        """Adjust to a response, returns True if the request should be retried
+
+        wait is how long the server asked us to wait when it says so outside
+        the Retry-After header (Telegram puts it in the body).
+        """
+        headers = headers or {}
+        self._follow_headers(headers)
+
+        if status not in RETRY_STATUSES:
+            if 200 <= status < 300 and self.rate is not None:
+                # additive increase back up to the allowed rate
+                with self._lock:
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            return False
+
+        wait = wait if wait is not None else retry_after(headers)
+        current().event("rate_limited", upstream=self.name, status=status, attempt=attempt + 1, retry_after=wait)
+        if self.rate is not None:
+            with self._lock:
+                self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+
+        if wait is not None and wait > MAX_BACKOFF:
+            return False
+        self.pause(backoff_delay(attempt, wait))
+        return attempt < MAX_RETRIES
+
+    def _follow_headers(self, headers):
+        # Alpaca: X-RateLimit-Limit per minute, X-RateLimit-Remaining, X-RateLimit-Reset as epoch seconds
+        limit = _number(headers.get("X-RateLimit-Limit"))
+        remaining = _number(headers.get("X-RateLimit-Remaining"))
+        reset = _number(headers.get("X-RateLimit-Reset"))
+        # Binance: the request weight used in the current minute
+        used_weight = _number(headers.get("X-MBX-USED-WEIGHT-1M"))
+
+        with self._lock:
+            if self.rate is None:
+                return
+            if limit:
+                self.max_rate = limit / 60
+                self.burst = max(1.0, self.max_rate)
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+                if remaining <= 0 and reset:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + max(0.0, reset - time.time()))
+            if used_weight is not None and used_weight >= self.max_rate * 60:
+                # the weight resets at the start of the next minute
+                self.blocked_until = max(self.blocked_until, time.monotonic() + 60 - time.time() % 60)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """A requests adapter that waits for the limiter before every request and retries 429s
+
+    cost turns a request into the number of tokens it uses (Binance weighs
+    endpoints differently), every request costs 1 without it.
+    """
+
+    def __init__(self, limiter, cost=None, **kwargs):
+        self.limiter = limiter
+        self.cost = cost
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        cost = self.cost(request) if self.cost else 1
+        attempt = 0
+        while True:
+            self.limiter.acquire(cost)
+            response = super().send(request, **kwargs)
+            if not self.limiter.observe(response.status_code, response.headers, attempt):
+                return response
+            response.close()
+            attempt += 1
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(name, per_minute=DEFAULT_RATE):
+    """The shared limiter for an upstream, created on first use
+
+    per_minute is the rate of a limiter that isn't in RATES.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            rate = _number(os.getenv(f"RATE_LIMIT_{name.upper()}"))
+            if rate is None:
+                rate = RATES.get(name, per_minute)
+            _limiters[name] = RateLimiter(name, rate)
+        return _limiters[name]
+
+
+def set_rate(name, per_minute):
+    """Change the allowed rate of an upstream, None or 0 turns its limit off"""
+    limiter(name).set_rate(per_minute)
+
+
+def install(session, name, **adapter_kwargs):
+    """Route every request of a requests Session through the limiter of an upstream"""
+    adapter = RateLimitedAdapter(limiter(name), **adapter_kwargs)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def install_client(client, name):
+    """Route every request of an Alpaca SDK client through the limiter of an upstream
+
+    The SDK has no public hook for this, so its private session gets the
+    adapter and its own retries (a fixed 3 second wait on 429) are turned off.
+    The adapter already retries 429s with backoff, both would multiply.
+    """
+    install(client._session, name)
+    client._retry = 0
+    return client
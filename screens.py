@@ -0,0 +1,213 @@
+# Description: Screen definitions compiled to vectorized evaluators
+# A screen is a name and a list of conditions, each condition one or more
+# comparisons that all have to hold:
+#
+#   {
+#       "name": "Tight",
+#       "conditions": {
+#           "near high": "close >= 0.9 * 52 week high",
+#           "trend": ["close > sma 50", "sma 50 > sma 200", "sma 200 > sma 200 20"],
+#       },
+#   }
+#
+# Each side of a comparison is a number, an indicator or a number times an
+# indicator. The indicators are:
+#   close               the latest close
+#   sma N               simple moving average of the last N closes
+#   sma N D             the same SMA as it was D bars ago, leaving out the last D closes
+#   N day low/high      lowest/highest close of the last N trading days
+#   52 week low/high    the same over a year of trading days (conditions.LOOKBACK)
+#
+# Any number of screens compile into one evaluator. The closes are stacked
+# into one panel, and every indicator and comparison is worked out once however
+# many screens use it. Each screen then gets the same table evaluate_frames
+# gives: a "cond count" column and one column per condition, indexed by ticker.
+#
+# Screens can also be kept in a JSON file holding a list of them (SCREENS_FILE in main.py).
+
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+from conditions import LOOKBACK, _window_mean, build_close_panel
+
+# The six conditions in conditions.py as a screen definition
+MINERVINI = {
+    "name": "Screener",
+    "conditions": {
+        # Current Price > 150 SMA and > 200 SMA
+        "cond 1": ["close > sma 150", "sma 150 > sma 200"],
+        # 200 SMA trending up for at least 1 month (conditions.py's "sma 200 20" ends 21 bars back)
+        "cond 2": "sma 200 > sma 200 21",
+        # 50 SMA > 150 SMA and 50 SMA > 200 SMA
+        "cond 3": ["sma 50 > sma 150", "sma 150 > sma 200"],
+        # Current Price > 50 SMA
+        "cond 4": "close > sma 50",
+        # Current Price is at least 30% above 52 week low
+        "cond 5": "close >= 1.3 * 52 week low",
+        # Current Price is within 25% of 52 week high
+        "cond 6": "close >= 0.75 * 52 week high",
+    },
+}
+
+OPERATORS = {
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+}
+
+_NUMBER = r"\d+(?:\.\d+)?"
+_COMPARISON = re.compile(r"^\s*(.+?)\s*(>=|<=|>|<)\s*(.+?)\s*$")
+_TERM = re.compile(rf"^(?:({_NUMBER})\s*\*\s*)?(.+)$")
+_SMA = re.compile(r"^sma (\d+)(?: (\d+))?$")
+_EXTREME = re.compile(r"^(?:(\d+) day|(52) week) (low|high)$")
+
+
+def parse_indicator(name):
+    """Turn an indicator name into a key shared by every name for the same series
+
+    ("close",), ("sma", window, days_ago) or ("low"/"high", window), raises
+    ValueError for a name that isn't one of the indicators above.
+    """
+    name = " ".join(name.lower().split())
+    if name == "close":
+        return ("close",)
+    match = _SMA.match(name)
+    if match:
+        window, days_ago = int(match.group(1)), int(match.group(2) or 0)
+        if window:
+            return ("sma", window, days_ago)
+    match = _EXTREME.match(name)
+    if match:
+        window = LOOKBACK if match.group(2) else int(match.group(1))
+        if window:
+            return (match.group(3), window)
+    raise ValueError(f"Unknown indicator: {name!r}")
+
+
+def parse_term(text):
+    """A side of a comparison as (factor, indicator key), indicator key is None for a plain number"""
+    text = text.strip()
+    if re.fullmatch(_NUMBER, text):
+        return (float(text), None)
+    factor, name = _TERM.match(text).groups()
+    return (float(factor) if factor else 1.0, parse_indicator(name))
+
+
+def parse_comparison(text):
+    """Parse "left op right" into (left term, operator, right term)"""
+    match = _COMPARISON.match(text)
+    if not match:
+        raise ValueError(f"Not a comparison: {text!r}")
+    left, operator, right = match.groups()
+    return (parse_term(left), operator, parse_term(right))
+
+
+def _depth(key):
+    """How many closes an indicator needs"""
+    if key[0] == "close":
+        return 1
+    if key[0] == "sma":
+        return key[1] + key[2]
+    return key[1]
+
+
+def compute_indicator(panel, key):
+    """One indicator for every row of the panel, rounded the way compute_indicators rounds it"""
+    if key[0] == "close":
+        return panel[:, -1]
+    if key[0] == "sma":
+        _, window, days_ago = key
+        return np.round(_window_mean(panel, -(window + days_ago), -days_ago or None), 2)
+
+    kind, window = key
+    values = panel[:, -window:]
+    valid = ~np.isnan(values)
+    if kind == "low":
+        extreme = np.where(valid, values, np.inf).min(axis=1)
+    else:
+        extreme = np.where(valid, values, -np.inf).max(axis=1)
+    return np.round(np.where(valid.any(axis=1), extreme, np.nan), 2)
+
+
+class CompiledScreens:
+    """Several screens compiled to work on one close panel, build it with compile_screens"""
+
+    def __init__(self, screens):
+        self.screens = []
+        self.comparisons = {}  # parsed comparison -> its position in the comparison matrix
+        for screen in screens:
+            conditions = screen.get("conditions")
+            if not screen.get("name") or not conditions:
+                raise ValueError(f"A screen needs a name and at least one condition: {screen!r}")
+            compiled = []
+            for condition, comparisons in conditions.items():
+                if isinstance(comparisons, str):
+                    comparisons = [comparisons]
+                positions = [self.comparisons.setdefault(parse_comparison(text), len(self.comparisons)) for text in comparisons]
+                compiled.append((condition, positions))
+            self.screens.append((screen["name"], compiled))
+
+        names = [name for name, _ in self.screens]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Screen names have to be unique: {names}")
+
+        self.indicators = sorted(
+            {term[1] for comparison in self.comparisons for term in (comparison[0], comparison[2]) if term[1]}
+        )
+        self.depth = max([LOOKBACK] + [_depth(key) for key in self.indicators])
+
+    def evaluate_panel(self, panel):
+        """Every screen's conditions for the rows of the panel, name -> (condition names, flags, count)"""
+        values = {key: compute_indicator(panel, key) for key in self.indicators}
+
+        def side(term):
+            factor, key = term
+            if key is None:
+                return factor
+            return values[key] if factor == 1.0 else factor * values[key]
+
+        # one row per comparison, shared by every condition and screen that uses it
+        matrix = np.empty((len(self.comparisons), len(panel)), dtype=bool)
+        with np.errstate(invalid="ignore"):
+            for (left, operator, right), position in self.comparisons.items():
+                matrix[position] = OPERATORS[operator](side(left), side(right))
+
+        results = {}
+        for name, conditions in self.screens:
+            flags = np.stack([matrix[positions].all(axis=0) for _, positions in conditions], axis=1)
+            results[name] = ([condition for condition, _ in conditions], flags, flags.sum(axis=1))
+        return results
+
+    def evaluate(self, frames, close="Close"):
+        """Evaluate every screen for a dict of ticker -> bars, returns screen name -> table indexed by ticker"""
+        tickers, panel = build_close_panel(frames, close, self.depth)
+        tables = {}
+        for name, (columns, flags, count) in self.evaluate_panel(panel).items():
+            table = pd.DataFrame(flags, index=tickers, columns=columns)
+            table.insert(0, "cond count", count.astype(int))
+            tables[name] = table
+        return tables
+
+
+def compile_screens(screens):
+    """Compile screen definitions into one evaluator, raises ValueError for a definition it can't read"""
+    return CompiledScreens(screens)
+
+
+def evaluate_screens(frames, screens, close="Close"):
+    """Evaluate screen definitions in one pass over the bars, returns screen name -> table indexed by ticker"""
+    return compile_screens(screens).evaluate(frames, close)
+
+
+def load_screens(path):
+    """Read a JSON file holding a list of screen definitions"""
+    with open(path) as f:
+        screens = json.load(f)
+    if isinstance(screens, dict):
+        screens = [screens]
+    compile_screens(screens)  # fail on a bad definition now rather than after the bars are fetched
+    return screens
@@ -0,0 +1,105 @@
+# Description: Shared secrets
+# One Secret Manager client for main, telegram and binance, created on first
+# use, with fetched secrets cached for a while. For local and offline runs a
+# secret can come from an environment variable or a JSON file instead.
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# This is set upon gcloud deployment
+PROJECT_ID = os.getenv("MY_PROJECT_ID")
+
+# How long a fetched secret is reused before asking Secret Manager again
+CACHE_TTL = int(os.getenv("SECRET_CACHE_TTL", 60 * 60))
+
+# A JSON file of secret name -> value used instead of Secret Manager
+SECRETS_FILE = os.getenv("SECRETS_FILE")
+
+# SECRET_TELEGRAM_BOT_TOKEN overrides the telegram_bot_token secret and so on
+ENV_PREFIX = "SECRET_"
+
+_client = None
+_client_lock = threading.Lock()
+_cache = {}  # secret name -> (time fetched, value)
+_file_secrets = None
+
+
+def _get_client():
+    """Create the Secret Manager client on first use, shared by every thread"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            from google.cloud import secretmanager
+
+            _client = secretmanager.SecretManagerServiceClient()
+    return _client
+
+
+def _local_secret(secret_name):
+    """Look for a stand-in for the secret in the environment or the secrets file"""
+    global _file_secrets
+    value = os.getenv(ENV_PREFIX + secret_name.upper())
+    if value is not None:
+        return value
+
+    if SECRETS_FILE:
+        if _file_secrets is None:
+            with open(SECRETS_FILE) as f:
+                _file_secrets = json.load(f)
+        value = _file_secrets.get(secret_name)
+        # a secret that is a file (like the service account) can be kept as an object
+        if value is not None and not isinstance(value, str):
+            value = json.dumps(value)
+    return value
+
+
+def _fetch(secret_name):
+    value = _local_secret(secret_name)
+    if value is None:
+        name = f"projects/{PROJECT_ID}/secrets/{secret_name}/versions/latest"
+        response = _get_client().access_secret_version(name=name)
+        value = response.payload.data.decode("UTF-8")
+    _cache[secret_name] = (time.time(), value)
+    return value
+
+
+def get_secret(secret_name: str, parse_json=False):
+    """Get a secret, from the cache if it was fetched less than CACHE_TTL seconds ago
+
+    With parse_json a secret holding JSON (like a service account file) is
+    returned as a dict, anything else is returned as a string.
+    """
+    cached = _cache.get(secret_name)
+    if cached and time.time() - cached[0] < CACHE_TTL:
+        value = cached[1]
+    else:
+        value = _fetch(secret_name)
+
+    if parse_json:
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def get_secrets(secret_names, parse_json=False):
+    """Get several secrets at once, fetching the ones that aren't cached concurrently
+
+    Returns a dict of secret name -> value. A secret that can't be fetched
+    raises, same as get_secret.
+    """
+    secret_names = list(dict.fromkeys(secret_names))
+    with ThreadPoolExecutor(max_workers=max(len(secret_names), 1)) as executor:
+        values = executor.map(lambda name: get_secret(name, parse_json), secret_names)
+        return dict(zip(secret_names, values))
+
+
+def clear_cache():
+    """Forget every fetched secret so the next call asks again"""
+    global _file_secrets
+    _cache.clear()
+    _file_secrets = None
@@ -0,0 +1,218 @@
+# Description: Sharded screening across processes
+# Splits the universe into N shards by a hash of the ticker, so a ticker is
+# always in the same shard, and fetches and evaluates every shard in its own
+# process. The partial results are merged back, in the order the stocks came
+# in, into the same output DataFrame evaluate_stocks builds. Compliance and
+# publishing stay in the calling process.
+#
+# Shards can also run as separate invocations that share a result directory:
+#   python shards.py prepare --dir /tmp/run --shards 4   # screen and split the universe
+#   python shards.py run --dir /tmp/run --shard 0        # once per shard, anywhere
+#   python shards.py merge --dir /tmp/run                # once every shard is done, publishes
+
+import argparse
+import datetime as dt
+import json
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from checkpoint import resume
+from storage import atomic_write
+from telemetry import current, start_run
+
+UNIVERSE_FILE = "universe.json"
+
+
+def shard_of(ticker, shards):
+    # crc32 rather than hash() so every process and every run agrees
+    return zlib.crc32(ticker.encode()) % shards
+
+
+def split(stocks, shards):
+    """Split the stocks into shards, keeping their order within each shard"""
+    parts = [[] for _ in range(shards)]
+    for stock in stocks:
+        parts[shard_of(stock["Ticker"], shards)].append(stock)
+    return parts
+
+
+def evaluate_shard(stocks, start_date, end_date, close="Close", refresh=False, prescreen=False, cache_dir=None,
+                   alpaca_rate=None):
+    """Fetch and evaluate one shard in a process of its own
+
+    Returns the evaluated stocks as a list of dicts and the shard's run report
+    as a dict, for the calling process to merge into its own. With prescreen
+    the stocks go through main.apply_prescreen first, like they do with
+    LOCAL_PRESCREEN.
+    """
+    import main
+    import rate_limit
+    from bar_cache import BarCache
+
+    # the counters of this process would be lost with it, so they go back with the rows
+    report = start_run("shard")
+
+    # every process has its own limiter, so each gets its share of the Alpaca rate
+    if alpaca_rate is not None:
+        rate_limit.set_rate("alpaca", alpaca_rate)
+
+    cache = BarCache(cache_dir) if cache_dir else BarCache()
+    frames = main.get_cached_stock_data(
+        [stock["Ticker"] for stock in stocks], start_date, end_date, refresh=refresh, cache=cache, evict=False
+    )
+    if prescreen:
+        stocks, frames = main.apply_prescreen(stocks, frames, close)
+
+    conditions = main.evaluate_results(frames, close)
+    rows = [dict(stock, **conditions[stock["Ticker"]]) for stock in stocks if stock["Ticker"] in conditions]
+    return rows, report.to_dict()
+
+
+def merge(stocks, parts):
+    """Merge the evaluated stocks of every shard into the output DataFrame, in the order of stocks"""
+    import main
+
+    evaluated = {}
+    for part in parts:
+        evaluated.update((stock["Ticker"], stock) for stock in part)
+    return main.build_output([evaluated[stock["Ticker"]] for stock in stocks if stock["Ticker"] in evaluated])
+
+
+def _alpaca_share(workers):
+    import rate_limit
+
+    per_second = rate_limit.limiter("alpaca").max_rate
+    return per_second * 60 / workers if per_second else None
+
+
+def run_sharded(stocks, start_date, end_date, close="Close", shards=None, workers=None, refresh=False,
+                prescreen=False, checkpoint=None, cache_dir=None, initializer=None, initargs=()):
+    """Evaluate the stocks in shards on a process pool, returns the same output as evaluate_stocks
+
+    shards defaults to the number of workers, which defaults to the number of
+    cores. With a checkpoint, stocks it already has are skipped and every
+    shard is saved to it as it finishes. initializer runs in every worker
+    before its first shard.
+    """
+    from bar_cache import BarCache
+
+    workers = workers or os.cpu_count() or 1
+    shards = shards or workers
+    report = current()
+
+    done, left = resume(checkpoint, [stock["Ticker"] for stock in stocks])
+    evaluated = [[dict(stock, **done[stock["Ticker"]]) for stock in stocks if stock["Ticker"] in done]]
+    left = set(left)
+    todo = [stock for stock in stocks if stock["Ticker"] in left]
+
+    parts = [part for part in split(todo, shards) if part]
+    report.count("shards", len(parts))
+
+    # spawn rather than fork so no worker inherits the pooled connections of this process
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=initializer, initargs=initargs) as executor:
+        futures = {
+            executor.submit(
+                evaluate_shard, part, start_date, end_date, close, refresh, prescreen, cache_dir, _alpaca_share(workers)
+            ): part
+            for part in parts
+        }
+        for future in as_completed(futures):
+            rows, shard_report = future.result()
+            report.merge(shard_report)
+            if checkpoint is not None:
+                checkpoint.add_evaluated([stock["Ticker"] for stock in futures[future]], {row["Ticker"]: row for row in rows})
+            evaluated.append(rows)
+
+    # make room by dropping the symbols that aren't in the universe anymore, once for all shards
+    cache = BarCache(cache_dir) if cache_dir else BarCache()
+    report.count("bar_cache.evicted", len(cache.evict(keep=[stock["Ticker"] for stock in stocks])))
+    return merge(stocks, evaluated)
+
+
+def _shard_file(directory, index):
+    return os.path.join(directory, f"shard-{index:03d}.json")
+
+
+def _write_json(path, value):
+    # the merge never reads half a shard
+    with atomic_write(path, "w") as f:
+        json.dump(value, f, default=lambda value: value.item() if hasattr(value, "item") else str(value))
+
+
+def prepare(directory, stocks, shards, start_date, end_date):
+    """Write the universe and the date range for the shard invocations to pick up"""
+    os.makedirs(directory, exist_ok=True)
+    _write_json(os.path.join(directory, UNIVERSE_FILE), {
+        "shards": shards,
+        "start": start_date.isoformat(),
+        "end": end_date.isoformat(),
+        "stocks": stocks,
+    })
+
+
+def _universe(directory):
+    with open(os.path.join(directory, UNIVERSE_FILE)) as f:
+        universe = json.load(f)
+    universe["start"] = dt.datetime.fromisoformat(universe["start"])
+    universe["end"] = dt.datetime.fromisoformat(universe["end"])
+    return universe
+
+
+def run_shard(directory, index, close="Close", refresh=False, prescreen=False):
+    """Evaluate one shard of a prepared universe and write its result to the directory"""
+    universe = _universe(directory)
+    part = split(universe["stocks"], universe["shards"])[index]
+    rows, report = evaluate_shard(part, universe["start"], universe["end"], close, refresh, prescreen)
+    _write_json(_shard_file(directory, index), rows)
+    # a shard invocation reports like any other run
+    current().emit()
+    return len(rows)
+
+
+def merge_directory(directory):
+    """Merge the shard results in the directory, None until every shard has written its result"""
+    universe = _universe(directory)
+    parts = []
+    for index in range(universe["shards"]):
+        try:
+            with open(_shard_file(directory, index)) as f:
+                parts.append(json.load(f))
+        except FileNotFoundError:
+            print(f"Shard {index} of {universe['shards']} isn't done yet")
+            return None
+    return merge(universe["stocks"], parts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the screener in shards that share a result directory")
+    parser.add_argument("command", choices=["prepare", "run", "merge"])
+    parser.add_argument("--dir", required=True, help="result directory shared by every shard")
+    parser.add_argument("--shards", type=int, default=os.cpu_count(), help="how many shards to prepare")
+    parser.add_argument("--shard", type=int, help="which shard to run")
+    parser.add_argument(
+        "--env", choices=["test", "cloud"], default="test",
+        help="where merge gets the Sheets credentials: test reads service_account.json, cloud Secret Manager",
+    )
+    args = parser.parse_args()
+
+    import main
+
+    if args.command == "prepare":
+        now = dt.datetime.now()
+        stocks = main.screen_universe()
+        if stocks is None:
+            raise SystemExit("We couldn't get the stocks from FinViz")
+        prepare(args.dir, stocks, args.shards, now - dt.timedelta(days=400), now)
+        print(f"Split {len(stocks)} stocks into {args.shards} shards in {args.dir}")
+    elif args.command == "run":
+        count = run_shard(args.dir, args.shard, refresh=main.REFRESH_BAR_CACHE, prescreen=main.LOCAL_PRESCREEN)
+        print(f"Shard {args.shard}: {count} stocks evaluated")
+    else:
+        output = merge_directory(args.dir)
+        if output is not None:
+            output = main.add_sharia_status(output)
+            main.save_sharia_cache()
+            main.publish_output(main.open_spreadsheet(main.get_sheets_credentials(args.env)), output)
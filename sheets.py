@@ -0,0 +1,271 @@
+# Description: Google Sheets publisher
+# Builds every write the screener makes to the "Stock Screener" spreadsheet
+# (values, formats, filter, column sizes and visibility) into a single
+# batch_update instead of one API call per step.
+
+import json
+import random
+
+import numpy as np
+import pandas as pd
+
+from telemetry import current
+
+HEADER_FORMAT = {
+    "backgroundColor": {
+        "red": 216 / 255,
+        "green": 229 / 255,
+        "blue": 252 / 255,
+    },
+    "horizontalAlignment": "CENTER",
+    "textFormat": {"fontSize": 12, "bold": True},
+}
+
+# column -> number format for that whole column
+COLUMN_FORMATS = {
+    "Change": {"type": "PERCENT"},
+    "Market Cap": {"type": "NUMBER", "pattern": '0,,"M"'},
+    "Price": {"type": "CURRENCY"},
+    "Volume": {"type": "NUMBER", "pattern": '0.0,,"M"'},
+}
+
+HIDDEN_COLUMNS = ["cond 1", "cond 2", "cond 3", "cond 4", "cond 5", "cond 6"]
+
+
+def _cell(value):
+    """Turn one DataFrame value into Sheets CellData"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return {}
+    if isinstance(value, (bool, np.bool_)):
+        return {"userEnteredValue": {"boolValue": bool(value)}}
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return {"userEnteredValue": {"numberValue": float(value)}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+def _plain(value):
+    """The value as the Sheets API hands it back unformatted, for comparing"""
+    cell = _cell(value).get("userEnteredValue")
+    if not cell:
+        return ""
+    return next(iter(cell.values()))
+
+
+def _rows(output):
+    """The header and every row of the DataFrame as lists of values"""
+    return [list(output.columns)] + output.to_numpy(dtype=object).tolist()
+
+
+def _update_cells(sheet_id, row, col, rows):
+    """Write a block of values with its top left corner at (row, col)"""
+    return {
+        "updateCells": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": row,
+                "endRowIndex": row + len(rows),
+                "startColumnIndex": col,
+                "endColumnIndex": col + max(len(values) for values in rows),
+            },
+            "rows": [{"values": [_cell(value) for value in values]} for values in rows],
+            "fields": "userEnteredValue",
+        }
+    }
+
+
+def _grid_properties(sheet_id, rows, cols):
+    return {
+        "updateSheetProperties": {
+            "properties": {"sheetId": sheet_id, "gridProperties": {"rowCount": rows, "columnCount": cols}},
+            "fields": "gridProperties(rowCount,columnCount)",
+        }
+    }
+
+
+def _layout_requests(sheet_id, output, condition_columns=HIDDEN_COLUMNS):
+    """Formats, filter, column sizes and hidden columns, using the DataFrame's column indexes"""
+    columns = list(output.columns)
+    col_count = len(columns)
+    requests = [
+        # Format the header row
+        {
+            "repeatCell": {
+                "range": {"sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": col_count},
+                "cell": {"userEnteredFormat": HEADER_FORMAT},
+                "fields": "userEnteredFormat(backgroundColor,horizontalAlignment,textFormat)",
+            }
+        }
+    ]
+
+    # Format cells for their numbers
+    for column, number_format in COLUMN_FORMATS.items():
+        if column in columns:
+            index = columns.index(column)
+            requests.append(
+                {
+                    "repeatCell": {
+                        "range": {"sheetId": sheet_id, "startColumnIndex": index, "endColumnIndex": index + 1},
+                        "cell": {"userEnteredFormat": {"numberFormat": number_format}},
+                        "fields": "userEnteredFormat.numberFormat",
+                    }
+                }
+            )
+
+    # Filter out to only show the ones that met all the conditions, and sort by Volume
+    if "cond count" in columns and "Volume" in columns and "Sharia" in columns:
+        count_filter = {"hiddenValues": [str(count) for count in range(len(condition_columns))]}
+        # with the result history (history.annotate) the ones that just dropped out are shown as well
+        moved = f"{len(condition_columns)}/{len(condition_columns)}"
+        if moved in columns:
+            count_cell = f"${_column_letter(columns.index('cond count'))}2"
+            moved_cell = f"${_column_letter(columns.index(moved))}2"
+            formula = f'=OR({count_cell}={len(condition_columns)}, {moved_cell}="dropped")'
+            count_filter = {"condition": {"type": "CUSTOM_FORMULA", "values": [{"userEnteredValue": formula}]}}
+        requests.append(
+            {
+                "setBasicFilter": {
+                    "filter": {
+                        "range": {"sheetId": sheet_id},
+                        "filterSpecs": [
+                            {
+                                "filterCriteria": count_filter,
+                                "columnIndex": columns.index("cond count"),
+                            },
+                            {
+                                "filterCriteria": {"hiddenValues": ["FAILED"]},
+                                "columnIndex": columns.index("Sharia"),
+                            },
+                        ],
+                        "sortSpecs": [
+                            {
+                                "sortOrder": "DESCENDING",
+                                "dimensionIndex": columns.index("Volume"),
+                            }
+                        ],
+                    }
+                }
+            }
+        )
+
+    # resize the columns
+    requests.append(
+        {
+            "autoResizeDimensions": {
+                "dimensions": {"sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": 0, "endIndex": col_count}
+            }
+        }
+    )
+
+    # show every column then hide the conditions columns
+    requests.append(_column_visibility(sheet_id, 0, col_count, hidden=False))
+    for column in condition_columns:
+        if column in columns:
+            index = columns.index(column)
+            requests.append(_column_visibility(sheet_id, index, index + 1, hidden=True))
+    return requests
+
+
+def _column_letter(index):
+    """The A1 letters of a 0-based column index"""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def _column_visibility(sheet_id, start, end, hidden):
+    return {
+        "updateDimensionProperties": {
+            "range": {"sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": start, "endIndex": end},
+            "properties": {"hiddenByUser": hidden},
+            "fields": "hiddenByUser",
+        }
+    }
+
+
+def _diff_requests(sheet_id, current, rows):
+    """updateCells for only the cells that changed, one request per changed stretch of a row"""
+    requests = []
+    for r, row in enumerate(rows):
+        old = current[r] if r < len(current) else []
+        changed = [
+            c for c, value in enumerate(row) if (old[c] if c < len(old) else "") != _plain(value)
+        ]
+        if changed:
+            first, last = changed[0], changed[-1]
+            requests.append(_update_cells(sheet_id, r, first, [row[first : last + 1]]))
+    return requests
+
+
+def publish(gs, output, title, in_place=False, kind=None, condition_columns=HIDDEN_COLUMNS):
+    """Publish the screener output to a "Screener" sheet in one batch_update
+
+    By default every old "Screener" sheet is replaced by a new sheet called
+    title. With in_place the existing screener sheet is renamed to title and
+    only the cells that changed are written. For another screen (screens.py)
+    kind is its name, and its sheets are the ones titled "<kind> <date>".
+    condition_columns are hidden and the filter shows only the rows that
+    met all of them, or just dropped out of that when the output has the
+    result history's "new"/"dropped" column.
+    """
+    # the filter sorts by Volume anyway, writing the rows in that order keeps the diff small
+    if "Volume" in output.columns:
+        output = output.sort_values("Volume", ascending=False, kind="stable")
+
+    worksheets = gs.worksheets()
+    if kind is None:
+        screeners = [sheet for sheet in worksheets if "Screener" in sheet.title]
+    else:
+        screeners = [sheet for sheet in worksheets if sheet.title.rsplit(" ", 1)[0] == kind]
+    rows = _rows(output)
+    row_count, col_count = len(rows), len(output.columns)
+
+    if in_place and screeners:
+        # reuse today's sheet if we already published today, otherwise the first screener sheet
+        target = next((sheet for sheet in screeners if sheet.title == title), screeners[0])
+        sheet_id = target.id
+        current().count("sheets.requests")
+        values = target.get_all_values(value_render_option="UNFORMATTED_VALUE")
+
+        requests = [
+            {"updateSheetProperties": {"properties": {"sheetId": sheet_id, "title": title}, "fields": "title"}},
+            # resizing first drops anything outside the new output
+            _grid_properties(sheet_id, row_count, col_count),
+        ]
+        requests += _diff_requests(sheet_id, values, rows)
+        others = [sheet for sheet in screeners if sheet.id != sheet_id]
+    else:
+        # pick the new sheet's id ourselves so the writes can go in the same batch as addSheet
+        existing = {sheet.id for sheet in worksheets}
+        sheet_id = random.randint(1, 2**31 - 1)
+        while sheet_id in existing:
+            sheet_id = random.randint(1, 2**31 - 1)
+
+        # a sheet with the same title has to go before the new one can take its name,
+        # the rest are deleted after so the spreadsheet is never left without a sheet
+        requests = [{"deleteSheet": {"sheetId": sheet.id}} for sheet in screeners if sheet.title == title]
+        requests.append(
+            {
+                "addSheet": {
+                    "properties": {
+                        "sheetId": sheet_id,
+                        "title": title,
+                        "gridProperties": {"rowCount": row_count, "columnCount": col_count},
+                    }
+                }
+            }
+        )
+        requests.append(_update_cells(sheet_id, 0, 0, rows))
+        others = [sheet for sheet in screeners if sheet.title != title]
+
+    requests += [{"deleteSheet": {"sheetId": sheet.id}} for sheet in others]
+    requests += _layout_requests(sheet_id, output, condition_columns)
+
+    body = {"requests": requests}
+    report = current()
+    report.count("sheets.requests", 2)  # worksheets() and batch_update
+    report.count("sheets.bytes", len(json.dumps(body)))
+    gs.batch_update(body)
+    return sheet_id
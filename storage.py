@@ -0,0 +1,125 @@
+# Description: Storage shared by the caches and checkpoints
+# Every file the screener keeps between runs (the bar cache, the FinViz and
+# sharia caches, checkpoints, the result history) is replaced in one step:
+# written next to its final name and renamed over it once complete. A crash
+# part way never leaves half a file or half a directory for the next run to read.
+#
+# A Cloud Function's /tmp lives in memory and goes with its instance, and a
+# daily run almost always gets a new one. What has to outlive the instance
+# goes through a store instead: a LocalStore directory when running locally,
+# a GCSStore bucket (gs://bucket/prefix) on Cloud Functions.
+
+import contextlib
+import os
+import shutil
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="wb"):
+    """Open path for writing through a temp file next to it, which replaces path when the block ends"""
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+@contextlib.contextmanager
+def atomic_directory(path):
+    """A temp directory next to path to fill in, swapped in for path when the block ends
+
+    The temp directory starts with a dot so directory listings can skip it.
+    """
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+    try:
+        yield tmp
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+
+
+class LocalStore:
+    """Files in a directory, keys are relative paths"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def read(self, key):
+        try:
+            with open(os.path.join(self.root, key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, key, data):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as f:
+            f.write(data)
+
+    def list(self, prefix):
+        """Every key under prefix"""
+        base = os.path.join(self.root, prefix)
+        keys = []
+        for directory, _, files in os.walk(base):
+            for name in files:
+                if not name.endswith(".tmp"):
+                    keys.append(os.path.relpath(os.path.join(directory, name), self.root))
+        return sorted(keys)
+
+    def runs(self):
+        return os.listdir(self.root) if os.path.isdir(self.root) else []
+
+    def delete(self, prefix):
+        shutil.rmtree(os.path.join(self.root, prefix), ignore_errors=True)
+
+
+class GCSStore:
+    """Objects in a Cloud Storage bucket, keys are object names under prefix"""
+
+    def __init__(self, bucket, prefix=""):
+        from google.cloud import storage
+
+        self.bucket = storage.Client().bucket(bucket)
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+
+    def read(self, key):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            return self.bucket.blob(self.prefix + key).download_as_bytes()
+        except NotFound:
+            return None
+
+    def write(self, key, data):
+        # an object upload is atomic, a reader sees the old object or the new one
+        content_type = "application/json" if key.endswith(".json") else "application/octet-stream"
+        self.bucket.blob(self.prefix + key).upload_from_string(data, content_type=content_type)
+
+    def list(self, prefix):
+        names = (blob.name for blob in self.bucket.list_blobs(prefix=f"{self.prefix}{prefix}/"))
+        return sorted(name[len(self.prefix):] for name in names)
+
+    def runs(self):
+        blobs = self.bucket.list_blobs(prefix=self.prefix, delimiter="/")
+        list(blobs)  # the prefixes are only filled in once the listing is read
+        return [prefix[len(self.prefix):].strip("/") for prefix in blobs.prefixes]
+
+    def delete(self, prefix):
+        for blob in self.bucket.list_blobs(prefix=f"{self.prefix}{prefix}/"):
+            blob.delete()
+
+
+def open_store(location):
+    """A GCSStore for gs://bucket/prefix, a LocalStore for anything else"""
+    if location.startswith("gs://"):
+        bucket, _, prefix = location[len("gs://"):].partition("/")
+        return GCSStore(bucket, prefix)
+    return LocalStore(location)
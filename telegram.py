@@ -1,75 +1,223 @@
+import atexit
 import json
-import urllib3
-from google.cloud import secretmanager
 import os
+import queue
+import threading
+import time
+
+import urllib3
+import rate_limit
+from secret_store import get_secrets
+from telemetry import current
+
+# Pointed at fakes.FakeTelegramServer for tests and benchmarks
+API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+
+# Signals queued within this many seconds of the first one go out as one message
+COALESCE_SECONDS = float(os.getenv("TELEGRAM_COALESCE_SECONDS", 2))
+
+# Telegram rejects longer messages, and a long keyboard is hard to use anyway
+MAX_MESSAGE_LENGTH = 4096
+MAX_SIGNALS_PER_MESSAGE = 20
+
+# How long a process exiting waits for queued messages to go out
+MAX_WAIT_AT_EXIT = 30
 
-http = urllib3.PoolManager()
+# One pooled connection to the Bot API, callers take turns on it
+http = urllib3.PoolManager(num_pools=1, maxsize=1, block=True)
+limiter = rate_limit.limiter("telegram")
 
-# Get the project ID from environment variable
-PROJECT_ID = os.getenv("MY_PROJECT_ID")
 
+# Telegram allows about one message a second in a private chat and 20 a minute in a group (negative ids)
+def chat_limiter(chat_id):
+    return rate_limit.limiter(f"telegram_chat_{chat_id}", 20 if str(chat_id).startswith("-") else 60)
 
-def get_secret(secret_name: str):
-    """Get secret from Google Cloud Secret Manager"""
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{PROJECT_ID}/secrets/{secret_name}/versions/latest"
-    response = client.access_secret_version(name=name)
-    return response.payload.data.decode("UTF-8")
 
+# Send a request to the Bot API at the chat's and the global Telegram rate, retrying when told to slow down
+def tgram_request(method, url, chat_id=None, **kwargs):
+    chat = chat_limiter(chat_id) if chat_id is not None else limiter
+    attempt = 0
+    while True:
+        chat.acquire()
+        if chat is not limiter:
+            limiter.acquire()
+        current().count("telegram.requests")
+        response = http.request(method, url, **kwargs)
 
-# Get Telegram credentials from Secret Manager
-try:
-    BOT_TOKEN = get_secret("telegram_bot_token")
-    CHAT_ID = get_secret("telegram_chat_id")
-except Exception as e:
-    print(f"Error getting Telegram credentials: {str(e)}")
-    BOT_TOKEN = None
-    CHAT_ID = None
+        # Telegram says how long to wait in the body of a 429
+        wait = None
+        if response.status == 429:
+            try:
+                wait = json.loads(response.data)["parameters"]["retry_after"]
+            except (ValueError, KeyError, TypeError):
+                pass
+
+        if not chat.observe(response.status, response.headers, attempt, wait):
+            return response
+        attempt += 1
+
+
+# Get Telegram credentials from Secret Manager the first time a message is sent
+def get_credentials():
+    try:
+        secrets = get_secrets(["telegram_bot_token", "telegram_chat_id"])
+        return secrets["telegram_bot_token"], secrets["telegram_chat_id"]
+    except Exception as e:
+        print(f"Error getting Telegram credentials: {str(e)}")
+        return None, None
 
 
 # Function to send a message using the Telegram Bot API
 def tgram_send_simple(message):
-    if not BOT_TOKEN or not CHAT_ID:
+    bot_token, chat_id = get_credentials()
+    if not bot_token or not chat_id:
         print("Telegram credentials not available")
         return None
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage?chat_id={CHAT_ID}&text={message}"
-    response = http.request("GET", url)
+    # urllib3 encodes the fields into the query string so any text is safe to send
+    url = f"{API_URL}/bot{bot_token}/sendMessage"
+    response = tgram_request("GET", url, chat_id, fields={"chat_id": chat_id, "text": message})
     return response
 
 
 def tgram_send_signal(message, action, ticker, price):
-    if not BOT_TOKEN or not CHAT_ID:
+    return tgram_send_signals([(message, action, ticker, price)])
+
+
+# Send several signals as one message with a button for each
+def tgram_send_signals(signals):
+    bot_token, chat_id = get_credentials()
+    if not bot_token or not chat_id:
         print("Telegram credentials not available")
         return None
 
-    # Define the Inline Keyboard with BUY/SELL button
-    keyboard = [[{"text": action, "callback_data": f"{action}_{ticker}_{price}"}]]
+    # Define the Inline Keyboard with a BUY/SELL button per signal
+    keyboard = [
+        [{"text": f"{action} {ticker}" if len(signals) > 1 else action, "callback_data": f"{action}_{ticker}_{price}"}]
+        for _, action, ticker, price in signals
+    ]
 
     # Prepare the payload
     payload = {
-        "chat_id": CHAT_ID,
-        "text": message,
+        "chat_id": chat_id,
+        "text": "\n".join(message for message, *_ in signals),
         "reply_markup": {"inline_keyboard": keyboard},
     }
 
     # Construct the request URL
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+    url = f"{API_URL}/bot{bot_token}/sendMessage"
     body = json.dumps(payload)
 
     # Send the request
-    response = http.request(
-        "POST", url, body=body, headers={"Content-Type": "application/json"}
+    response = tgram_request(
+        "POST", url, chat_id, body=body, headers={"Content-Type": "application/json"}
     )
     return response
 
 
+class Notifier:
+    """Delivers messages and signals from a background thread so callers never wait on Telegram
+
+    Whatever is queued within COALESCE_SECONDS of the first item is sent
+    together: signals as one message with a button each, plain messages
+    joined into as few messages as fit.
+    """
+
+    def __init__(self, coalesce=COALESCE_SECONDS):
+        self.coalesce = coalesce
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._done = threading.Condition()
+        self._thread = None
+
+    def send(self, message):
+        self._put(("message", message))
+
+    def signal(self, message, action, ticker, price):
+        self._put(("signal", (message, action, ticker, price)))
+
+    def _put(self, item):
+        with self._done:
+            self._pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="telegram", daemon=True)
+                self._thread.start()
+                # don't lose what is still queued when the process exits
+                atexit.register(self.flush, MAX_WAIT_AT_EXIT)
+        self._queue.put(item)
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been sent, returns False on timeout"""
+        with self._done:
+            return self._done.wait_for(lambda: self._pending == 0, timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.coalesce
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._deliver(batch)
+            except Exception as e:
+                print(f"Error sending to Telegram: {str(e)}")
+            with self._done:
+                self._pending -= len(batch)
+                self._done.notify_all()
+
+    def _deliver(self, batch):
+        report = current()
+        signals = [payload for kind, payload in batch if kind == "signal"]
+        messages = [payload for kind, payload in batch if kind == "message"]
+        report.count("telegram.queued", len(batch))
+
+        for i in range(0, len(signals), MAX_SIGNALS_PER_MESSAGE):
+            _check(tgram_send_signals(signals[i:i + MAX_SIGNALS_PER_MESSAGE]))
+            report.count("telegram.messages")
+
+        text = ""
+        for message in messages:
+            if text and len(text) + len(message) + 2 > MAX_MESSAGE_LENGTH:
+                _check(tgram_send_simple(text))
+                report.count("telegram.messages")
+                text = ""
+            text = f"{text}\n\n{message}" if text else message[:MAX_MESSAGE_LENGTH]
+        if text:
+            _check(tgram_send_simple(text))
+            report.count("telegram.messages")
+
+
+def _check(response):
+    if response is not None and response.status != 200:
+        print(f"Telegram answered {response.status}: {response.data[:200]}")
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+# The shared notification queue, started on first use
+def notifier():
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = Notifier()
+        return _notifier
+
+
 # Example usage (commented out)
 # action = "BUY"
 # ticker = "AAPL"
 # price = 100.00
 # message = f"{action} --> {ticker} at {price}"
 # r = tgram_send_signal(message, action, ticker, price)
+# or without waiting for Telegram:
+# notifier().signal(message, action, ticker, price)
 
 # Set webhook (commented out)
 # webhook_url = "https://xqtie2r7pxtb63ewmbj3b6u7dm0kexyt.lambda-url.us-east-1.on.aws/aD0ymuDug5/callback"
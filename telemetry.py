@@ -0,0 +1,168 @@
+# Description: Run telemetry
+# Collects stage timings, counters and retry/rate limit events for one
+# invocation of the screener and emits them as a single JSON run report.
+# Code anywhere in the run records through current() so nothing has to be
+# passed down. cProfile and tracemalloc captures can be switched on with
+# SCREENER_PROFILE=cprofile, tracemalloc or both.
+
+import contextlib
+import cProfile
+import datetime as dt
+import heapq
+import io
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+# Where run reports (and cProfile dumps) are written, they always go to stdout as well
+REPORT_DIR = os.getenv("RUN_REPORT_DIR")
+
+# cprofile, tracemalloc or both (comma separated)
+PROFILE = {mode.strip() for mode in os.getenv("SCREENER_PROFILE", "").lower().split(",") if mode.strip()}
+
+# How many of the slowest items to keep per kind
+SLOWEST = 10
+
+# Events beyond this are only counted so a bad run can't blow up the report
+MAX_EVENTS = 200
+
+
+class RunReport:
+    def __init__(self, name="screener"):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.events = []
+        self.slowest = {}
+        self.info = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage of the run, a stage that raises is recorded as failed"""
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            self.stages[name] = {"seconds": round(time.perf_counter() - started, 4), "status": status}
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def event(self, kind, **fields):
+        """Record something worth looking at later, like a retry or a rate limit"""
+        self.count(f"events.{kind}")
+        with self._lock:
+            if len(self.events) < MAX_EVENTS:
+                self.events.append({"kind": kind, "at": round(time.time() - self.started, 3), **fields})
+
+    def observe(self, kind, key, seconds):
+        """Keep track of how long one item took, only the slowest few are kept"""
+        with self._lock:
+            slowest = self.slowest.setdefault(kind, [])
+            item = (round(seconds, 4), str(key))
+            if len(slowest) < SLOWEST:
+                heapq.heappush(slowest, item)
+            else:
+                heapq.heappushpop(slowest, item)
+
+    def set(self, **info):
+        self.info.update(info)
+
+    def merge(self, other):
+        """Add the counters, events and slowest items of another report's to_dict(), like a worker process's"""
+        with self._lock:
+            for name, n in other.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.events.extend(other.get("events", [])[:max(MAX_EVENTS - len(self.events), 0)])
+        for kind, items in other.get("slowest", {}).items():
+            for item in items:
+                self.observe(kind, item["key"], item["seconds"])
+
+    def to_dict(self):
+        return {
+            "run_id": self.run_id,
+            "name": self.name,
+            "started": dt.datetime.fromtimestamp(self.started, dt.timezone.utc).isoformat(timespec="seconds"),
+            "seconds": round(time.time() - self.started, 4),
+            "stages": self.stages,
+            "counters": dict(sorted(self.counters.items())),
+            "events": self.events,
+            "slowest": {
+                kind: [{"key": key, "seconds": seconds} for seconds, key in sorted(items, reverse=True)]
+                for kind, items in self.slowest.items()
+            },
+            **self.info,
+        }
+
+    def emit(self):
+        """Print the report as one JSON line and write it to REPORT_DIR if that is set"""
+        report = json.dumps(self.to_dict(), default=str)
+        print(report)
+        if REPORT_DIR:
+            os.makedirs(REPORT_DIR, exist_ok=True)
+            with open(os.path.join(REPORT_DIR, f"run-{self.run_id}.json"), "w") as f:
+                f.write(report)
+        return report
+
+
+# Stands in when no run is active so recording is always safe
+_report = RunReport("idle")
+
+
+def current():
+    return _report
+
+
+def start_run(name="screener"):
+    global _report
+    _report = RunReport(name)
+    return _report
+
+
+@contextlib.contextmanager
+def profiled(report):
+    """Capture cProfile and/or tracemalloc for the block if SCREENER_PROFILE asks for them"""
+    profiler = cProfile.Profile() if "cprofile" in PROFILE else None
+    tracing = "tracemalloc" in PROFILE and not tracemalloc.is_tracing()
+
+    if tracing:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            path = os.path.join(REPORT_DIR or tempfile.gettempdir(), f"run-{report.run_id}.prof")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            profiler.dump_stats(path)
+
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(15)
+            report.set(profile={"file": path, "top": summary.getvalue().splitlines()[-20:]})
+
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report.set(
+                memory={
+                    "peak_mb": round(peak_bytes / 1024 / 1024, 2),
+                    "current_mb": round(current_bytes / 1024 / 1024, 2),
+                    "top": [str(stat) for stat in snapshot.statistics("lineno")[:10]],
+                }
+            )